@@ -0,0 +1,113 @@
+"""
+Benchmark linearizable against serializable configuration reads.
+
+Writes a number of processing blocks with state, then repeatedly reads
+them back the way a monitoring client would (list processing blocks,
+read state of each), once using linearizable and once using
+serializable transactions. Reports read latency percentiles, and the
+change of etcd server metrics on every given cluster member - which
+shows how much of the read load ends up on the leader.
+
+Usage:
+  bench_serializable.py [options] [<metrics_url>...]
+
+Options:
+  --pbs <count>       Number of processing blocks to create [default: 20]
+  --reads <count>     Number of read transactions per mode [default: 200]
+  --prefix <prefix>   Database prefix to use [default: /__bench_read]
+  --metric <regex>    Metrics to report
+                      [default: etcd_debugging_mvcc_range_total|etcd_network_peer_sent_bytes_total]
+
+Example (three member cluster, client connected to a follower):
+  SDP_CONFIG_HOST=etcd-1 bench_serializable.py \\
+     http://etcd-0:2379/metrics http://etcd-1:2379/metrics \\
+     http://etcd-2:2379/metrics
+"""
+
+# pylint: disable=invalid-name
+
+import re
+import time
+import urllib.request
+import docopt
+import ska_sdp_config
+
+WORKFLOW = {'type': 'realtime', 'id': 'bench', 'version': '0.0.1'}
+
+
+def read_metrics(urls, pattern):
+    """Sum up matching metrics per member."""
+    result = []
+    for url in urls:
+        totals = {}
+        with urllib.request.urlopen(url) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith('#'):
+                    continue
+                match = re.match(r'^(' + pattern + r')(\{.*\})?\s+(\S+)$',
+                                 line)
+                if match:
+                    name = match.group(1)
+                    totals[name] = totals.get(name, 0) + float(match.group(3))
+        result.append(totals)
+    return result
+
+
+def percentile(values, pct):
+    """Determine percentile of a sorted list."""
+    return values[min(len(values)-1, int(len(values) * pct / 100))]
+
+
+def bench(config, reads, serializable):
+    """Read processing blocks + state, return sorted latencies."""
+    latencies = []
+    for _ in range(reads):
+        start = time.time()
+        for txn in config.txn(serializable=serializable):
+            for pb_id in txn.list_processing_blocks():
+                txn.get_processing_block_state(pb_id)
+        latencies.append(time.time() - start)
+    return sorted(latencies)
+
+
+def main():
+    """Run benchmark."""
+    args = docopt.docopt(__doc__)
+    pbs = int(args['--pbs'])
+    reads = int(args['--reads'])
+    urls = args['<metrics_url>']
+    pattern = args['--metric']
+
+    config = ska_sdp_config.Config(global_prefix=args['--prefix'])
+    config._backend.delete(  # pylint: disable=protected-access
+        args['--prefix'], must_exist=False, recursive=True)
+    try:
+        for i in range(pbs):
+            pb_id = 'bench-00000000-{:04d}'.format(i)
+            for txn in config.txn():
+                txn.create_processing_block(
+                    ska_sdp_config.ProcessingBlock(pb_id, None, WORKFLOW))
+                txn.create_processing_block_state(
+                    pb_id, {'state': 'executing'})
+
+        for serializable in (False, True):
+            before = read_metrics(urls, pattern)
+            latencies = bench(config, reads, serializable)
+            after = read_metrics(urls, pattern)
+            print("{} reads: mean {:.2f} ms, p50 {:.2f} ms, p99 {:.2f} ms"
+                  .format("Serializable" if serializable else "Linearizable",
+                          1000 * sum(latencies) / len(latencies),
+                          1000 * percentile(latencies, 50),
+                          1000 * percentile(latencies, 99)))
+            for url, metrics0, metrics1 in zip(urls, before, after):
+                for name in sorted(metrics1):
+                    print("  {} {}: +{:.0f}".format(
+                        url, name, metrics1[name] - metrics0.get(name, 0)))
+    finally:
+        config._backend.delete(  # pylint: disable=protected-access
+            args['--prefix'], must_exist=False, recursive=True)
+        config.close()
+
+
+if __name__ == '__main__':
+    main()
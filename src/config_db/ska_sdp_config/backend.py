@@ -1,14 +1,22 @@
 """
 Backend database modules for SKA SDP configuration information.
 
-At the moment we only support etcd3.
+At the moment we only support etcd3 (or an in-memory stand-in for it,
+see :mod:`ska_sdp_config.memory`).
 """
 
+import os
 import time
+import json
+import hashlib
+import logging
+import threading
 import queue as queue_m
 
 import etcd3
 
+LOG = logging.getLogger(__name__)
+
 
 # Some utilities for handling tagging paths.
 #
@@ -28,6 +36,11 @@ def _tag_depth(path, depth=None):
     return "{}{}".format(depth, path).encode('utf-8')
 
 
+def _prefix_end(key):
+    """Get end of range of keys with the given prefix."""
+    return key[:-1] + bytes([key[-1] + 1])
+
+
 def _untag_depth(path):
     """Remove depth from path."""
     # Cut from first '/'
@@ -37,6 +50,71 @@ def _untag_depth(path):
     return path[slash_ix:]
 
 
+# Utilities for chunked storage of large values.
+#
+# Values larger than the chunk size get split into chunks. The value
+# key itself gets a manifest listing the keys and hashes of the
+# chunks, which is what transactions check and watchers trigger on.
+#
+# Chunk keys are the tagged path of the value prefixed with "~" plus
+# ":chunk/[name]". As the tag does not start with a digit, chunks
+# never fall into the ranges of lists or watches. Every write uses
+# fresh chunk names (unchanged chunks get reused), and chunks are
+# only deleted once no committed manifest refers to them any more. So
+# chunks can get written in separate requests ahead of the manifest:
+# etcd limits the size of requests (--max-request-bytes, 1.5 MiB by
+# default), so writing all chunks in the transaction committing the
+# manifest would fail for large values.
+
+#: Values larger than this number of bytes get stored in chunks. Must
+#: stay below the maximum request size of etcd, and the other values
+#: written by a transaction have to fit into a request together.
+CHUNK_SIZE = 1024 * 1024
+
+_CHUNK_TAG = ':chunk/'
+_MANIFEST_PREFIX = b'{"__chunked__":'
+
+
+def _chunk_key(path, name=''):
+    """Get key of a chunk of a value (or prefix of all its chunks)."""
+    return b'~' + _tag_depth(path) + (_CHUNK_TAG + name).encode('utf-8')
+
+
+def _split_chunks(data, chunk_size):
+    """Split encoded value into chunks without splitting characters."""
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(start + chunk_size, len(data))
+        # Do not split UTF-8 continuation bytes from their character
+        while end < len(data) and end > start+1 and \
+                (data[end] & 0xC0) == 0x80:
+            end -= 1
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def _make_manifest(data, hashes, names):
+    """Make manifest for a chunked value."""
+    return _MANIFEST_PREFIX + json.dumps({
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'chunks': hashes,
+        'keys': names
+    }, separators=(',', ':')).encode('utf-8') + b'}'
+
+
+def _parse_manifest(data):
+    """Parse manifest, returning None if value is not chunked."""
+    if not data.startswith(_MANIFEST_PREFIX):
+        return None
+    try:
+        return json.loads(data.decode('utf-8'))['__chunked__']
+    except (ValueError, KeyError):
+        return None
+
+
 class Etcd3():
     """
     Highly consistent database backend store.
@@ -44,13 +122,21 @@ class Etcd3():
     See https://github.com/etcd-io/etcd
     """
 
-    def __init__(self, *args, **kw_args):
+    def __init__(self, *args, chunk_size=CHUNK_SIZE, client=None, **kw_args):
         """Instantiate the database client.
 
-        All parameters will be passed on
+        All other parameters will be passed on
         to pmeth:`etcd3.Client`.
+
+        :param chunk_size: Values written by transactions that are
+            larger than this number of bytes get split into chunks
+        :param client: Client to use instead of connecting to etcd
+            (see :class:`ska_sdp_config.memory.MemoryClient`)
         """
-        self._client = etcd3.Client(*args, **kw_args)
+        if client is None:
+            client = etcd3.Client(*args, **kw_args)
+        self._client = client
+        self.chunk_size = chunk_size
 
     def lease(self, ttl=10):
         """Generate a new lease.
@@ -65,18 +151,32 @@ class Etcd3():
         """
         return self._client.Lease(ttl=ttl)
 
-    def txn(self, max_retries=64):
-        """Create a new transaction."""
-        return Etcd3Transaction(self, self._client, max_retries)
+    def txn(self, max_retries=64, serializable=False):
+        """Create a new transaction.
 
-    def get(self, path, revision=None):
+        :param max_retries: Number of transaction retries before a
+            :class:`RuntimeError` gets raised.
+        :param serializable: Use serializable reads. The transaction
+            will be read-only.
+        """
+        return Etcd3Transaction(self, self._client, max_retries, serializable)
+
+    def get(self, path, revision=None, serializable=False):
         """
         Get value of a key.
 
         :param path: Path of key to query
         :param revision: Database revision for which to read key
+        :param serializable: Allow any cluster member to answer the
+            read from its local state, which might be slightly stale.
+            Linearizable (default) reads always go through the leader.
         :returns: (value, revision). value is None if it doesn't exist
         """
+        value, rev, _ = self._get(path, revision, serializable)
+        return value, rev
+
+    def _get(self, path, revision=None, serializable=False):
+        """Get value of a key, plus the manifest if it was chunked."""
         # Check/prepare parameters
         if path and path[-1] == '/':
             raise ValueError("Path should not have a trailing '/'!")
@@ -84,19 +184,55 @@ class Etcd3():
         rev = (None if revision is None else revision.revision)
 
         # Query range
-        response = self._client.range(tagged_path, revision=rev)
+        response = self._client.range(
+            tagged_path, revision=rev, serializable=serializable)
 
         # Get value returned
         result = response.kvs
         mod_revision = None
+        manifest = None
         if result is not None:
             assert len(response.kvs) == 1, \
                 "Requesting '{}' yielded more than one match!".format(path)
             mod_revision = result[0].mod_revision
-            result = result[0].value.decode('utf-8')
+            result, manifest = self._decode_value(
+                path, result[0].value,
+                response.header.revision if rev is None else rev,
+                serializable)
 
         # Return value together with revision
-        return (result, Etcd3Revision(response.header.revision, mod_revision))
+        return (result,
+                Etcd3Revision(response.header.revision, mod_revision),
+                manifest)
+
+    def _decode_value(self, path, data, revision, serializable=False):
+        """Decode a value, reassembling it from chunks if required.
+
+        :param path: Path of the key
+        :param data: Value as stored in the database
+        :param revision: Revision at which to read chunks
+        :param serializable: Use serializable read for chunks
+        :returns: (value, manifest). manifest is None if not chunked
+        """
+        data = data or b''
+        manifest = _parse_manifest(data)
+        if manifest is None:
+            return data.decode('utf-8'), None
+
+        # Read all chunks with one request at the same revision
+        txn = self._client.Txn()
+        for name in manifest['keys']:
+            txn.success(txn.range(
+                _chunk_key(path, name), revision=revision,
+                serializable=serializable))
+        kvs = [res.response_range.kvs
+               for res in txn.commit().responses or []]
+        data = b''.join(kv[0].value for kv in kvs if kv)
+        if len(kvs) != len(manifest['chunks']) or not all(kvs) or \
+           hashlib.sha256(data).hexdigest() != manifest['sha256']:
+            raise RuntimeError(
+                "Chunks of {} do not match manifest!".format(path))
+        return data.decode('utf-8'), manifest
 
     def watch(self, path, prefix=False, revision=None, depth=None):
         """Watch key or key range.
@@ -107,20 +243,39 @@ class Etcd3():
         :param path: Path of key to query, or prefix of keys.
         :param prefix: Watch for keys with given prefix if set
         :param revision: Database revision from which to watch
+        :param depth: Depth of keys to watch. If iterable, watch keys
+           with the given prefix at all of these depths using a single
+           watch, so updates arrive in revision order across depths.
         :returns: `Etcd3Watcher` object for watch request
         """
         # Check/prepare parameters
         if not prefix and path and path[-1] == '/':
             raise ValueError("Path should not have a trailing '/'!")
-        tagged_path = _tag_depth(path, depth)
         rev = (None if revision is None else revision.revision)
+        try:
+            depths = sorted(set(depth))
+        except TypeError:
+            depths = None
 
         # Set up watcher
+        if depths is None:
+            watcher = self._client.Watcher(
+                _tag_depth(path, depth), start_revision=rev, prefix=prefix)
+            return Etcd3Watcher(watcher, self)
+        if not prefix or not depths:
+            raise ValueError("Watching several depths needs a prefix!")
+
+        # Depth tags come first, so the range from the first to the
+        # last depth also covers other keys at the depths in between,
+        # which we need to filter out
+        tagged_paths = tuple(_tag_depth(path, dpth) for dpth in depths)
         watcher = self._client.Watcher(
-            tagged_path, start_revision=rev, prefix=prefix)
-        return Etcd3Watcher(watcher, self)
+            tagged_paths[0], range_end=_prefix_end(tagged_paths[-1]),
+            start_revision=rev)
+        return Etcd3Watcher(watcher, self, key_filter=lambda key: any(
+            key.startswith(tagged) for tagged in tagged_paths))
 
-    def list_keys(self, path, recurse=0, revision=None):
+    def list_keys(self, path, recurse=0, revision=None, serializable=False):
         """
         List keys under given path.
 
@@ -128,8 +283,10 @@ class Etcd3():
            child paths.
         :param recurse: Maximum recursion level to query. If iterable,
            cover exactly the recursion levels specified.
-        :param revision: Database revision for which to list :returns:
-            (sorted key list, revision)
+        :param revision: Database revision for which to list
+        :param serializable: Allow any cluster member to answer the
+           read (see :meth:`get`)
+        :returns: (sorted key list, revision)
         """
         # Prepare parameters
         path_depth = path.count('/')
@@ -146,7 +303,8 @@ class Etcd3():
         for depth in depth_iter:
             tagged_path = _tag_depth(path, depth+path_depth)
             txn.success(txn.range(
-                tagged_path, prefix=True, keys_only=True, revision=rev))
+                tagged_path, prefix=True, keys_only=True, revision=rev,
+                serializable=serializable))
         response = txn.commit()
 
         # We do not return a mod revision here - this would not be
@@ -164,6 +322,58 @@ class Etcd3():
         ])
         return (sorted_keys, revision)
 
+    def list_values(self, path, recurse=0, revision=None,
+                    serializable=False):
+        """
+        List keys together with their values under given path.
+
+        Works like :meth:`list_keys`, but retrieves values in the
+        same ranged read. Useful for taking a consistent snapshot of
+        many keys at once.
+
+        :param path: Prefix of keys to query. Append '/' to list
+           child paths.
+        :param recurse: Maximum recursion level to query. If iterable,
+           cover exactly the recursion levels specified.
+        :param revision: Database revision for which to list
+        :param serializable: Allow any cluster member to answer the
+           read (see :meth:`get`)
+        :returns: (sorted list of (key, value, revision) triples, revision)
+        """
+        # Prepare parameters
+        path_depth = path.count('/')
+        rev = None
+        if revision is not None:
+            rev = revision.revision
+
+        # Make transaction to collect keys from all levels
+        txn = self._client.Txn()
+        try:
+            depth_iter = iter(recurse)
+        except TypeError:
+            depth_iter = range(recurse+1)
+        for depth in depth_iter:
+            tagged_path = _tag_depth(path, depth+path_depth)
+            txn.success(txn.range(tagged_path, prefix=True, revision=rev,
+                                  serializable=serializable))
+        response = txn.commit()
+
+        revision = Etcd3Revision(response.header.revision, None)
+        if response.responses is None:
+            return ([], revision)
+
+        # Collect and sort key/value pairs
+        values = []
+        for res in response.responses:
+            for kv in res.response_range.kvs or []:
+                key = _untag_depth(kv.key.decode('utf-8'))
+                value, _ = self._decode_value(
+                    key, kv.value, revision.revision if rev is None else rev,
+                    serializable)
+                values.append((key, value, Etcd3Revision(
+                    revision.revision, kv.mod_revision)))
+        return (sorted(values, key=lambda kv: kv[0]), revision)
+
     def create(self, path, value, lease=None):
         """Create a key and initialise it with the value.
 
@@ -213,6 +423,7 @@ class Etcd3():
                 raise ValueError("Did not pass a valid mod_revision!")
             txn.compare(txn.key(tagged_path).mod == must_be_rev.mod_revision)
         txn.success(txn.put(tagged_path, value))
+        txn.success(txn.delete(_chunk_key(path), prefix=True))
         if not txn.commit().succeeded:
             raise Vanished(
                 path, "Cannot update {}, as it does not exist!".format(path))
@@ -232,11 +443,18 @@ class Etcd3():
         # Prepare parameters
         tagged_path = _tag_depth(path)
 
-        # Determine start recursion level
+        # Determine start recursion level. Without prefix or
+        # recursion, only remove chunks if the key exists: a
+        # transaction might be about to create it, having written its
+        # chunks already.
         txn = self._client.Txn()
-        if must_exist:
+        if must_exist or not (prefix or recursive):
             txn.compare(txn.key(tagged_path).version != 0)
         txn.success(txn.delete(tagged_path, prefix=prefix))
+        if prefix:
+            txn.success(txn.delete(b'~' + tagged_path, prefix=True))
+        else:
+            txn.success(txn.delete(_chunk_key(path), prefix=True))
 
         # If recursive, we also delete all paths at lower recursion
         # levels that have the path as a prefix
@@ -245,9 +463,10 @@ class Etcd3():
             for lvl in range(depth+1, depth+max_depth):
                 dpath = _tag_depth(path if prefix else path+'/', lvl)
                 txn.success(txn.delete(dpath, prefix=True))
+                txn.success(txn.delete(b'~' + dpath, prefix=True))
 
         # Execute
-        if not txn.commit().succeeded:
+        if not txn.commit().succeeded and must_exist:
             raise Vanished(
                 path, "Cannot delete {}, as it does not exist!".format(path))
 
@@ -314,10 +533,21 @@ class Etcd3Watcher():
     val, rev)` triples.
     """
 
-    def __init__(self, watcher, backend):
-        """Initialise watcher."""
+    def __init__(self, watcher, backend, key_filter=None):
+        """Initialise watcher.
+
+        :param watcher: etcd3 watcher to wrap
+        :param backend: Backend to decode values with
+        :param key_filter: Only report events for (tagged) keys this
+           returns true for
+        """
         self._watcher = watcher
         self._backend = backend
+        self._key_filter = key_filter
+        self._lock = threading.Lock()
+        self._events = queue_m.Queue()  # Events to decode in order
+        self._pending = 0
+        self._decoder = None
         self.queue = None
 
     def start(self, queue=None):
@@ -325,23 +555,71 @@ class Etcd3Watcher():
         if queue is None:
             self.queue = queue = queue_m.Queue()
 
+        # Decoding chunked values needs to read the chunks, which we
+        # should not do on the thread delivering watch events. Such
+        # events (and all following until they are done) get decoded
+        # by a separate thread.
         def on_event(event):
-            key = _untag_depth(event.key.decode('utf-8'))
-            if event.type == etcd3.EventType.PUT:
-                val = event.value.decode('utf-8')
-                rev = Etcd3Revision(event.mod_revision, event.mod_revision)
-            else:
-                val = None
-                rev = Etcd3Revision(event.mod_revision, event.mod_revision)
-            queue.put((key, val, rev))
+            if self._key_filter is not None and \
+               not self._key_filter(event.key):
+                return
+            with self._lock:
+                if self._pending == 0 and (
+                        event.type != etcd3.EventType.PUT or
+                        _parse_manifest(event.value or b'') is None):
+                    queue.put(self._decode_event(event))
+                    return
+                self._pending += 1
+                self._events.put(event)
+                if self._decoder is None:
+                    self._decoder = threading.Thread(
+                        target=self._decode_events,
+                        args=(self._events, queue),
+                        name='watch-decode', daemon=True)
+                    self._decoder.start()
 
         self._watcher.onEvent(on_event)
         self._watcher.runDaemon()
 
+    def _decode_event(self, event):
+        """Decode an event into a (key, val, rev) triple."""
+        key = _untag_depth(event.key.decode('utf-8'))
+        rev = Etcd3Revision(event.mod_revision, event.mod_revision)
+        if event.type != etcd3.EventType.PUT:
+            return (key, None, rev)
+        # pylint: disable=protected-access
+        val, _ = self._backend._decode_value(
+            key, event.value, event.mod_revision)
+        return (key, val, rev)
+
+    def _decode_events(self, events, queue):
+        """Decode pending events on the decoder thread."""
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            try:
+                result = self._decode_event(event)
+            except RuntimeError as exc:
+                LOG.error("Could not decode %s: %s", event.key, exc)
+                result = None
+            with self._lock:
+                if events is not self._events:
+                    return
+                if result is not None:
+                    queue.put(result)
+                self._pending -= 1
+
     def stop(self):
         """Deactivates the watcher."""
         self._watcher.clear_callbacks()
         self._watcher.stop()
+        with self._lock:
+            if self._decoder is not None:
+                self._events.put(None)
+                self._events = queue_m.Queue()
+                self._pending = 0
+                self._decoder = None
         self.queue = None
 
     def __enter__(self):
@@ -371,6 +649,11 @@ class Etcd3Transaction():
 
     This can also be used to loop a transaction manually, possibly
     waiting for read values to change (see :meth:`Etcd3Transaction.loop`).
+
+    Serializable transactions read from whichever cluster member
+    answers, so they might see a slightly stale snapshot. As commit
+    validation could not detect this, such transactions are
+    read-only.
     """
 
     # Ideas:
@@ -399,15 +682,17 @@ class Etcd3Transaction():
     # "get" a key before "updating" it anyway, and collisions on
     # "create" should be quite rare.
 
-    def __init__(self, backend, client, max_retries=64):
+    def __init__(self, backend, client, max_retries=64, serializable=False):
         """Initialise transaction."""
         self._backend = backend
         self._client = client
         self._max_retries = max_retries
+        self._serializable = serializable
 
         self._revision = None  # Revision backed in after first read
         self._get_queries = {}  # Query log
         self._list_queries = {}  # Query log
+        self._manifests = {}  # Manifests of chunked values read
         self._updates = {}  # Delayed updates
 
         self._committed = False
@@ -426,6 +711,21 @@ class Etcd3Transaction():
         if self._committed:
             raise RuntimeError("Attempted to modify committed transaction!")
 
+    def _ensure_writable(self):
+        if self._serializable:
+            raise RuntimeError(
+                "Attempted to write using serializable transaction!")
+
+    @property
+    def serializable(self):
+        """Whether this transaction uses serializable reads."""
+        return self._serializable
+
+    @property
+    def revision(self):
+        """Revision the transaction reads at (None before first read)."""
+        return self._revision
+
     def get(self, path):
         """
         Get value of a key.
@@ -444,8 +744,12 @@ class Etcd3Transaction():
             return self._get_queries[path][0]
 
         # Perform get request
-        val, rev = self._get_queries[path] = \
-            self._backend.get(path, revision=self._revision)
+        # pylint: disable=protected-access
+        val, rev, manifest = self._backend._get(
+            path, revision=self._revision, serializable=self._serializable)
+        self._get_queries[path] = (val, rev)
+        if manifest is not None:
+            self._manifests[path] = manifest
 
         # Set revision, if not already done so
         if self._revision is None:
@@ -490,7 +794,8 @@ class Etcd3Transaction():
             query = (path, depth+path_depth)
             if query not in self._list_queries:
                 self._list_queries[query] = self._backend.list_keys(
-                    path, recurse=(depth,), revision=self._revision)
+                    path, recurse=(depth,), revision=self._revision,
+                    serializable=self._serializable)
 
             # Add to key set
             result, rev = self._list_queries[query]
@@ -515,6 +820,7 @@ class Etcd3Transaction():
         :raises: Collision
         """
         self._ensure_uncommitted()
+        self._ensure_writable()
 
         # Attempt to get the value - mainly to check whether it exists
         # and put it into the query log
@@ -535,6 +841,7 @@ class Etcd3Transaction():
         :raises: Vanished
         """
         self._ensure_uncommitted()
+        self._ensure_writable()
 
         # As with "update"
         result = self.get(path)
@@ -552,6 +859,7 @@ class Etcd3Transaction():
         :param path: Path of key to remove
         :param must_exist: Fail if path does not exist?
         """
+        self._ensure_writable()
         if must_exist:
             # As with "update"
             result = self.get(path)
@@ -611,24 +919,98 @@ class Etcd3Transaction():
             txn.compare(txn.key(tagged_path, prefix=True).create
                         < self._revision.revision+1)
 
+        # Deleting keys we did not read? Read them in the transaction
+        # to find their chunks
+        blind_deletes = [
+            path for path, (value, _) in self._updates.items()
+            if value is None and path not in self._get_queries
+        ]
+        for path in blind_deletes:
+            txn.success(txn.range(_tag_depth(path)))
+
         # Commit changes. Note that the dictionary guarantees that we
-        # only update any key at most once.
-        for path, (value, lease) in self._updates.items():
-            tagged_path = _tag_depth(path)
-            lease_id = (None if lease is None else lease.ID)
-            if value is None:
-                txn.success(txn.delete(tagged_path, value, lease_id))
-            else:
-                txn.success(txn.put(tagged_path, value, lease_id))
+        # only update any key at most once. Chunks get written ahead.
+        written = []
+        obsolete = []
+        try:
+            for path, (value, lease) in self._updates.items():
+                self._commit_update(txn, path, value, lease,
+                                    written, obsolete)
+        except BaseException:
+            self._delete_chunks(written)
+            raise
 
         # Done
         self._committed = True
         response = txn.commit()
-        if response.succeeded:
-            for callback in self._commit_callbacks:
-                callback()
+        if not response.succeeded:
+            self._delete_chunks(written)
+            self._commit_callbacks = []
+            return False
+
+        # Remove chunks no longer referenced
+        for path, res in zip(blind_deletes, response.responses):
+            for kv in res.response_range.kvs or []:
+                manifest = _parse_manifest(kv.value or b'')
+                if manifest is not None:
+                    obsolete.extend(
+                        _chunk_key(path, name) for name in manifest['keys'])
+        self._delete_chunks(obsolete)
+        for callback in self._commit_callbacks:
+            callback()
         self._commit_callbacks = []
-        return response.succeeded
+        return True
+
+    def _commit_update(self, txn, path, value, lease, written, obsolete):
+        """Add operations for updating a key to the etcd transaction.
+
+        :param written: List to add keys of chunks written to
+        :param obsolete: List to add keys of chunks to delete once
+            the transaction has been committed
+        """
+        tagged_path = _tag_depth(path)
+        lease_id = (None if lease is None else lease.ID)
+        old_manifest = self._manifests.get(path)
+        old_names = [] if old_manifest is None else old_manifest['keys']
+
+        # Delete, or small enough to write directly?
+        data = None if value is None else str(value).encode('utf-8')
+        if data is None or len(data) <= self._backend.chunk_size:
+            if data is None:
+                txn.success(txn.delete(tagged_path))
+            else:
+                txn.success(txn.put(tagged_path, data, lease_id))
+            obsolete.extend(_chunk_key(path, name) for name in old_names)
+            return
+
+        # Write chunks, reusing those that have not changed
+        chunks = _split_chunks(data, self._backend.chunk_size)
+        hashes = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+        old_hashes = [] if old_manifest is None else old_manifest['chunks']
+        write_id = os.urandom(8).hex()
+        names = []
+        for i, (chunk, chunk_hash) in enumerate(zip(chunks, hashes)):
+            if i < len(old_hashes) and old_hashes[i] == chunk_hash:
+                names.append(old_names[i])
+                continue
+            names.append("{}.{:06d}".format(write_id, i))
+            key = _chunk_key(path, names[-1])
+            chunk_txn = self._client.Txn()
+            chunk_txn.success(chunk_txn.put(key, chunk, lease_id))
+            chunk_txn.commit()
+            written.append(key)
+        obsolete.extend(_chunk_key(path, name)
+                        for name in old_names if name not in names)
+        txn.success(txn.put(
+            tagged_path, _make_manifest(data, hashes, names), lease_id))
+
+    def _delete_chunks(self, keys):
+        """Delete chunks, in requests of bounded size."""
+        for start in range(0, len(keys), 128):
+            txn = self._client.Txn()
+            for key in keys[start:start+128]:
+                txn.success(txn.delete(key))
+            txn.commit()
 
     def on_commit(self, callback):
         """Register a callback to call when the transaction succeeds.
@@ -650,6 +1032,7 @@ class Etcd3Transaction():
         self._revision = revision
         self._get_queries = {}
         self._list_queries = {}
+        self._manifests = {}
         self._updates = {}
         self._committed = False
         self._loop = False
@@ -0,0 +1,381 @@
+"""
+Bounded-memory output capture for processes started by deployments.
+
+Output of every stream gets read by a single background thread, which
+waits on all pipes at once using a selector. Lines get collected in a
+ring buffer bounded by size in bytes. Optionally, lines dropping out of
+the ring can be spilled to a (rotating) memory-mapped temporary file,
+so that a longer history can be kept outside of the Python heap.
+"""
+
+import os
+import time
+import mmap
+import logging
+import tempfile
+import threading
+import selectors
+from collections import deque
+from itertools import islice
+
+LOG = logging.getLogger(__name__)
+
+#: Appended to lines that got cut to fit into a ring buffer
+TRUNCATED = b'[truncated]\n'
+
+
+class SpillFile():
+    """Rotating memory-mapped file for older output lines.
+
+    Consists of two equally sized segments. Once the current segment
+    is full, writing switches to the other one, discarding its
+    previous contents. Therefore between half and all of the given
+    size worth of most recent lines is available.
+
+    :param max_bytes: Total size of the spill file
+    :param directory: Directory to create the file in (default is the
+        system's temporary directory)
+    """
+
+    def __init__(self, max_bytes, directory=None):
+        """Create spill file."""
+        self._segment_size = max(1, max_bytes // 2)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.truncate(2 * self._segment_size)
+        self._map = mmap.mmap(self._file.fileno(), 2 * self._segment_size)
+        self._fill = [0, 0]
+        self._current = 0
+
+    def write(self, line):
+        """Append a line."""
+        # Overly long lines get cut, only keeping their end
+        line = line[-self._segment_size:]
+        if self._fill[self._current] + len(line) > self._segment_size:
+            self._current = 1 - self._current
+            self._fill[self._current] = 0
+        offset = self._current * self._segment_size + \
+            self._fill[self._current]
+        self._map[offset:offset+len(line)] = line
+        self._fill[self._current] += len(line)
+
+    def tail(self, count):
+        """Get up to the given number of last lines.
+
+        Only touches as much data as the returned lines need.
+        """
+        lines = []
+        for segment in (self._current, 1 - self._current):
+            start = segment * self._segment_size
+            end = start + self._fill[segment]
+            while end > start and len(lines) < count:
+                newline = self._map.rfind(b'\n', start, end-1)
+                line_start = start if newline < 0 else newline + 1
+                lines.append(self._map[line_start:end])
+                end = line_start
+        lines.reverse()
+        return lines
+
+    def close(self):
+        """Release the file."""
+        self._map.close()
+        self._file.close()
+
+
+class StreamRing():
+    """Byte-bounded ring buffer of output lines of one stream.
+
+    Lines get numbered consecutively in the order they were received,
+    which allows readers to follow the stream incrementally (see
+    :meth:`read`). Lines longer than the ring get cut, ending in
+    :data:`TRUNCATED`.
+
+    :param max_bytes: Maximum number of bytes of lines to keep
+    :param spill: Optional :class:`SpillFile` to move lines into
+       once they drop out of the ring
+    """
+
+    def __init__(self, max_bytes, spill=None):
+        """Create ring buffer."""
+        self._max_bytes = max_bytes
+        self._spill = spill
+        self._lines = deque()
+        self._times = deque()  # Time each line was received
+        self._first = 0  # Sequence number of first line in ring
+        self._size = 0
+        # Chunks of incomplete last line, at most max_bytes + 1 bytes
+        self._partial = []
+        self._partial_size = 0
+        self._cond = threading.Condition()
+        self._closed = threading.Event()
+
+    def feed(self, data):
+        """Add raw output data, splitting it into lines."""
+        lines = data.split(b'\n')
+        rest = lines.pop()
+        if lines and self._partial:
+            self._add_partial(lines[0])
+            lines[0] = self._take_partial()
+        self._add_partial(rest)
+        if not lines:
+            return
+        now = time.time()
+        with self._cond:
+            for line in lines:
+                self._append(self._truncate(line + b'\n'), now)
+            self._cond.notify_all()
+
+    def _add_partial(self, chunk):
+        # Only keep enough to tell that the line needs cutting
+        chunk = chunk[:self._max_bytes + 1 - self._partial_size]
+        if chunk:
+            self._partial.append(chunk)
+            self._partial_size += len(chunk)
+
+    def _take_partial(self):
+        line = b''.join(self._partial)
+        self._partial = []
+        self._partial_size = 0
+        return line
+
+    def _truncate(self, line):
+        """Cut line to fit into the ring, marking that it was cut."""
+        if len(line) <= self._max_bytes:
+            return line
+        return line[:max(0, self._max_bytes - len(TRUNCATED))] + TRUNCATED
+
+    def _append(self, line, now):
+        self._lines.append(line)
+        self._times.append(now)
+        self._size += len(line)
+        while self._size > self._max_bytes and len(self._lines) > 1:
+            old = self._lines.popleft()
+            self._times.popleft()
+            self._first += 1
+            self._size -= len(old)
+            if self._spill is not None:
+                self._spill.write(old)
+
+    def close(self):
+        """Mark end of stream, flushing an incomplete last line."""
+        with self._cond:
+            if self._partial:
+                self._append(self._truncate(self._take_partial()),
+                             time.time())
+            self._closed.set()
+            self._cond.notify_all()
+
+    def wait_closed(self, timeout=None):
+        """Wait for the end of the stream.
+
+        :returns: Whether the stream was closed
+        """
+        return self._closed.wait(timeout)
+
+    def tail(self, count):
+        """Get up to the given number of last lines.
+
+        Takes time proportional to the number of lines returned.
+        """
+        with self._cond:
+            lines = list(islice(reversed(self._lines), count))
+            lines.reverse()
+            if len(lines) < count and self._spill is not None:
+                lines = self._spill.tail(count - len(lines)) + lines
+        return lines
+
+    def position(self, since=None):
+        """Get sequence number to start reading from.
+
+        :param since: Time (as returned by `time.time`) of oldest line
+           to include. Default is to only include lines received from
+           now on.
+        :returns: Sequence number to pass to :meth:`read`
+        """
+        with self._cond:
+            end = self._first + len(self._lines)
+            if since is None:
+                return end
+            # Search from the end, as followers usually want recent lines
+            for count, received in enumerate(reversed(self._times)):
+                if received < since:
+                    return end - count
+            return self._first
+
+    def read(self, seq, max_lines=None, timeout=None):
+        """Read lines starting at a sequence number.
+
+        Waits for lines to become available. Lines that already dropped
+        out of the ring get skipped. Takes time proportional to the
+        number of lines returned.
+
+        :param seq: Sequence number of first line to read
+        :param max_lines: Maximum number of lines to return
+        :param timeout: Maximum time to wait for lines, in seconds
+        :returns: Tuple of lines and sequence number to continue
+           reading from. Lines is `None` once the end of the stream
+           has been reached.
+        """
+        with self._cond:
+            end = self._first + len(self._lines)
+            while seq >= end and not self._closed.is_set():
+                if not self._cond.wait(timeout):
+                    return [], seq
+                end = self._first + len(self._lines)
+            if seq >= end:
+                return None, seq
+            seq = max(seq, self._first)
+            count = end - seq
+            if max_lines is not None and max_lines < count:
+                count = max_lines
+            lines = list(islice(reversed(self._lines), end - seq))
+            lines.reverse()
+            return lines[:count], seq + count
+
+    def release(self):
+        """Release resources held (spill file)."""
+        with self._cond:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+
+class SelectorThread():
+    """Background thread waiting on many file descriptors at once.
+
+    Callbacks are called from the thread whenever a registered file
+    descriptor becomes readable. Where there is nothing to wait on,
+    the thread can also periodically call polling functions.
+
+    A callback or polling function raising an exception gets logged
+    and removed, so it can not affect any other file descriptor.
+    """
+
+    #: Interval for calling polling functions, in seconds
+    POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        """Create selector thread (started on first registration)."""
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+        self._thread = None
+        self._polls = []
+
+    def register(self, fd, callback):
+        """Call `callback(fd)` whenever the file descriptor is readable.
+
+        :param fd: File descriptor (or object with `fileno`)
+        :param callback: Function to call
+        """
+        with self._lock:
+            self._pending.append((fd, callback))
+            self._ensure_started()
+        os.write(self._wake_write, b'\0')
+
+    def unregister(self, fd):
+        """Stop waiting on file descriptor. Only call from callbacks."""
+        self._selector.unregister(fd)
+
+    def add_poll(self, poll):
+        """Call `poll()` periodically until it returns True.
+
+        :param poll: Function to call
+        """
+        with self._lock:
+            self._polls.append(poll)
+            self._ensure_started()
+        os.write(self._wake_write, b'\0')
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="selector", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                timeout = self.POLL_INTERVAL if self._polls else None
+            events = self._selector.select(timeout)
+            with self._lock:
+                polls = list(self._polls)
+            for poll in polls:
+                try:
+                    done = poll()
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception("Polling function %r failed", poll)
+                    done = True
+                if done:
+                    with self._lock:
+                        self._polls.remove(poll)
+            for key, _ in events:
+                if key.fd == self._wake_read:
+                    self._register_pending()
+                    continue
+                try:
+                    key.data(key.fileobj)
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception("Callback for file descriptor %s failed",
+                                  key.fd)
+                    try:
+                        self._selector.unregister(key.fileobj)
+                    except (KeyError, ValueError):
+                        pass  # Already unregistered by the callback
+
+    def _register_pending(self):
+        try:
+            os.read(self._wake_read, 4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for fd, callback in pending:
+            try:
+                self._selector.register(fd, selectors.EVENT_READ, callback)
+            except (KeyError, ValueError, OSError):
+                LOG.exception("Could not wait on file descriptor %s", fd)
+
+
+_SELECTOR = None
+_SELECTOR_LOCK = threading.Lock()
+
+
+def selector_thread():
+    """Get the shared selector thread of this process."""
+    global _SELECTOR  # pylint: disable=global-statement
+    with _SELECTOR_LOCK:
+        if _SELECTOR is None:
+            _SELECTOR = SelectorThread()
+        return _SELECTOR
+
+
+def capture(pipe, ring):
+    """Read all output from a pipe into a ring buffer.
+
+    Reads are non-blocking and happen in the shared selector thread.
+    The pipe gets closed once the end of the stream is reached.
+
+    :param pipe: Pipe to read from (such as `Popen.stdout`)
+    :param ring: :class:`StreamRing` to write to
+    """
+    fd = pipe.fileno()
+    os.set_blocking(fd, False)
+
+    def on_readable(_fd):
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            ring.feed(data)
+            return
+        selector_thread().unregister(fd)
+        pipe.close()
+        ring.close()
+
+    selector_thread().register(fd, on_readable)
@@ -9,14 +9,23 @@ Usage:
   sdpcfg [options] edit <path>
   sdpcfg [options] process <workflow> [<parameters>]
   sdpcfg [options] deploy <type> <name> <parameters>
+  sdpcfg [options] logs [-f] [--since <seconds>] [--stderr] <name>
   sdpcfg --help
 
 Options:
   -q, --quiet          Cut back on unneccesary output
   --prefix <prefix>    Path prefix for high-level API
+  --serializable       Allow any database member to answer reads,
+                       possibly returning stale data (get/ls/watch only)
+  -f, --follow         Keep streaming new log lines as they appear
+  --since <seconds>    When following logs, start with lines of the
+                       given number of past seconds (default only
+                       new lines)
+  --stderr             Show standard error instead of standard output
+                       (process deployments only)
 
 Environment Variables:
-  SDP_CONFIG_BACKEND   Database backend (default etcd3)
+  SDP_CONFIG_BACKEND   Database backend: etcd3 or memory (default etcd3)
   SDP_CONFIG_HOST      Database host address (default 127.0.0.1)
   SDP_CONFIG_PORT      Database port (default 2379)
   SDP_CONFIG_PROTOCOL  Database access protocol (default http)
@@ -30,6 +39,7 @@ Environment Variables:
 import os
 import sys
 import re
+import time
 import tempfile
 import json
 import subprocess
@@ -147,6 +157,40 @@ def cmd_deploy(txn, typ, deploy_id, parameters):
     txn.create_deployment(entity.Deployment(deploy_id, typ, dct))
 
 
+def cmd_logs(cfg, deploy_id, args):
+    """Show (and possibly follow) logs of a deployment."""
+    for txn in cfg.txn(serializable=args['--serializable']):
+        dpl = txn.get_deployment(deploy_id)
+    if dpl is None:
+        print("Deployment {} does not exist!".format(deploy_id),
+              file=sys.stderr)
+        sys.exit(1)
+    since = None
+    if args['--since'] is not None:
+        since = time.time() - float(args['--since'])
+    stream = 'stderr' if args['--stderr'] else 'stdout'
+
+    # Logs are only available for pods and for processes started by
+    # this process (so never for process deployments here)
+    out = sys.stdout.buffer
+    try:
+        if args['--follow']:
+            for line in cfg.follow_deployment_logs(dpl, since, stream):
+                out.write(line)
+                out.flush()
+            return
+        logs = cfg.get_deployment_logs(dpl, stream=stream)
+    except ValueError as exc:
+        print("Cannot show logs of {} deployment {}: {}".format(
+            dpl.type, deploy_id, exc), file=sys.stderr)
+        sys.exit(1)
+    if isinstance(logs, str):
+        logs = [logs.encode()]
+    for line in logs:
+        out.write(line)
+    out.flush()
+
+
 def main(argv):
     """Command line interface implementation."""
     args = docopt.docopt(__doc__, argv=argv)
@@ -198,8 +242,18 @@ def cmd(args, path, value, workflow, parameters):
     import ska_sdp_config
     prefix = ('' if args['--prefix'] is None else args['--prefix'])
     cfg = ska_sdp_config.Config(global_prefix=prefix)
+    if args['logs']:
+        try:
+            cmd_logs(cfg, args['<name>'], args)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cfg.close()
+        return
+    read_only = args['ls'] or args['list'] or args['get'] or args['watch']
+    serializable = args['--serializable'] and read_only
     try:
-        for txn in cfg.txn():
+        for txn in cfg.txn(serializable=serializable):
             if args['ls'] or args['list']:
                 cmd_list(txn, path, args)
             elif args['watch'] or args['get']:
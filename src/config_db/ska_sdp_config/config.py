@@ -2,19 +2,28 @@
 
 import os
 import sys
-import functools
+import time
 from datetime import date
 import json
+import logging
+import queue as queue_m
 from socket import gethostname
+from concurrent.futures import Future, CancelledError
 
-from . import backend as backend_mod, entity, deploy
+from . import backend as backend_mod, entity, deploy, feed, hooks, memory
+
+LOG = logging.getLogger(__name__)
+
+#: Interval for checking cancellation of :meth:`Config.wait_for`, in seconds
+WAIT_CANCEL_INTERVAL = 0.1
 
 
 class Config():
     """Connection to SKA SDP configuration."""
 
+    # pylint: disable=too-many-arguments
     def __init__(self, backend=None, global_prefix='', owner=None,
-                 **cargs):
+                 serializable=False, side_effect_workers=0, **cargs):
         """
         Connect to configuration using the given backend.
 
@@ -23,6 +32,13 @@ class Config():
         :param global_prefix: Prefix to use within the database
         :param owner: Dictionary used for identifying the process when claiming
             ownership.
+        :param serializable: Use serializable reads for transactions by
+            default, see :meth:`txn`. Useful for monitoring clients.
+        :param side_effect_workers: Maximum number of side effects of
+            committed transactions (such as applying deployments) to
+            run concurrently in the background. If zero (default), they
+            get run synchronously as part of the commit, and failures
+            get raised from it.
         :param cargs: Backend client arguments
         """
         # Determine backend
@@ -44,6 +60,9 @@ class Config():
                 cargs['password'] = os.getenv('SDP_CONFIG_PASSWORD', None)
 
             self._backend = backend_mod.Etcd3(**cargs)
+        elif backend == 'memory':
+            self._backend = backend_mod.Etcd3(
+                client=memory.MemoryClient(), **cargs)
         else:
             raise ValueError(
                 "Unknown configuration backend {}!".format(backend))
@@ -56,15 +75,24 @@ class Config():
                 'command': sys.argv
             }
         self.owner = dict(owner)
+        self.serializable = serializable
 
         # Prefixes
         assert global_prefix == '' or global_prefix[0] == '/'
+        self.global_prefix = global_prefix
         self.pb_path = global_prefix+"/pb/"
         self.deploy_path = global_prefix+"/deploy/"
+        self.deploy_by_pb_path = global_prefix+"/index/deploy-by-pb/"
+        self.pb_by_sbi_path = global_prefix+"/index/pb-by-sbi/"
+        self.controller_path = global_prefix+"/controller/"
 
         # Lease associated with client
         self._client_lease = None
 
+        # Executor for side effects
+        self._side_effect_workers = side_effect_workers
+        self._commit_hooks = None
+
     def lease(self, ttl=10):
         """
         Generate a new lease.
@@ -91,7 +119,7 @@ class Config():
 
         return self._client_lease
 
-    def txn(self, max_retries=64):
+    def txn(self, max_retries=64, serializable=None):
         """Create a :class:`Transaction` for atomic configuration query/change.
 
         As we do not use locks, transactions might have to be repeated in
@@ -110,14 +138,253 @@ class Config():
         application must make sure that the loop body has no other
         observable side effects.
 
+        Serializable transactions can be answered by any member of
+        the database cluster instead of just the leader, which means
+        lower latency and less load on the leader. However, they might
+        read a slightly stale (yet consistent) snapshot. This is fine
+        for monitoring, but as commit validation can not account for
+        it, serializable transactions are read-only: attempting to
+        write raises a :class:`RuntimeError`.
+
         :param max_retries: Number of transaction retries before a
             :class:`RuntimeError` gets raised.
+        :param serializable: Use serializable reads. Default is the
+            setting passed to the constructor.
         """
+        if serializable is None:
+            serializable = self.serializable
         return TransactionFactory(
-            self, self._backend.txn(max_retries=max_retries))
+            self, self._backend.txn(max_retries=max_retries,
+                                    serializable=serializable))
+
+    def watch_processing_blocks(self, prefix="", snapshot=True):
+        """Create a change feed for processing blocks.
+
+        Yields :class:`feed.Added`, :class:`feed.Changed` and
+        :class:`feed.Removed` events for processing blocks, as well as
+        :class:`feed.StateChanged` and :class:`feed.OwnerChanged`
+        events for their state and owner. Can be iterated either
+        directly or using ``async for``:
+
+        .. code-block:: python
+
+            for event in config.watch_processing_blocks():
+                if isinstance(event, feed.Added):
+                    print("New processing block", event.obj)
+
+        :param prefix: If given, only follow processing block IDs
+           with the given prefix
+        :param snapshot: Start with events for processing blocks that
+           already exist
+        :returns: :class:`feed.ChangeFeed` object
+        """
+        return feed.ChangeFeed(
+            self._backend, self.pb_path, entity.ProcessingBlock,
+            {'state': feed.StateChanged, 'owner': feed.OwnerChanged},
+            prefix, snapshot, child_fields=('state',))
+
+    def watch_deployments(self, prefix="", snapshot=True):
+        """Create a change feed for deployments.
+
+        Yields :class:`feed.Added`, :class:`feed.Changed` and
+        :class:`feed.Removed` events for deployments.
+
+        :param prefix: If given, only follow deployment IDs with the
+           given prefix
+        :param snapshot: Start with events for deployments that
+           already exist
+        :returns: :class:`feed.ChangeFeed` object
+        """
+        return feed.ChangeFeed(
+            self._backend, self.deploy_path, entity.Deployment, {},
+            prefix, snapshot)
+
+    def wait_for(self, path, predicate=None, timeout=None, cancel=None):
+        """Wait for a configuration value to satisfy a condition.
+
+        Reads the value, then watches its key and re-reads it only
+        when it changes, until the predicate returns true:
+
+        .. code-block:: python
+
+            status, _ = config.wait_for(
+                '/deploy/{}/status'.format(deploy_id),
+                lambda status: (status or {}).get('phase') == 'ready',
+                timeout=60)
+
+        :param path: Path of key relative to the global prefix, such
+            as ``/deploy/[deploy_id]/status``. The value is decoded
+            from JSON.
+        :param predicate: Condition on the value. Default is for the
+            key to exist.
+        :param timeout: Maximum time to wait, in seconds
+        :param cancel: :class:`threading.Event` which stops waiting
+            when set
+        :raises TimeoutError: If the timeout was reached
+        :raises concurrent.futures.CancelledError: If cancelled
+        :returns: (value, revision) of the matching value
+        """
+        path = self.global_prefix + path
+
+        def read(txn):
+            txt = txn.raw.get(path)
+            return None if txt is None else json.loads(txt)
+
+        return self._wait_for([(path, False)], read, predicate, timeout,
+                              cancel)
+
+    def wait_for_processing_block_state(self, pb_id, predicate=None,
+                                        timeout=None, cancel=None):
+        """Wait for a processing block state to satisfy a condition.
+
+        See :meth:`wait_for`. Fields of the state stored in sub-keys
+        are merged in (see
+        :meth:`Transaction.get_processing_block_state`), and get
+        watched as well.
+
+        :param pb_id: Processing block ID
+        :param predicate: Condition on the state. Default is for the
+            state to exist.
+        :param timeout: Maximum time to wait, in seconds
+        :param cancel: :class:`threading.Event` which stops waiting
+            when set
+        :raises TimeoutError: If the timeout was reached
+        :raises concurrent.futures.CancelledError: If cancelled
+        :returns: (state, revision) of the matching state
+        """
+        path = self.pb_path + pb_id + "/state"
+        return self._wait_for(
+            [(path, False), (path + "/", True)],
+            lambda txn: txn.get_processing_block_state(pb_id),
+            predicate, timeout, cancel)
+
+    def wait_for_deployment_status(self, deploy_id, predicate=None,
+                                   timeout=None, cancel=None):
+        """Wait for a deployment status to satisfy a condition.
+
+        See :meth:`wait_for`.
+
+        :param deploy_id: Deployment ID
+        :param predicate: Condition on the status. Default is for the
+            status to exist.
+        :param timeout: Maximum time to wait, in seconds
+        :param cancel: :class:`threading.Event` which stops waiting
+            when set
+        :raises TimeoutError: If the timeout was reached
+        :raises concurrent.futures.CancelledError: If cancelled
+        :returns: (status, revision) of the matching status
+        """
+        return self._wait_for(
+            [(self.deploy_path + deploy_id + "/status", False)],
+            lambda txn: txn.get_deployment_status(deploy_id),
+            predicate, timeout, cancel)
+
+    # pylint: disable=too-many-arguments
+    def _wait_for(self, watches, read, predicate, timeout, cancel):
+        """Wait for a value to satisfy a condition, using watches.
+
+        Watchers start right after the revision of the first read, so
+        no change can get missed in between.
+
+        :param watches: List of (path, prefix) to watch
+        :param read: Function reading the value using a transaction
+        :param predicate: Condition on the value (default: not None)
+        :param timeout: Maximum time to wait, in seconds
+        :param cancel: Event which stops waiting when set
+        :returns: (value, revision) of the matching value
+        """
+        if predicate is None:
+            predicate = _is_not_none
+        deadline = None if timeout is None else time.time() + timeout
+        watch_queue = queue_m.Queue()
+        watchers = []
+        try:
+            while True:
+                for txn in self.txn():
+                    value = read(txn)
+                    revision = txn.raw.revision
+                if predicate(value):
+                    return value, revision
+
+                # Start watching after the first read
+                if not watchers:
+                    start_rev = backend_mod.Etcd3Revision(
+                        revision.revision + 1, None)
+                    for path, prefix in watches:
+                        watcher = self._backend.watch(
+                            path, prefix=prefix, revision=start_rev)
+                        watcher.start(watch_queue)
+                        watchers.append(watcher)
+
+                # Wait for a change, then discard further notifications,
+                # as the next read covers them
+                self._wait_for_change(watch_queue, deadline, cancel)
+                while not watch_queue.empty():
+                    watch_queue.get_nowait()
+        finally:
+            for watcher in watchers:
+                watcher.stop()
+
+    @staticmethod
+    def _wait_for_change(watch_queue, deadline, cancel):
+        """Block until a watcher reports a change."""
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError("Waiting was cancelled")
+            wait = None if cancel is None else WAIT_CANCEL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Timeout waiting for configuration")
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                watch_queue.get(timeout=wait)
+                return
+            except queue_m.Empty:
+                pass
+
+    @property
+    def commit_hooks(self):
+        """Executor for asynchronous side effects of transactions.
+
+        :returns: :class:`hooks.CommitHookExecutor`, or None if side
+           effects get run synchronously
+        """
+        if self._commit_hooks is None and self._side_effect_workers > 0:
+            self._commit_hooks = hooks.CommitHookExecutor(
+                self._side_effect_workers)
+        return self._commit_hooks
+
+    def _report_side_effect_failure(self, dpls, action, exc):
+        """Record failure of a deployment side effect in its status.
+
+        Failures to undo only get logged, as the status got deleted
+        together with the deployment.
+        """
+        if action != 'apply':
+            LOG.error("Failed to %s deployments %s: %s", action,
+                      ", ".join(dpl.deploy_id for dpl in dpls), exc)
+            return
+        for txn in self.txn():
+            for dpl in dpls:
+                # Deployment might have been deleted meanwhile
+                if txn.get_deployment(dpl.deploy_id) is None:
+                    continue
+                txn.patch_deployment_status(dpl.deploy_id, {
+                    'phase': 'failed',
+                    'last_error': "Failed to {} deployment: {}".format(
+                        action, exc),
+                    'last_error_time': time.time()
+                })
 
     def close(self):
-        """Close the client connection."""
+        """Close the client connection.
+
+        Waits for pending side effects of transactions to finish.
+        """
+        if self._commit_hooks is not None:
+            self._commit_hooks.shutdown()
+            self._commit_hooks = None
         if self._client_lease:
             self._client_lease.__exit__(None, None, None)
             self._client_lease = None
@@ -134,7 +401,7 @@ class Config():
 
     # pylint: disable=R0201
     def get_deployment_logs(self, dpl: entity.Deployment,
-                            max_lines: int = 500):
+                            max_lines: int = 500, stream: str = 'stdout'):
         """
         Retrieve logs (stdout) produced by a deployment.
 
@@ -144,9 +411,61 @@ class Config():
 
         :param dpl: Deployment to query for logs
         :param max_lines: Maximum number of lines to return (log tail)
+        :param stream: Stream to return, 'stdout' or 'stderr'
         :returns: A list of the last log lines
         """
-        return deploy.get_deployment_logs(dpl, max_lines)
+        return deploy.get_deployment_logs(dpl, max_lines, stream)
+
+    # pylint: disable=R0201
+    def follow_deployment_logs(self, dpl: entity.Deployment,
+                               since: float = None, stream: str = 'stdout',
+                               timeout: float = None):
+        """
+        Stream logs produced by a deployment as they appear.
+
+        Same restrictions as :meth:`get_deployment_logs` apply.
+
+        :param dpl: Deployment to follow logs of
+        :param since: Time (as returned by `time.time`) of oldest log
+            lines to return. Default is to only return new lines.
+        :param stream: Stream to return, 'stdout' or 'stderr'
+        :param timeout: Stop if no new line appeared for this long
+        :returns: Generator of log lines
+        """
+        return deploy.follow_deployment_logs(dpl, since, stream, timeout)
+
+    # pylint: disable=R0201
+    def follow_deployment_logs_async(self, dpl: entity.Deployment,
+                                     since: float = None,
+                                     stream: str = 'stdout',
+                                     timeout: float = None):
+        """
+        Stream logs produced by a deployment, as an async generator.
+
+        See :meth:`follow_deployment_logs`.
+
+        :param dpl: Deployment to follow logs of
+        :param since: Time (as returned by `time.time`) of oldest log
+            lines to return. Default is to only return new lines.
+        :param stream: Stream to return, 'stdout' or 'stderr'
+        :param timeout: Stop if no new line appeared for this long
+        :returns: Async generator of log lines
+        """
+        return deploy.follow_deployment_logs_async(
+            dpl, since, stream, timeout)
+
+    # pylint: disable=R0201
+    def get_deployment_process_info(self, dpl: entity.Deployment):
+        """
+        Retrieve exit status and timing of a process deployment.
+
+        Only available to the process that spawned the deployment.
+
+        :param dpl: Process deployment to query
+        :returns: Dictionary with keys 'pid', 'returncode', 'started',
+            'terminated', 'killed', 'exited' and 'runtime'
+        """
+        return deploy.get_process_info(dpl)
 
 
 class TransactionFactory():
@@ -179,6 +498,44 @@ def dict_to_json(obj):
         indent=2, separators=(',', ': '), sort_keys=True)
 
 
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386) to a JSON value.
+
+    Objects in the patch get merged recursively into the target,
+    `None` (JSON `null`) removes the corresponding entry, and all
+    other values replace the target value. Neither argument gets
+    modified.
+
+    :param target: Value to patch, or None if it does not exist
+    :param patch: Patch to apply
+    :returns: Patched value
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, dict):
+        result = dict(target)
+    else:
+        result = {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def _is_not_none(value):
+    """Check that a value is not None."""
+    return value is not None
+
+
+def _value_to_json(value):
+    """Format an arbitrary JSON value for writing it into the database."""
+    if isinstance(value, dict):
+        return dict_to_json(value)
+    return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+
 class Transaction():
     """High-level configuration queries and updates to execute atomically."""
 
@@ -188,6 +545,11 @@ class Transaction():
         self._txn = txn
         self._pb_path = config.pb_path
         self._deploy_path = config.deploy_path
+        self._deploy_by_pb_path = config.deploy_by_pb_path
+        self._pb_by_sbi_path = config.pb_by_sbi_path
+        self._controller_path = config.controller_path
+        self._undo_deployments = None
+        self._undo_future = None
 
     @property
     def raw(self):
@@ -209,6 +571,62 @@ class Transaction():
         """Set a existing path in the database to a JSON object."""
         self._txn.update(path, dict_to_json(obj))
 
+    def _list_index(self, path):
+        """List entries of an index with a single ranged read."""
+        keys = self._txn.list_keys(path)
+        assert all([key.startswith(path) for key in keys])
+        return list([key[len(path):] for key in keys])
+
+    def _on_commit_async(self, dpls, action, function):
+        """Run side effect of deployment changes once committed.
+
+        Side effects run synchronously, unless the configuration
+        has an executor for running them in the background (see
+        :attr:`Config.commit_hooks`), ordered per deployment ID.
+        Failures get recorded in the deployment status.
+
+        :param dpls: List of deployments concerned. Might still get
+           extended before commit.
+        :param action: Description of action for error messages
+        :param function: Function to call with list of deployments
+        :returns: Future for the side effect result
+        """
+        result = Future()
+
+        def run(dpls):
+            try:
+                return function(dpls)
+            except Exception as exc:
+                # Record before completing, so that waiting on the
+                # future is enough to observe the failure status
+                # pylint: disable=protected-access
+                self._cfg._report_side_effect_failure(dpls, action, exc)
+                raise
+
+        def chain(inner):
+            exc = inner.exception()
+            if exc is None:
+                result.set_result(inner.result())
+            else:
+                result.set_exception(exc)
+
+        def on_commit():
+            executor = self._cfg.commit_hooks
+            if executor is None:
+                # Run synchronously, raising failures from the commit
+                try:
+                    result.set_result(run(dpls))
+                except Exception as exc:
+                    result.set_exception(exc)
+                    raise
+            else:
+                inner = executor.submit(
+                    [dpl.deploy_id for dpl in dpls], run, dpls)
+                inner.add_done_callback(chain)
+
+        self._txn.on_commit(on_commit)
+        return result
+
     def loop(self, wait=False, timeout=None):
         """Repeat transaction regardless of whether commit succeeds.
 
@@ -275,6 +693,41 @@ class Transaction():
         assert isinstance(pb, entity.ProcessingBlock)
         self._create(self._pb_path + pb.pb_id, pb.to_dict())
 
+        # Maintain index of processing blocks by scheduling block instance
+        if pb.sbi_id is not None:
+            self._create(self._pb_by_sbi_path + pb.sbi_id + "/" + pb.pb_id,
+                         {})
+
+    def delete_processing_block(self, pb_id: str):
+        """
+        Remove a :class:`ProcessingBlock` from the configuration.
+
+        This removes all data associated with the processing block,
+        including its state and owner. Deployments are not removed.
+
+        :param pb_id: Processing block ID to remove
+        """
+        pb_path = self._pb_path + pb_id
+        dct = self._get(pb_path)
+        if dct is not None:
+            self._txn.delete(pb_path)
+        for key in self._txn.list_keys(pb_path + "/", recurse=4):
+            self._txn.delete(key)
+
+        # Update index
+        if dct is not None and dct.get('sbi_id') is not None:
+            self._txn.delete(self._pb_by_sbi_path + dct['sbi_id'] + "/" +
+                             pb_id, must_exist=False)
+
+    def list_processing_blocks_for_sbi(self, sbi_id: str):
+        """
+        Query processing blocks associated with a scheduling block instance.
+
+        :param sbi_id: Scheduling block instance ID
+        :returns: Processing block ids, in lexographical order
+        """
+        return self._list_index(self._pb_by_sbi_path + sbi_id + "/")
+
     def update_processing_block(self, pb: entity.ProcessingBlock):
         """
         Update a :class:`ProcessingBlock` in the configuration.
@@ -342,14 +795,150 @@ class Transaction():
 
         return None
 
+    def register_controller_replica(self, controller: str, replica: str,
+                                    lease):
+        """
+        Register a replica of a controller, for as long as a lease lives.
+
+        :param controller: Name of controller (e.g. processing_controller)
+        :param replica: Replica ID, unique for the controller
+        :param lease: Lease to hold registration with
+        :raises: backend.Collision
+        """
+        assert lease is not None
+        path = self._controller_path + controller + "/replica/" + replica
+        self._create(path, self._cfg.owner, lease)
+
+    def list_controller_replicas(self, controller: str):
+        """
+        List live replicas of a controller.
+
+        :param controller: Name of controller
+        :returns: List of replica IDs
+        """
+        return sorted(self._list_index(
+            self._controller_path + controller + "/replica/"))
+
+    def _shard_path(self, controller: str, shard: int):
+        return self._controller_path + controller + \
+            "/shard/{:04d}".format(shard)
+
+    def get_shard_owner(self, controller: str, shard: int) -> str:
+        """
+        Look up the replica owning a shard of a controller.
+
+        Reading the owner in a transaction makes its commit depend on
+        ownership not changing meanwhile, which can be used for fencing.
+
+        :param controller: Name of controller
+        :param shard: Shard index
+        :returns: Replica ID, or None if not claimed
+        """
+        dct = self._get(self._shard_path(controller, shard))
+        if dct is None:
+            return None
+        return dct['replica']
+
+    def list_shard_owners(self, controller: str) -> dict:
+        """
+        Get owners of all claimed shards of a controller.
+
+        :param controller: Name of controller
+        :returns: Dictionary mapping shard index to replica ID
+        """
+        path = self._controller_path + controller + "/shard/"
+        return {int(shard): self.get_shard_owner(controller, int(shard))
+                for shard in self._list_index(path)}
+
+    def claim_shard(self, controller: str, shard: int, replica: str, lease):
+        """
+        Take ownership of a shard, for as long as a lease lives.
+
+        :param controller: Name of controller
+        :param shard: Shard index
+        :param replica: Replica ID taking ownership
+        :param lease: Lease to hold ownership with
+        :raises: backend.Collision
+        """
+        assert lease is not None
+        dct = dict(self._cfg.owner)
+        dct['replica'] = replica
+        self._create(self._shard_path(controller, shard), dct, lease)
+
+    def release_shard(self, controller: str, shard: int):
+        """
+        Give up ownership of a shard.
+
+        :param controller: Name of controller
+        :param shard: Shard index
+        """
+        self._txn.delete(self._shard_path(controller, shard),
+                         must_exist=False)
+
+    def get_controller_leader(self, controller: str) -> dict:
+        """
+        Look up the leader of a controller.
+
+        Reading the leader in a transaction makes its commit depend on
+        leadership not changing meanwhile, which can be used for fencing.
+
+        :param controller: Name of controller
+        :returns: Leader information (including the replica ID), or
+            None if there is no leader
+        """
+        return self._get(self._controller_path + controller + "/leader")
+
+    def claim_controller_leader(self, controller: str, replica: str, lease,
+                                info: dict = None):
+        """
+        Become leader of a controller, for as long as a lease lives.
+
+        :param controller: Name of controller
+        :param replica: Replica ID becoming leader
+        :param lease: Lease to hold leadership with
+        :param info: Additional information to record
+        :raises: backend.Collision
+        """
+        assert lease is not None
+        dct = dict(self._cfg.owner)
+        dct.update(info or {})
+        dct['replica'] = replica
+        self._create(self._controller_path + controller + "/leader", dct,
+                     lease)
+
+    def release_controller_leader(self, controller: str):
+        """
+        Give up leadership of a controller.
+
+        :param controller: Name of controller
+        """
+        self._txn.delete(self._controller_path + controller + "/leader",
+                         must_exist=False)
+
+    def _list_state_fields(self, pb_id: str):
+        """List processing block state fields stored in sub-keys."""
+        path = self._pb_path + pb_id + "/state/"
+        return {key[len(path):]: key for key in self._txn.list_keys(path)}
+
     def get_processing_block_state(self, pb_id: str) -> dict:
         """
         Get the current processing block state.
 
+        Fields stored in their own sub-keys (see
+        :meth:`patch_processing_block_state`) are merged into the
+        returned dictionary.
+
         :param pb_id: Processing block ID
         :returns: Processing block state, or None if not present
         """
         state = self._get(self._pb_path + pb_id + "/state")
+        for field, path in self._list_state_fields(pb_id).items():
+            txt = self._txn.get(path)
+            if txt is None:
+                continue
+            if state is None:
+                state = {}
+            state[field] = json.loads(txt)
         if state is None:
             return None
         return state
@@ -367,21 +956,140 @@ class Transaction():
         """
         Update processing block state.
 
+        This replaces the entire state. Fields stored in sub-keys stay
+        there, and only get written if they changed (or deleted if
+        missing from `state`). Prefer
+        :meth:`patch_processing_block_state` where possible, as it
+        does not need to read fields it does not change.
+
         :param pb_id: Processing block ID
         :param state: Processing block state to update
         """
-        self._update(self._pb_path + pb_id + "/state", state)
+        sub_keys = self._list_state_fields(pb_id)
+        self._update(self._pb_path + pb_id + "/state", {
+            field: value for field, value in state.items()
+            if field not in sub_keys})
+        for field, path in sub_keys.items():
+            if field not in state:
+                self._txn.delete(path, must_exist=False)
+                continue
+            txt = self._txn.get(path)
+            if txt is None:
+                self._txn.create(path, _value_to_json(state[field]))
+            elif json.loads(txt) != state[field]:
+                self._txn.update(path, _value_to_json(state[field]))
+
+    def patch_processing_block_state(self, pb_id: str, patch: dict,
+                                     fields=()):
+        """
+        Patch processing block state.
+
+        Applies a JSON merge patch (RFC 7386, see :func:`merge_patch`)
+        to the state, so only the given fields get changed. If the
+        state does not exist yet, it gets created.
+
+        Top-level fields named in `fields` get stored in their own
+        sub-keys (``/pb/[pb_id]/state/[field]``). Fields that are
+        already stored that way will continue to be. This means that
+        patches to such a field neither read nor write the rest of
+        the state, so concurrent writers of different fields do not
+        conflict with each other. Only moving a field into its
+        sub-key touches the rest of the state, removing the field
+        from it.
+
+        :param pb_id: Processing block ID
+        :param patch: Merge patch to apply
+        :param fields: Top-level fields to store in sub-keys
+        """
+        assert isinstance(patch, dict)
+        state_path = self._pb_path + pb_id + "/state"
+        sub_keys = self._list_state_fields(pb_id)
+
+        # Fields to move into sub-keys need to get removed from the
+        # state document, and patched starting from the value there
+        state = None
+        main_patch = {}
+        moving = [field for field in patch
+                  if field in fields and field not in sub_keys]
+        if moving:
+            state = self._get(state_path)
+            for field in moving:
+                if state is not None and field in state:
+                    main_patch[field] = None
+
+        # Patch fields stored in sub-keys individually
+        for field, value in patch.items():
+            if field not in sub_keys and field not in fields:
+                main_patch[field] = value
+                continue
+            path = state_path + "/" + field
+            if field in moving:
+                txt = None
+                old = None if state is None else state.get(field)
+            else:
+                txt = self._txn.get(path)
+                old = None if txt is None else json.loads(txt)
+            new = merge_patch(old, value)
+            if new is None:
+                self._txn.delete(path, must_exist=False)
+            elif txt is None:
+                self._txn.create(path, _value_to_json(new))
+            elif new != old:
+                self._txn.update(path, _value_to_json(new))
+
+        # Patch the rest of the state document
+        if not main_patch:
+            return
+        if state is None:
+            state = self._get(state_path)
+        new_state = merge_patch(state, main_patch)
+        if state is None:
+            self._create(state_path, new_state)
+        elif new_state != state:
+            self._update(state_path, new_state)
 
     def get_deployment(self, deploy_id: str) -> entity.Deployment:
         """
         Retrieve details about a cluster configuration change.
 
+        Note that before version 0.0.6, this raised an exception for
+        deployments that do not exist.
+
         :param deploy_id: Name of the deployment
-        :returns: Deployment details
+        :returns: Deployment details, or None if it doesn't exist
         """
         dct = self._get(self._deploy_path + deploy_id)
+        if dct is None:
+            return None
         return entity.Deployment(**dct)
 
+    def get_deployment_status(self, deploy_id: str) -> dict:
+        """
+        Get the status of a deployment.
+
+        :param deploy_id: Deployment ID
+        :returns: Deployment status, or None if not present
+        """
+        return self._get(self._deploy_path + deploy_id + "/status")
+
+    def patch_deployment_status(self, deploy_id: str, patch: dict):
+        """
+        Patch the status of a deployment.
+
+        Applies a JSON merge patch (see :func:`merge_patch`), creating
+        the status if it does not exist yet.
+
+        :param deploy_id: Deployment ID
+        :param patch: Merge patch to apply
+        """
+        path = self._deploy_path + deploy_id + "/status"
+        status = self._get(path)
+        new_status = merge_patch(status, patch)
+        if status is None:
+            self._create(path, new_status)
+        elif new_status != status:
+            self._update(path, new_status)
+
     def list_deployments(self, prefix=""):
         """
         List all current deployments.
@@ -395,32 +1103,116 @@ class Transaction():
         assert all([key.startswith(self._deploy_path) for key in keys])
         return list([key[len(self._deploy_path):] for key in keys])
 
+    def list_deployments_for_pb(self, pb_id: str):
+        """
+        List deployments belonging to a processing block.
+
+        :param pb_id: Processing block ID
+        :returns: Deployment IDs, in lexographical order
+        """
+        return self._list_index(self._deploy_by_pb_path + pb_id + "/")
+
+    def list_deployments_by_pb(self):
+        """
+        List deployments for all processing blocks.
+
+        Only covers deployments that were created with an associated
+        processing block. Note that processing blocks might no longer
+        exist.
+
+        :returns: Dictionary mapping processing block IDs to lists of
+           deployment IDs
+        """
+        index_path = self._deploy_by_pb_path
+        keys = self._txn.list_keys(index_path, recurse=(1,))
+        assert all([key.startswith(index_path) for key in keys])
+        result = {}
+        for key in keys:
+            pb_id, deploy_id = key[len(index_path):].split('/')
+            result.setdefault(pb_id, []).append(deploy_id)
+        return result
+
+    def index_deployment(self, deploy_id: str, pb_id: str):
+        """
+        Associate an existing deployment with a processing block.
+
+        Records the processing block ID in the deployment and adds it
+        to the index. Meant for migrating deployments created before
+        deployments recorded the processing block they belong to.
+
+        :param deploy_id: Deployment ID
+        :param pb_id: Processing block ID
+        :raises: ValueError if the deployment does not exist, or
+           belongs to a different processing block
+        """
+        deploy_path = self._deploy_path + deploy_id
+        dct = self._get(deploy_path)
+        if dct is None:
+            raise ValueError("Deployment {} does not exist!".format(
+                deploy_id))
+        if dct.get('pb_id') == pb_id:
+            return
+        if dct.get('pb_id') is not None:
+            raise ValueError(
+                "Deployment {} already belongs to processing block {}!"
+                "".format(deploy_id, dct['pb_id']))
+        dct['pb_id'] = pb_id
+        self._update(deploy_path, dct)
+        self._create(self._deploy_by_pb_path + pb_id + "/" + deploy_id, {})
+
     def create_deployment(self, dpl: entity.Deployment):
         """
         Request a change to cluster configuration.
 
         :param dpl: Deployment to add to database
+        :returns: Future for applying the deployment. Completes once
+           the transaction was committed and the deployment applied.
         """
         # Add to database
         assert isinstance(dpl, entity.Deployment)
         self._create(self._deploy_path + dpl.deploy_id,
                      dpl.to_dict())
 
+        # Maintain index of deployments by processing block
+        if dpl.pb_id is not None:
+            self._create(self._deploy_by_pb_path + dpl.pb_id + "/" +
+                         dpl.deploy_id, {})
+
         # Apply deployment on successful deployment (this should
         # eventually be done by a separate controller process!)
-        self._txn.on_commit(functools.partial(deploy.apply_deployment, dpl))
+        return self._on_commit_async(
+            [dpl], 'apply', lambda dpls: deploy.apply_deployment(dpls[0]))
 
     def delete_deployment(self, dpl: entity.Deployment):
         """
         Undo a change to cluster configuration.
 
         :param dpl: Deployment to remove
+        :returns: Future for undoing the deployment. Completes once
+           the transaction was committed and all deployments removed
+           by it are undone.
         """
         # Delete all data associated with deployment
         deploy_path = self._deploy_path + dpl.deploy_id
-        for key in self._txn.list_keys(deploy_path, recurse=5):
+        dct = self._get(deploy_path)
+        if dct is not None:
+            self._txn.delete(deploy_path)
+        for key in self._txn.list_keys(deploy_path + "/", recurse=4):
             self._txn.delete(key)
 
-        # Apply deployment on successful deployment (this should
-        # eventually be done by a separate controller process!)
-        self._txn.on_commit(functools.partial(deploy.undo_deployment, dpl))
+        # Update index. Use the stored processing block ID, if available.
+        pb_id = dpl.pb_id if dct is None else dct.get('pb_id')
+        if pb_id is not None:
+            self._txn.delete(self._deploy_by_pb_path + pb_id + "/" +
+                             dpl.deploy_id, must_exist=False)
+
+        # Undo deployment on successful commit (this should
+        # eventually be done by a separate controller process!). All
+        # deployments deleted by the transaction get undone together,
+        # so processes get terminated in parallel.
+        if self._undo_deployments is None:
+            self._undo_deployments = []
+            self._undo_future = self._on_commit_async(
+                self._undo_deployments, 'undo', deploy.undo_deployments)
+        self._undo_deployments.append(dpl)
+        return self._undo_future
@@ -5,20 +5,129 @@ This is temporary - clearly the configuration database back-end should
 not handle creating containers and processes itself.
 """
 
+import os
 import subprocess
 import time
+import math
 import re
-import tempfile
-import json
-import threading
 import queue
+import asyncio
+import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 import kubernetes
 from .entity import Deployment
+from . import capture
 
-# Map of deployment ID to spawned subprocesses
+# Map of deployment ID to spawned (supervised) subprocesses
 _SUBPROCESS = {}
-_MAX_HISTORY = 500
+# Subprocesses of undone deployments, kept so that their logs and
+# process information remain available for a while (oldest first)
+_UNDONE = collections.OrderedDict()
+# Guards the two above, as deployments get applied and undone by
+# executor threads
+_PROCESS_LOCK = threading.Lock()
+# Number of undone subprocesses to keep
+_KEEP_UNDONE = int(os.getenv('SDP_CONFIG_KEEP_UNDONE', '16'))
+# Bytes of output to keep in memory per stream
+_MAX_LOG_BYTES = int(os.getenv('SDP_CONFIG_LOG_BYTES', str(1024 * 1024)))
+# Bytes of older output to spill to disk per stream (zero to disable)
+_LOG_SPILL_BYTES = int(os.getenv('SDP_CONFIG_LOG_SPILL_BYTES', '0'))
+# Time processes get to exit after SIGTERM before getting SIGKILL
+_TERMINATE_GRACE = 10.0
+# Shared Kubernetes API client, created on first use
+_KUBE_CLIENT = None
+_KUBE_CLIENT_LOCK = threading.Lock()
+# Maximum number of Kubernetes objects to create/delete in parallel
+_KUBE_PARALLEL = 8
+# Order to create Kubernetes objects in by kind, so that objects get
+# created after those they might depend on (same as Helm). Objects of
+# other kinds get created last.
+_KUBE_CREATE_ORDER = [
+    'Namespace', 'NetworkPolicy', 'ResourceQuota', 'LimitRange',
+    'PodSecurityPolicy', 'PodDisruptionBudget', 'ServiceAccount', 'Secret',
+    'ConfigMap', 'StorageClass', 'PersistentVolume',
+    'PersistentVolumeClaim', 'CustomResourceDefinition', 'ClusterRole',
+    'ClusterRoleBinding', 'Role', 'RoleBinding', 'Service', 'DaemonSet',
+    'Pod', 'ReplicationController', 'ReplicaSet', 'Deployment',
+    'HorizontalPodAutoscaler', 'StatefulSet', 'Job', 'CronJob', 'Ingress',
+    'APIService',
+]
+# Lines of followed Kubernetes logs to buffer before applying backpressure
+_FOLLOW_BUFFER_LINES = 1000
+
+
+class _Process():
+    """Subprocess supervised by the shared selector thread.
+
+    Exit is detected using a pidfd where supported, otherwise the
+    selector thread polls the process periodically.
+    """
+
+    def __init__(self, proc, rings):
+        """Start supervising the process."""
+        self.proc = proc
+        self.rings = rings
+        self.started = time.time()
+        self.terminated = None
+        self.killed = None
+        self.exited = None
+        self._exit = threading.Event()
+
+        selector = capture.selector_thread()
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            selector.add_poll(self._poll)
+        else:
+            def on_exit(_fd):
+                if self._poll():
+                    selector.unregister(pidfd)
+                    os.close(pidfd)
+            selector.register(pidfd, on_exit)
+
+    def _poll(self):
+        """Check whether process has exited (and reap it)."""
+        if self.proc.poll() is None:
+            return False
+        if self.exited is None:
+            self.exited = time.time()
+        self._exit.set()
+        return True
+
+    def terminate(self):
+        """Send SIGTERM, unless the process has already exited."""
+        if not self._exit.is_set() and self.proc.poll() is None:
+            self.terminated = time.time()
+            self.proc.terminate()
+
+    def kill(self):
+        """Send SIGKILL, unless the process has already exited."""
+        if not self._exit.is_set() and self.proc.poll() is None:
+            self.killed = time.time()
+            self.proc.kill()
+
+    def wait(self, timeout=None):
+        """Wait for process to exit.
+
+        :returns: Whether the process has exited
+        """
+        return self._exit.wait(timeout)
+
+    def info(self):
+        """Get status and timing information about the process."""
+        return {
+            'pid': self.proc.pid,
+            'returncode': self.proc.returncode if self._exit.is_set()
+                          else None,
+            'started': self.started,
+            'terminated': self.terminated,
+            'killed': self.killed,
+            'exited': self.exited,
+            'runtime': (self.exited or time.time()) - self.started,
+        }
 
 
 def apply_deployment(dpl: Deployment):
@@ -35,42 +144,21 @@ def apply_deployment(dpl: Deployment):
             stderr=subprocess.PIPE,
             **dpl.args)
 
-        # Spawn thread to watch stdout
-        stdout_queue = queue.Queue(maxsize=_MAX_HISTORY)
-
-        def stdout_thread():
-            for line in proc.stdout:
-                try:
-                    stdout_queue.put_nowait(line)
-                except queue.Full:
-                    stdout_queue.get_nowait()
-                    stdout_queue.put_nowait(line)
-
-        stdout_thread = threading.Thread(target=stdout_thread)
-        stdout_thread.start()
+        # Capture both stdout and stderr, so neither pipe can fill up
+        rings = {}
+        for name, pipe in [('stdout', proc.stdout), ('stderr', proc.stderr)]:
+            spill = None
+            if _LOG_SPILL_BYTES > 0:
+                spill = capture.SpillFile(_LOG_SPILL_BYTES)
+            rings[name] = capture.StreamRing(_MAX_LOG_BYTES, spill)
+            capture.capture(pipe, rings[name])
 
         # Remember
-        _SUBPROCESS[dpl.deploy_id] = (proc, stdout_queue)
+        with _PROCESS_LOCK:
+            _SUBPROCESS[dpl.deploy_id] = _Process(proc, rings)
 
     elif dpl.type == 'kubernetes-direct':
-
-        # Create client using either kube.conf or from environment
-        # variables (which is appropriate for running in-cluster)
-        try:
-            kubernetes.config.load_incluster_config()
-        except kubernetes.config.ConfigException:
-            kubernetes.config.load_kube_config()
-
-        # Create from dictionary
-        client = kubernetes.client.ApiClient()
-
-        # Write to file (with the next version of the Kubernetes
-        # bindings we will be able to use create_from_json here)
-        with tempfile.NamedTemporaryFile("w") as temp:
-            json.dump(dpl.args, temp)
-            temp.flush()
-            kubernetes.utils.create_from_yaml(client, temp.name)
-        del client
+        _kube_apply(dpl.args, 'create')
 
     elif dpl.type == 'helm':
         pass  # Handled by operator
@@ -80,6 +168,74 @@ def apply_deployment(dpl: Deployment):
             dpl.type))
 
 
+def _get_process(dpl: Deployment):
+    with _PROCESS_LOCK:
+        proc = _SUBPROCESS.get(dpl.deploy_id)
+        if proc is None:
+            proc = _UNDONE.get(dpl.deploy_id)
+    if proc is not None:
+        return proc
+    raise ValueError(
+        ("Deployment {} was not created by this " +
+         "process!").format(dpl.deploy_id))
+
+
+def _forget_process(dpl: Deployment):
+    """Release resources of the process of an undone deployment.
+
+    Spill files get closed straight away, in-memory output is kept
+    until more than `_KEEP_UNDONE` further deployments got undone.
+    """
+    with _PROCESS_LOCK:
+        proc = _SUBPROCESS.pop(dpl.deploy_id, None)
+        if proc is None:
+            return
+        _UNDONE.pop(dpl.deploy_id, None)
+        _UNDONE[dpl.deploy_id] = proc
+        while len(_UNDONE) > _KEEP_UNDONE:
+            _UNDONE.popitem(last=False)
+    for ring in proc.rings.values():
+        ring.release()
+
+
+def undo_deployments(dpls, grace: float = None):
+    """
+    Remove software processes/pods specified by many deployments.
+
+    Processes get terminated in parallel: all get sent SIGTERM at
+    once, and any that have not exited once the shared grace period is
+    over get sent SIGKILL together.
+
+    :param dpls: List of deployments
+    :param grace: Time to give processes to exit before killing them
+    """
+    if grace is None:
+        grace = _TERMINATE_GRACE
+    procs = [_get_process(dpl) for dpl in dpls
+             if dpl.type == 'process-direct']
+    for proc in procs:
+        proc.terminate()
+    deadline = time.time() + grace
+    for proc in procs:
+        proc.wait(max(0, deadline - time.time()))
+    for proc in procs:
+        proc.kill()
+
+    # Wait to finish, give capture a chance to read remaining output
+    for proc in procs:
+        proc.wait()
+    deadline = time.time() + 1
+    for proc in procs:
+        for ring in proc.rings.values():
+            ring.wait_closed(max(0, deadline - time.time()))
+
+    for dpl in dpls:
+        if dpl.type == 'process-direct':
+            _forget_process(dpl)
+        else:
+            undo_deployment(dpl)
+
+
 def undo_deployment(dpl: Deployment):
     """
     Remove software processes/pods specified.
@@ -87,41 +243,10 @@ def undo_deployment(dpl: Deployment):
     :param dpl: Deployment details
     """
     if dpl.type == 'process-direct':
-        if dpl.deploy_id not in _SUBPROCESS:
-            raise ValueError(
-                ("Deployment {} was not created by this " +
-                 "process!").format(dpl.deploy_id))
-
-        # Get subprocess, send SIGTERM
-        proc = _SUBPROCESS[dpl.deploy_id][0]
-        proc.poll()
-        if proc.returncode is None:
-            proc.terminate()
-
-            # Wait for it to finish
-            counter = 100
-            while proc.returncode is None and counter > 0:
-                time.sleep(0.1)
-                proc.poll()
-                counter -= 1
-            # Eventually send SIGKILL
-            if not proc.poll():
-                proc.kill()
-
-        # Wait to finish
-        proc.wait()
+        undo_deployments([dpl])
 
     elif dpl.type == 'kubernetes-direct':
-        data = dpl.args
-
-        # Loosely adapted from create_from_dict
-        client = kubernetes.client.ApiClient()
-        if data["kind"] == "List":
-            for obj in data["items"]:
-                _undo_kube_deployment(client, obj)
-        else:
-            _undo_kube_deployment(client, data)
-        del client
+        _kube_apply(dpl.args, 'delete')
 
     elif dpl.type == 'helm':
         pass  # Handled by operator
@@ -131,12 +256,46 @@ def undo_deployment(dpl: Deployment):
             dpl.type))
 
 
-def _undo_kube_deployment(k8s_client, yml_object):
-
+def _kube_client():
+    """Get the shared Kubernetes API client, creating it if needed."""
+    global _KUBE_CLIENT  # pylint: disable=global-statement
+    with _KUBE_CLIENT_LOCK:
+        if _KUBE_CLIENT is None:
+
+            # Configure using either environment variables (which is
+            # appropriate for running in-cluster) or kube.conf
+            configuration = kubernetes.client.Configuration()
+            try:
+                kubernetes.config.load_incluster_config(
+                    client_configuration=configuration)
+            except kubernetes.config.ConfigException:
+                kubernetes.config.load_kube_config(
+                    config_file=os.getenv('KUBECONFIG'),
+                    client_configuration=configuration)
+            _KUBE_CLIENT = kubernetes.client.ApiClient(configuration)
+        return _KUBE_CLIENT
+
+
+def _reset_kube_client():
+    """Drop the shared Kubernetes client (e.g. after config changes)."""
+    global _KUBE_CLIENT  # pylint: disable=global-statement
+    with _KUBE_CLIENT_LOCK:
+        _KUBE_CLIENT = None
+    _kube_api.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _kube_api(api_version, kind):
+    """Look up the API object and method suffix for an object type.
+
+    :param api_version: API version of object, e.g. "apps/v1"
+    :param kind: Object kind, e.g. "StatefulSet"
+    :returns: (API object, snake-case kind)
+    """
     # ## Code determining API version + kind extracted from
     # ## kubernetes.utils.create_from_yaml.create_from_yaml_single_item
 
-    group, _, version = yml_object["apiVersion"].partition("/")
+    group, _, version = api_version.partition("/")
     if version == "":
         version = group
         group = "core"
@@ -148,40 +307,110 @@ def _undo_kube_deployment(k8s_client, yml_object):
     group = "".join(word.capitalize() for word in group.split('.'))
     fcn_to_call = "{0}{1}Api".format(group, version.capitalize())
     # pylint: disable=E1102
-    k8s_api = getattr(kubernetes.client, fcn_to_call)(k8s_client)
+    k8s_api = getattr(kubernetes.client, fcn_to_call)(_kube_client())
     # Replace CamelCased action_type into snake_case
-    kind = yml_object["kind"]
     kind = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', kind)
     kind = re.sub('([a-z0-9])([A-Z])', r'\1_\2', kind).lower()
 
     # ## Copied end
 
-    metadata = yml_object['metadata']
-    if hasattr(k8s_api, "delete_namespaced_{0}".format(kind)):
-        return getattr(k8s_api, "delete_namespaced_{0}".format(kind))(
-            metadata['name'], metadata.get('namespace'))
-    return getattr(k8s_api, "delete_{0}")(metadata['name'])
+    return k8s_api, kind
+
+
+def _kube_apply_single(obj, action):
+    """Create or delete a single Kubernetes object."""
+    k8s_api, kind = _kube_api(obj["apiVersion"], obj["kind"])
+    metadata = obj['metadata']
+    namespaced = hasattr(k8s_api, "{}_namespaced_{}".format(action, kind))
+    if action == 'create':
+        if namespaced:
+            return getattr(k8s_api, "create_namespaced_" + kind)(
+                body=obj, namespace=metadata.get('namespace', 'default'))
+        return getattr(k8s_api, "create_" + kind)(body=obj)
+    if namespaced:
+        return getattr(k8s_api, "delete_namespaced_" + kind)(
+            metadata['name'], metadata.get('namespace', 'default'))
+    return getattr(k8s_api, "delete_" + kind)(metadata['name'])
+
+
+def _kube_apply(data, action):
+    """Create or delete Kubernetes objects given as a dictionary.
+
+    Items of a `List` get created kind by kind (see
+    `_KUBE_CREATE_ORDER`), with objects of the same kind created in
+    parallel. Deletion happens in parallel for all items. As with
+    `kubernetes.utils.create_from_dict`, API failures on creation get
+    collected into a `kubernetes.utils.FailToCreateError`.
+
+    :param data: Object, or list of objects
+    :param action: Either 'create' or 'delete'
+    """
+    def apply_single(obj):
+        try:
+            _kube_apply_single(obj, action)
+            return None
+        except kubernetes.client.rest.ApiException as exc:
+            return exc
+
+    def apply_parallel(items):
+        if len(items) <= 1:
+            return [apply_single(obj) for obj in items]
+        with ThreadPoolExecutor(min(_KUBE_PARALLEL, len(items))) as pool:
+            return list(pool.map(apply_single, items))
+
+    items = data["items"] if data["kind"] == "List" else [data]
+    if action == 'create':
+        stages = {}
+        for obj in items:
+            kind = obj.get('kind')
+            order = (_KUBE_CREATE_ORDER.index(kind)
+                     if kind in _KUBE_CREATE_ORDER
+                     else len(_KUBE_CREATE_ORDER))
+            stages.setdefault(order, []).append(obj)
+        results = []
+        for order in sorted(stages):
+            results.extend(apply_parallel(stages[order]))
+    else:
+        results = apply_parallel(items)
+    api_exceptions = [exc for exc in results if exc is not None]
+    if api_exceptions:
+        if action == 'create':
+            raise kubernetes.utils.FailToCreateError(api_exceptions)
+        raise api_exceptions[0]
+
+
+def get_process_info(dpl: Deployment):
+    """
+    Query status of the process started by a deployment.
+
+    Only supported for process deployments created by this process.
+
+    :param dpl: Deployment details
+    :returns: Dictionary with process ID, return code (None if still
+        running), and the times (as returned by `time.time`) when the
+        process was started, sent SIGTERM and SIGKILL and exited
+        (None if not applicable), as well as its run time in seconds.
+    """
+    if dpl.type != 'process-direct':
+        raise ValueError("Unsupported deployment type {}!".format(
+            dpl.type))
+    return _get_process(dpl).info()
 
 
-def get_deployment_logs(dpl: Deployment, max_lines: int = 500):
+def get_deployment_logs(dpl: Deployment, max_lines: int = 500,
+                        stream: str = 'stdout'):
     """
     Query logs associated with a deployment.
 
     :param dpl: Deployment details
     :param max_lines: Maximum number of lines to return (log tail)
+    :param stream: Stream to return, 'stdout' or 'stderr'. Only
+        supported for process deployments.
     """
     if dpl.type == 'process-direct':
 
-        if dpl.deploy_id not in _SUBPROCESS:
-            raise ValueError(
-                ("Deployment {} was not created by this " +
-                 "process!").format(dpl.deploy_id))
-
         # Retrieve lines
-        lines = list(_SUBPROCESS[dpl.deploy_id][1].queue)
-        if len(lines) > max_lines:
-            lines = lines[-max_lines:]
-        return lines
+        return _get_process(dpl).rings[stream].tail(max_lines)
 
     if dpl.type == 'kubernetes-direct':
 
@@ -189,17 +418,187 @@ def get_deployment_logs(dpl: Deployment, max_lines: int = 500):
         if dpl.args.get('kind') != 'Pod':
             raise ValueError("Can only retrieve logs from pod deployments!")
 
-        # Make client
-        client = kubernetes.client.ApiClient()
-        api = kubernetes.client.CoreV1Api(client)
-
         # Ask for logs
+        api, _ = _kube_api('v1', 'Pod')
         metadata = dpl.args['metadata']
-        logs = api.read_namespaced_pod_log(
+        return api.read_namespaced_pod_log(
             metadata['name'], metadata.get('namespace', 'default'),
             tail_lines=max_lines)
-        del client
-        return logs
 
     raise ValueError("Unsupported deployment type {}!".format(
         dpl.type))
+
+
+class _RingFollower():
+    """Follows a process output stream in its ring buffer."""
+
+    def __init__(self, ring, since):
+        self._ring = ring
+        self._seq = ring.position(since)
+
+    def read(self, timeout=None):
+        """Get new lines, or None at the end of the stream."""
+        lines, self._seq = self._ring.read(self._seq, timeout=timeout)
+        return lines
+
+    def close(self):
+        """Stop following."""
+
+
+class _KubeLogFollower():
+    """Follows the log stream of a pod.
+
+    A background thread reads the stream into a bounded queue. Once the
+    queue is full the thread stops reading, so a slow consumer causes
+    backpressure on the connection instead of unbounded buffering.
+    """
+
+    _END = object()
+
+    def __init__(self, dpl, since):
+        if dpl.args.get('kind') != 'Pod':
+            raise ValueError("Can only retrieve logs from pod deployments!")
+        api, _ = _kube_api('v1', 'Pod')
+        metadata = dpl.args['metadata']
+        kwargs = {'follow': True, '_preload_content': False}
+        if since is None:
+            kwargs['tail_lines'] = 0
+        else:
+            kwargs['since_seconds'] = max(1, math.ceil(time.time() - since))
+        self._response = api.read_namespaced_pod_log(
+            metadata['name'], metadata.get('namespace', 'default'), **kwargs)
+        self._queue = queue.Queue(_FOLLOW_BUFFER_LINES)
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="follow-" + dpl.deploy_id, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        partial = b''
+        try:
+            for data in self._response.stream(65536, decode_content=True):
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    self._queue.put(line + b'\n')
+                if self._closed:
+                    break
+        except Exception:  # pylint: disable=broad-except
+            # Connection failing or getting closed ends the stream
+            pass
+        finally:
+            if partial and not self._closed:
+                self._queue.put(partial)
+            self._queue.put(self._END)
+
+    def read(self, timeout=None):
+        """Get new lines, or None at the end of the stream."""
+        try:
+            lines = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                lines.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if lines[-1] is self._END:
+            lines.pop()
+            self._queue.put(self._END)
+            return lines or None
+        return lines
+
+    def close(self):
+        """Stop following, releasing the connection."""
+        self._closed = True
+        self._response.close()
+        # Unblock reader thread, if waiting for space
+        deadline = time.time() + 5
+        while self._thread.is_alive() and time.time() < deadline:
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _follower(dpl, since, stream):
+    if dpl.type == 'process-direct':
+        return _RingFollower(_get_process(dpl).rings[stream], since)
+    if dpl.type == 'kubernetes-direct':
+        return _KubeLogFollower(dpl, since)
+    raise ValueError("Unsupported deployment type {}!".format(
+        dpl.type))
+
+
+def follow_deployment_logs(dpl: Deployment, since: float = None,
+                           stream: str = 'stdout', timeout: float = None):
+    """
+    Stream logs associated with a deployment as they get produced.
+
+    Lines get read incrementally as the consumer asks for them. For
+    processes, lines that drop out of the ring buffer before they are
+    read get skipped. For pods, reading from the log stream stops
+    while the consumer falls behind.
+
+    :param dpl: Deployment details
+    :param since: Time (as returned by `time.time`) of oldest log
+        lines to return. Default is to only return new lines.
+    :param stream: Stream to return, 'stdout' or 'stderr'. Only
+        supported for process deployments.
+    :param timeout: Stop if no new line appeared for this long, in
+        seconds
+    :returns: Generator of log lines (bytes). Ends once the process or
+        pod has finished.
+    """
+    follower = _follower(dpl, since, stream)
+    try:
+        while True:
+            lines = follower.read(timeout)
+            if not lines:
+                return
+            for line in lines:
+                yield line
+    finally:
+        follower.close()
+
+
+async def follow_deployment_logs_async(
+        dpl: Deployment, since: float = None, stream: str = 'stdout',
+        timeout: float = None, poll_interval: float = 1.0):
+    """
+    Stream logs associated with a deployment, as an async generator.
+
+    Same as :func:`follow_deployment_logs`. Waiting happens in the
+    default executor of the event loop, in steps of at most
+    `poll_interval` seconds so that cancellation takes effect quickly.
+
+    :param dpl: Deployment details
+    :param since: Time (as returned by `time.time`) of oldest log
+        lines to return. Default is to only return new lines.
+    :param stream: Stream to return, 'stdout' or 'stderr'
+    :param timeout: Stop if no new line appeared for this long, in
+        seconds
+    :param poll_interval: Maximum time to block an executor thread
+    """
+    loop = asyncio.get_event_loop()
+    follower = await loop.run_in_executor(
+        None, _follower, dpl, since, stream)
+    try:
+        waited = 0.0
+        while True:
+            step = poll_interval
+            if timeout is not None:
+                step = min(step, timeout - waited)
+            lines = await loop.run_in_executor(None, follower.read, step)
+            if lines is None:
+                return
+            if not lines:
+                waited += step
+                if timeout is not None and waited >= timeout:
+                    return
+                continue
+            waited = 0.0
+            for line in lines:
+                yield line
+    finally:
+        await loop.run_in_executor(None, follower.close)
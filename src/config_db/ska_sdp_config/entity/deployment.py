@@ -24,7 +24,7 @@ class Deployment:
     """
 
     # pylint: disable=W0102,W0622
-    def __init__(self, deploy_id, type, args):
+    def __init__(self, deploy_id, type, args, pb_id=None):
         """
         Create a new deployment structure.
 
@@ -32,6 +32,8 @@ class Deployment:
         :param type: Type of the deployment (method by which
             it is applied)
         :param args: Type-specific deployment arguments
+        :param pb_id: Processing block ID the deployment belongs to
+            (None if not associated with a processing block)
         :returns: Deployment object
         """
         # Get parameter dictionary
@@ -39,6 +41,7 @@ class Deployment:
             'deploy_id': str(deploy_id),
             'type': str(type),
             'args': dict(copy.deepcopy(args)),
+            'pb_id': None if pb_id is None else str(pb_id),
         }
 
         # Validate
@@ -67,6 +70,11 @@ class Deployment:
         """Return deployment arguments."""
         return self._dict['args']
 
+    @property
+    def pb_id(self):
+        """Processing block ID, if deployment belongs to one."""
+        return self._dict.get('pb_id')
+
     def __repr__(self):
         """Produce object representation."""
         return "entity.Deployment({})".format(
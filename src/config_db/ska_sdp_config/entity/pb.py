@@ -79,6 +79,14 @@ class ProcessingBlock:
         """Workflow-specific scan parameters."""
         return self._dict['scan_parameters']
 
+    @property
+    def dependencies(self):
+        """Processing blocks this one depends on (batch only).
+
+        List of dictionaries with 'pbId' and 'type' keys.
+        """
+        return self._dict.get('dependencies', [])
+
     def __repr__(self):
         """Build string representation."""
         return "ProcessingBlock({})".format(
@@ -0,0 +1,426 @@
+"""
+Incremental change feeds for configuration entities.
+
+A change feed takes a snapshot of all entities of a kind (such as
+processing blocks or deployments), then follows changes using
+database watches starting from the snapshot revision. This means that
+clients can react to changes in time proportional to the number of
+changes, instead of re-reading the whole configuration on every
+wake-up:
+
+.. code-block:: python
+
+    with config.watch_processing_blocks() as feed:
+        for event in feed:
+            if isinstance(event, feed.Added):
+                ...
+
+Feeds can also be consumed from `asyncio` code using ``async with``
+and ``async for`` (but a single feed can not be used both ways).
+"""
+
+import json
+import queue as queue_m
+import asyncio
+from collections import deque
+
+from . import backend as backend_mod
+
+
+class Event():
+    """Base class for change feed events.
+
+    :param entity_id: ID of the entity the event refers to
+    :param revision: Database revision at which the change happened
+    """
+
+    def __init__(self, entity_id, revision):
+        """Instantiate event."""
+        self.id = entity_id  # pylint: disable=invalid-name
+        self.revision = revision
+
+    def __repr__(self):
+        """Build string representation."""
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={}".format(k, repr(v)) for k, v in vars(self).items()))
+
+    def __eq__(self, other):
+        """Equality check."""
+        return type(self) is type(other) and vars(self) == vars(other)
+
+
+class Added(Event):
+    """Entity got added to the configuration."""
+
+    def __init__(self, obj, revision):
+        """Instantiate event.
+
+        :param obj: Entity that got added
+        :param revision: Database revision of the change
+        """
+        super().__init__(_entity_id(obj), revision)
+        self.obj = obj
+
+
+class Changed(Event):
+    """Entity got updated in the configuration."""
+
+    def __init__(self, obj, old, revision):
+        """Instantiate event.
+
+        :param obj: New version of the entity
+        :param old: Previous version of the entity
+        :param revision: Database revision of the change
+        """
+        super().__init__(_entity_id(obj), revision)
+        self.obj = obj
+        self.old = old
+
+
+class Removed(Event):
+    """Entity got removed from the configuration."""
+
+    def __init__(self, entity_id, old, revision):
+        """Instantiate event.
+
+        :param entity_id: ID of the removed entity
+        :param old: Last known version of the entity
+        :param revision: Database revision of the change
+        """
+        super().__init__(entity_id, revision)
+        self.old = old
+
+
+class StateChanged(Event):
+    """State of an entity got created, updated or removed."""
+
+    def __init__(self, entity_id, state, old, revision):
+        """Instantiate event.
+
+        :param entity_id: ID of the entity
+        :param state: New state, or None if it was removed
+        :param old: Previous state, or None if it did not exist
+        :param revision: Database revision of the change
+        """
+        super().__init__(entity_id, revision)
+        self.state = state
+        self.old = old
+
+
+class OwnerChanged(Event):
+    """Owner of an entity got claimed, changed or released."""
+
+    def __init__(self, entity_id, owner, old, revision):
+        """Instantiate event.
+
+        :param entity_id: ID of the entity
+        :param owner: New owner, or None if it was released
+        :param old: Previous owner, or None if it was not claimed
+        :param revision: Database revision of the change
+        """
+        super().__init__(entity_id, revision)
+        self.owner = owner
+        self.old = old
+
+
+def _entity_id(obj):
+    """Determine ID of an entity."""
+    # Deployments refer to a processing block as well
+    if hasattr(obj, 'deploy_id'):
+        return obj.deploy_id
+    return obj.pb_id
+
+
+class _AsyncQueue():
+    """Adapter pushing watcher updates into an asyncio queue."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        """Put item into queue (thread-safe)."""
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+class ChangeFeed():
+    """Typed change feed for one kind of configuration entity.
+
+    Use :meth:`ska_sdp_config.Config.watch_processing_blocks` or
+    :meth:`ska_sdp_config.Config.watch_deployments` to create. The
+    first events returned describe the snapshot of the configuration
+    at the point the feed was started (as :class:`Added`,
+    :class:`StateChanged` and :class:`OwnerChanged` events). After
+    that the feed returns the changes as they arrive, in order of
+    database revision (all keys are followed using a single watch).
+
+    The feed also maintains an up-to-date model of the configuration,
+    see :attr:`entities` and :attr:`children`.
+    """
+
+    Added = Added
+    Changed = Changed
+    Removed = Removed
+    StateChanged = StateChanged
+    OwnerChanged = OwnerChanged
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, backend, path, make_entity, child_events,
+                 prefix='', snapshot=True, child_fields=()):
+        """Instantiate change feed.
+
+        :param backend: Backend to use
+        :param path: Path of entity keys (ending in '/')
+        :param make_entity: Entity class, called with stored dictionary
+        :param child_events: Event class for every entity child key
+            (such as 'state' or 'owner') to follow
+        :param prefix: Only follow entities with IDs with this prefix
+        :param snapshot: Generate events for the initial snapshot?
+        :param child_fields: Child keys that might have fields stored
+            in sub-keys (such as processing block state), which should
+            be merged into the child value
+        """
+        self._backend = backend
+        self._path = path
+        self._prefix = prefix
+        self._make_entity = make_entity
+        self._child_events = dict(child_events)
+        self._snapshot = snapshot
+        self._child_fields = set(child_fields)
+
+        #: Revision up to which the model is up-to-date
+        self.revision = None
+        #: Entities by ID
+        self.entities = {}
+        #: Child values by child name, then entity ID
+        self.children = {name: {} for name in self._child_events}
+
+        self._queue = None
+        self._watcher = None
+        self._snapshot_revision = None
+        self._pending = deque()
+        # Raw child values and fields, by child name, then entity ID
+        self._child_raw = {name: {} for name in self._child_events}
+
+    @property
+    def started(self):
+        """Whether the feed is active."""
+        return self._queue is not None
+
+    def start(self, queue=None):
+        """Start following changes.
+
+        Called automatically when the feed gets iterated or polled.
+
+        :param queue: Queue-like object to receive updates from
+           watchers. Default is a standard thread-safe queue.
+        """
+        if self.started:
+            raise RuntimeError("Change feed was already started!")
+        self._queue = queue_m.Queue() if queue is None else queue
+
+        # Take snapshot. We only need deeper levels if we are
+        # following child keys.
+        depths = (0,)
+        if self._child_events:
+            depths = (0, 1, 2) if self._child_fields else (0, 1)
+        path = self._path + self._prefix
+        values, rev = self._backend.list_values(path, recurse=depths)
+        self.revision = self._snapshot_revision = rev
+        for key, value, key_rev in values:
+            events = self._apply(key, value, key_rev)
+            if self._snapshot:
+                self._pending.extend(events)
+
+        # Watch changes from right after the snapshot. All depths are
+        # covered by one watch, so that changes arrive in revision
+        # order even if they are to different keys.
+        start_rev = backend_mod.Etcd3Revision(rev.revision+1, None)
+        self._watcher = self._backend.watch(
+            path, prefix=True, revision=start_rev,
+            depth=[path.count('/')+depth for depth in depths])
+        self._watcher.start(self._queue)
+
+    def close(self):
+        """Stop following changes."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        self._queue = None
+
+    def __enter__(self):
+        """Scope the change feed."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Scope the change feed."""
+        self.close()
+        return False
+
+    async def __aenter__(self):
+        """Scope the change feed (asynchronous)."""
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Scope the change feed (asynchronous)."""
+        self.close()
+        return False
+
+    def _decode(self, value, make=None):
+        """Decode a stored value, returning None if invalid."""
+        if value is None:
+            return None
+        try:
+            dct = json.loads(value)
+            if make is not None:
+                return make(**dct)
+            return dct
+        except (ValueError, TypeError):
+            return None
+
+    def _apply(self, key, value, rev):
+        """Apply a key change to the model, returning generated events."""
+        # Determine entity ID and child key
+        path_parts = key[len(self._path):].split('/')
+        entity_id = path_parts[0]
+        if len(path_parts) == 1:
+            return self._apply_entity(entity_id, value, rev)
+        if len(path_parts) == 2 and path_parts[1] in self._child_events:
+            return self._apply_child(entity_id, path_parts[1], None,
+                                     value, rev)
+        if len(path_parts) == 3 and path_parts[1] in self._child_fields:
+            return self._apply_child(entity_id, path_parts[1],
+                                     path_parts[2], value, rev)
+        return []
+
+    def _apply_entity(self, entity_id, value, rev):
+        old = self.entities.get(entity_id)
+        obj = self._decode(value, self._make_entity)
+        if obj is None:
+            if old is None:
+                return []
+            del self.entities[entity_id]
+            return [Removed(entity_id, old, rev)]
+        self.entities[entity_id] = obj
+        if old is None:
+            return [Added(obj, rev)]
+        if old == obj:
+            return []
+        return [Changed(obj, old, rev)]
+
+    def _apply_child(self, entity_id, name, field, value, rev):
+        # Update raw value (field None being the child key itself)
+        raw = self._child_raw[name].setdefault(entity_id, {})
+        new_raw = self._decode(value)
+        if new_raw is None:
+            raw.pop(field, None)
+        else:
+            raw[field] = new_raw
+
+        # Determine merged value
+        new = raw.get(None)
+        fields = {fld: val for fld, val in raw.items() if fld is not None}
+        if fields:
+            new = dict(new) if isinstance(new, dict) else {}
+            new.update(fields)
+        if not raw:
+            del self._child_raw[name][entity_id]
+
+        values = self.children[name]
+        old = values.get(entity_id)
+        if new is None:
+            values.pop(entity_id, None)
+        else:
+            values[entity_id] = new
+        if old == new:
+            return []
+        return [self._child_events[name](entity_id, new, old, rev)]
+
+    def _process(self, updates):
+        """Process a batch of watcher updates (in revision order)."""
+        for key, value, rev in updates:
+            # Skip anything the model has already seen. Note that a
+            # transaction can change several keys at one revision.
+            if rev.revision <= self._snapshot_revision.revision or \
+               rev.revision < self.revision.revision:
+                continue
+            self._pending.extend(self._apply(key, value, rev))
+            self.revision = backend_mod.Etcd3Revision(rev.revision, None)
+
+    def poll(self, timeout=None):
+        """Wait for the next batch of events.
+
+        :param timeout: Maximum time to wait in seconds. Wait forever
+           if None.
+        :returns: List of events, empty if timeout was reached
+        """
+        if not self.started:
+            self.start()
+        if isinstance(self._queue, _AsyncQueue):
+            raise RuntimeError("Change feed was started asynchronously!")
+        if self._pending:
+            timeout = 0
+
+        # Wait for first update, then collect whatever else arrived
+        updates = []
+        try:
+            updates.append(self._queue.get(timeout != 0, timeout))
+            while True:
+                updates.append(self._queue.get_nowait())
+        except queue_m.Empty:
+            pass
+        self._process(updates)
+
+        events = list(self._pending)
+        self._pending.clear()
+        return events
+
+    def __iter__(self):
+        """Iterate over events, stopping the feed when done."""
+        try:
+            while True:
+                for event in self.poll():
+                    yield event
+        finally:
+            self.close()
+
+    async def apoll(self, timeout=None):
+        """Wait for the next batch of events (asynchronous).
+
+        :param timeout: Maximum time to wait in seconds. Wait forever
+           if None.
+        :returns: List of events, empty if timeout was reached
+        """
+        if not self.started:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.start, _AsyncQueue(loop))
+        if not isinstance(self._queue, _AsyncQueue):
+            raise RuntimeError("Change feed was started synchronously!")
+        if self._pending:
+            timeout = 0
+
+        updates = []
+        aqueue = self._queue.queue
+        try:
+            if timeout != 0:
+                updates.append(await asyncio.wait_for(aqueue.get(), timeout))
+            while True:
+                updates.append(aqueue.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            pass
+        self._process(updates)
+
+        events = list(self._pending)
+        self._pending.clear()
+        return events
+
+    def __aiter__(self):
+        """Iterate over events asynchronously."""
+        return self
+
+    async def __anext__(self):
+        """Return next event."""
+        while not self._pending:
+            self._pending.extend(await self.apoll())
+        return self._pending.popleft()
@@ -0,0 +1,96 @@
+"""
+Asynchronous execution of transaction side effects.
+
+Side effects registered to run once a transaction commits (such as
+applying a deployment) might take a long time. Running them inside
+the commit would block the transaction loop of the caller, so they
+are instead handed to a :class:`CommitHookExecutor`, which runs them
+on a bounded thread pool.
+
+Side effects are associated with keys (such as deployment IDs). Side
+effects sharing a key get run in the order they were submitted, while
+unrelated side effects can run concurrently. Once the executor got
+shut down, side effects still get run, but synchronously.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class CommitHookExecutor():
+    """Runs side effects asynchronously, ordered per key.
+
+    :param max_workers: Maximum number of side effects to run
+       concurrently
+    """
+
+    def __init__(self, max_workers=4):
+        """Create executor. Threads get started on demand."""
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="commit-hook")
+        self._lock = threading.Lock()
+        self._last = {}  # Last submitted future, by key
+
+    def submit(self, keys, function, *args, **kwargs):
+        """Run a function once all earlier functions for its keys are done.
+
+        :param keys: Keys the function is associated with
+        :param function: Function to call
+        :param args: Positional arguments to pass
+        :param kwargs: Keyword arguments to pass
+        :returns: :class:`concurrent.futures.Future` for the result
+        """
+        future = Future()
+        with self._lock:
+            deps = [self._last[key] for key in keys if key in self._last]
+            for key in keys:
+                self._last[key] = future
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+
+        def done(_future):
+            with self._lock:
+                for key in keys:
+                    if self._last.get(key) is future:
+                        del self._last[key]
+        future.add_done_callback(done)
+
+        # Start once all dependencies are done. Note that callbacks
+        # get called immediately if the future is done already.
+        remaining = [len(deps) + 1]
+
+        def dependency_done(_future=None):
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                self._executor.submit(run)
+            except RuntimeError:
+                # Shut down (possibly by interpreter shutdown)
+                run()
+        for dep in deps:
+            dep.add_done_callback(dependency_done)
+        dependency_done()
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop executor.
+
+        :param wait: Wait for pending side effects to finish
+        """
+        if wait:
+            with self._lock:
+                pending = list(self._last.values())
+            for future in pending:
+                try:
+                    future.result()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+        self._executor.shutdown(wait)
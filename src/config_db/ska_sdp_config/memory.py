@@ -0,0 +1,485 @@
+"""
+In-memory stand-in for an etcd3 server.
+
+Implements the part of the `etcd3` client API used by the etcd3
+backend (ranges, transactions with comparisons, watchers and leases)
+on top of a store held in memory, so the backend runs unchanged
+against it. Select it by setting ``SDP_CONFIG_BACKEND=memory``: all
+clients created by the same process then share one store. This is
+meant for tests and benchmarks running several controllers in one
+process - nothing gets persisted, and leases only end when revoked,
+never by expiring. Like etcd, the store limits the size of requests
+and compacts old history.
+"""
+
+import bisect
+import threading
+import itertools
+
+import etcd3
+
+#: Default maximum size of requests (as etcd's --max-request-bytes)
+MAX_REQUEST_BYTES = 1536 * 1024
+#: Default number of past revisions to keep (see :class:`MemoryStore`)
+HISTORY_REVISIONS = 10000
+
+
+def _prefix_end(key):
+    """Get end of range of keys with the given prefix."""
+    return key[:-1] + bytes([key[-1] + 1])
+
+
+def _to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class _Object:
+    """Response object with attributes."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _KeyValue:
+    """Stored key-value pair."""
+
+    # pylint: disable=too-many-arguments,too-few-public-methods
+    def __init__(self, key, value, create_revision, mod_revision, version,
+                 lease):
+        self.key = key
+        self.value = value
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
+        self.lease = lease
+
+
+class MemoryStore:
+    """Keys and history of an in-memory database.
+
+    Like etcd, the store only keeps a window of history: older revisions
+    get compacted, after which they can no longer be read or watched.
+
+    :param max_request_bytes: Maximum size of keys and values written
+        by one request
+    :param history_revisions: Minimum number of past revisions to keep
+    """
+
+    def __init__(self, max_request_bytes=MAX_REQUEST_BYTES,
+                 history_revisions=HISTORY_REVISIONS):
+        self.max_request_bytes = max_request_bytes
+        self.history_revisions = history_revisions
+        self.lock = threading.RLock()
+        self.revision = 1
+        self.keys = {}
+        # Current keys in order, for range reads
+        self._sorted_keys = []
+        # History of changes as (revision, type, key, key-value)
+        self.history = []
+        #: Oldest revision that can still be read
+        self.compact_revision = 1
+        # Versions of every key in the history as lists of revisions
+        # and key-values (None if deleted), and such keys in order
+        self._versions = {}
+        self._version_keys = []
+        self.watchers = []
+        self.leases = {}
+        self.lease_ids = itertools.count(1)
+
+    def key_range(self, key, range_end):
+        """Get current keys in a range, in order."""
+        keys = self._sorted_keys
+        start = bisect.bisect_left(keys, key)
+        return keys[start:bisect.bisect_left(keys, range_end, start)]
+
+    def history_from(self, revision):
+        """Get changes from a revision on.
+
+        :raises ValueError: If the revision was compacted
+        """
+        if revision < self.compact_revision:
+            raise ValueError("Revision {} has been compacted".format(
+                revision))
+        return self.history[bisect.bisect_left(self.history, (revision,)):]
+
+    def read_range(self, key, prefix=False, revision=None):
+        """Read a key or a range of keys.
+
+        :returns: List of key-values, or None if empty
+        :raises ValueError: If the revision was compacted
+        """
+        if revision is not None and revision < self.revision:
+            return self._read_range_at(key, prefix, revision)
+        if prefix:
+            kvs = [self.keys[k] for k in self.key_range(
+                key, _prefix_end(key))]
+        else:
+            kvs = [self.keys[key]] if key in self.keys else []
+        return kvs or None
+
+    def _read_range_at(self, key, prefix, revision):
+        """Read a key or a range of keys at a past revision."""
+        if revision < self.compact_revision:
+            raise ValueError("Revision {} has been compacted".format(
+                revision))
+        if prefix:
+            keys = self._version_keys
+            start = bisect.bisect_left(keys, key)
+            keys = keys[start:bisect.bisect_left(keys, _prefix_end(key),
+                                                 start)]
+        else:
+            keys = [key] if key in self._versions else []
+        kvs = []
+        for k in keys:
+            revisions, values = self._versions[k]
+            index = bisect.bisect_right(revisions, revision) - 1
+            if index >= 0 and values[index] is not None:
+                kvs.append(values[index])
+        return kvs or None
+
+    def put(self, key, value, lease, revision):
+        """Write a key at the given (new) revision."""
+        old = self.keys.get(key)
+        kv = _KeyValue(key, value,
+                       old.create_revision if old else revision, revision,
+                       old.version + 1 if old else 1, lease)
+        if old is None:
+            bisect.insort(self._sorted_keys, key)
+        self.keys[key] = kv
+        self._record(etcd3.EventType.PUT, key, kv, revision)
+
+    def delete(self, key, revision):
+        """Delete a key at the given (new) revision, if it exists."""
+        if key in self.keys:
+            del self.keys[key]
+            del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+            self._record(etcd3.EventType.DELETE, key, None, revision)
+
+    def _record(self, event_type, key, kv, revision):
+        self.history.append((revision, event_type, key, kv))
+        versions = self._versions.get(key)
+        if versions is None:
+            versions = self._versions[key] = ([], [])
+            bisect.insort(self._version_keys, key)
+        versions[0].append(revision)
+        versions[1].append(kv)
+        for watcher in list(self.watchers):
+            if watcher.matches(key):
+                watcher.fire(event_type, key, kv, revision)
+
+        # Compact once twice the history to keep has accumulated, so
+        # the cost is spread over the writes
+        if revision - self.compact_revision >= 2 * self.history_revisions:
+            self.compact(revision - self.history_revisions)
+
+    def compact(self, revision):
+        """Forget history before a revision.
+
+        :param revision: Oldest revision to keep readable
+        """
+        if revision <= self.compact_revision:
+            return
+        self.compact_revision = revision
+        end = bisect.bisect_left(self.history, (revision,))
+        compacted = {key for _, _, key, _ in self.history[:end]}
+        del self.history[:end]
+
+        # Only keep the last version of every key from before the
+        # revision, forgetting keys deleted by then altogether
+        for key in compacted:
+            revisions, values = self._versions[key]
+            index = bisect.bisect_right(revisions, revision) - 1
+            if index == len(revisions) - 1 and values[index] is None:
+                del self._versions[key]
+                del self._version_keys[
+                    bisect.bisect_left(self._version_keys, key)]
+            elif index > 0:
+                del revisions[:index]
+                del values[:index]
+
+
+_STORE = MemoryStore()
+
+
+class _Compare:
+    """Comparison of a transaction, built using comparison operators."""
+
+    _OPS = {
+        '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b, '>': lambda a, b: a > b,
+    }
+
+    def __init__(self, key, range_end, target):
+        self.key = key
+        self.range_end = range_end
+        self.target = target
+        self.op = None
+        self.value = None
+
+    def _set(self, op, value):
+        self.op = op
+        self.value = value
+        return self
+
+    def __eq__(self, other):
+        return self._set('==', other)
+
+    def __ne__(self, other):
+        return self._set('!=', other)
+
+    def __lt__(self, other):
+        return self._set('<', other)
+
+    def __gt__(self, other):
+        return self._set('>', other)
+
+    __hash__ = None
+
+    def check(self, store):
+        """Check comparison against current key-values."""
+        if self.range_end is None:
+            kvs = [store.keys.get(self.key)]
+        else:
+            kvs = [store.keys[k] for k in store.key_range(
+                self.key, self.range_end)] or [None]
+        for kv in kvs:
+            actual = 0
+            if kv is not None:
+                actual = {'version': kv.version, 'mod': kv.mod_revision,
+                          'create': kv.create_revision}[self.target]
+            if not self._OPS[self.op](actual, self.value):
+                return False
+        return True
+
+
+class _KeyTarget:
+    """Key (or range) to compare in a transaction."""
+
+    def __init__(self, key, range_end):
+        self._key = key
+        self._range_end = range_end
+
+    @property
+    def version(self):
+        """Compare version."""
+        return _Compare(self._key, self._range_end, 'version')
+
+    @property
+    def mod(self):
+        """Compare modification revision."""
+        return _Compare(self._key, self._range_end, 'mod')
+
+    @property
+    def create(self):
+        """Compare creation revision."""
+        return _Compare(self._key, self._range_end, 'create')
+
+
+class _Txn:
+    """Transaction, see `etcd3.Client.Txn`."""
+
+    def __init__(self, store):
+        self._store = store
+        self._compares = []
+        self._ops = []
+
+    def compare(self, compare):
+        """Add comparison."""
+        self._compares.append(compare)
+        return self
+
+    def success(self, op):
+        """Add operation to execute if all comparisons succeed."""
+        self._ops.append(op)
+        return self
+
+    @staticmethod
+    def key(key, prefix=False):
+        """Build key target for comparison."""
+        key = _to_bytes(key)
+        return _KeyTarget(key, _prefix_end(key) if prefix else None)
+
+    @staticmethod
+    def range(key, prefix=False, revision=None, **_kwargs):
+        """Build range operation."""
+        return ('range', _to_bytes(key), prefix, revision)
+
+    @staticmethod
+    def put(key, value, lease=None):
+        """Build put operation."""
+        return ('put', _to_bytes(key), _to_bytes(value), lease)
+
+    @staticmethod
+    def delete(key, value=None, lease=None, prefix=False):
+        """Build delete operation."""
+        # pylint: disable=unused-argument
+        return ('delete', _to_bytes(key), prefix)
+
+    def commit(self):
+        """Execute transaction atomically."""
+        store = self._store
+        size = sum(len(op[1]) + len(op[2] or b'') if op[0] == 'put'
+                   else len(op[1]) for op in self._ops)
+        if size > store.max_request_bytes:
+            raise RuntimeError("etcdserver: request is too large")
+        with store.lock:
+            succeeded = all(compare.check(store)
+                            for compare in self._compares)
+            responses = []
+            if succeeded:
+                if any(op[0] != 'range' for op in self._ops):
+                    store.revision += 1
+                for op in self._ops:
+                    responses.append(self._execute(op, store.revision))
+            return _Object(succeeded=succeeded,
+                           responses=responses or None,
+                           header=_Object(revision=store.revision))
+
+    def _execute(self, op, revision):
+        store = self._store
+        if op[0] == 'range':
+            _, key, prefix, rev = op
+            return _Object(response_range=_Object(
+                kvs=store.read_range(key, prefix, rev)))
+        if op[0] == 'put':
+            _, key, value, lease = op
+            store.put(key, value, lease, revision)
+        else:
+            _, key, prefix = op
+            if prefix:
+                for k in store.key_range(key, _prefix_end(key)):
+                    store.delete(k, revision)
+            else:
+                store.delete(key, revision)
+        return _Object()
+
+
+class _Watcher:
+    """Watcher, see `etcd3.Client.Watcher`."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, store, key, start_revision=None, prefix=False,
+                 range_end=None):
+        self._store = store
+        self._key = _to_bytes(key)
+        self._range_end = _to_bytes(range_end)
+        if prefix:
+            self._range_end = _prefix_end(self._key)
+        self._start_revision = start_revision
+        self._callbacks = []
+
+    def matches(self, key):
+        """Check whether watcher covers a key."""
+        if self._range_end is None:
+            return key == self._key
+        return self._key <= key < self._range_end
+
+    def onEvent(self, callback):  # pylint: disable=invalid-name
+        """Register callback for events."""
+        self._callbacks.append(callback)
+
+    def clear_callbacks(self):
+        """Remove all callbacks."""
+        self._callbacks = []
+
+    def runDaemon(self):  # pylint: disable=invalid-name
+        """Start watching, replaying history from the start revision."""
+        with self._store.lock:
+            if self._start_revision is not None:
+                history = self._store.history_from(self._start_revision)
+                for rev, event_type, key, kv in history:
+                    if self.matches(key):
+                        self.fire(event_type, key, kv, rev)
+            self._store.watchers.append(self)
+
+    def fire(self, event_type, key, kv, revision):
+        """Deliver an event to callbacks."""
+        event = _Object(type=event_type, key=key,
+                        value=None if kv is None else kv.value,
+                        mod_revision=revision)
+        for callback in list(self._callbacks):
+            callback(event)
+
+    def stop(self):
+        """Stop watching."""
+        with self._store.lock:
+            if self in self._store.watchers:
+                self._store.watchers.remove(self)
+
+
+class _Lease:
+    """Lease, see `etcd3.Client.Lease`. Never expires."""
+
+    def __init__(self, store, ttl):
+        self._store = store
+        self.ttl = ttl
+        self.ID = None  # pylint: disable=invalid-name
+
+    def grant(self):
+        """Grant lease."""
+        with self._store.lock:
+            self.ID = next(self._store.lease_ids)
+            self._store.leases[self.ID] = self
+        return self
+
+    def revoke(self):
+        """Revoke lease, deleting all keys associated with it."""
+        store = self._store
+        with store.lock:
+            keys = [key for key, kv in store.keys.items()
+                    if kv.lease == self.ID]
+            if keys:
+                store.revision += 1
+                for key in keys:
+                    store.delete(key, store.revision)
+            store.leases.pop(self.ID, None)
+
+    def alive(self):
+        """Check whether lease was granted and not revoked."""
+        return self.ID in self._store.leases
+
+    def time_to_live(self):
+        """Get remaining time to live."""
+        return self.ttl
+
+    def __enter__(self):
+        return self.grant()
+
+    def __exit__(self, *args):
+        self.revoke()
+
+
+class MemoryClient:
+    """Client for an in-memory store, mimicking `etcd3.Client`.
+
+    :param store: :class:`MemoryStore` to use. By default, all clients
+        of a process share the same store.
+    """
+
+    def __init__(self, store=None):
+        self.store = _STORE if store is None else store
+
+    def Lease(self, ttl=10):  # pylint: disable=invalid-name
+        """Create lease."""
+        return _Lease(self.store, ttl)
+
+    def Txn(self):  # pylint: disable=invalid-name
+        """Create transaction."""
+        return _Txn(self.store)
+
+    def Watcher(self, key, start_revision=None, prefix=False,
+                range_end=None, **_kwargs):  # pylint: disable=invalid-name
+        """Create watcher."""
+        return _Watcher(self.store, key, start_revision, prefix, range_end)
+
+    def range(self, key, revision=None, prefix=False, **_kwargs):
+        """Read a key or a range of keys."""
+        with self.store.lock:
+            return _Object(
+                kvs=self.store.read_range(_to_bytes(key), prefix, revision),
+                header=_Object(revision=self.store.revision))
+
+    def close(self):
+        """Close client (nothing to do)."""
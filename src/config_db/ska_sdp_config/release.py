@@ -3,7 +3,7 @@
 
 NAME = "ska-sdp-config"
 # For version names see: https://www.python.org/dev/peps/pep-0440/
-VERSION = "0.0.5"
+VERSION = "0.0.6"
 VERSION_INFO = VERSION.split(".")
 AUTHOR = "ORCA team, Sim team"
 LICENSE = 'License :: OSI Approved :: BSD License'
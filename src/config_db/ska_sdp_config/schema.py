@@ -0,0 +1,118 @@
+"""
+Registry of compiled JSON schema validators.
+
+Building a validator checks the schema and resolves its validator
+class and format checker, which is expensive compared to validating a
+typical document. Components that validate the same kinds of
+documents repeatedly (such as the subarray device validating
+configuration strings, or the processing controller validating
+workflow definitions) should therefore compile their schemas once and
+keep the validators in a registry:
+
+.. code-block:: python
+
+    schemas = SchemaRegistry('schema')
+    config = schemas.loads('configure', config_str)
+"""
+
+import os
+import json
+
+import jsonschema
+
+
+class SchemaRegistry:
+    """Compiled JSON schema validators, by name.
+
+    :param schema_dir: If given, load and compile all schemas
+        (``*.json`` files) in this directory, named after the file
+        without extension.
+    """
+
+    def __init__(self, schema_dir=None):
+        self._validators = {}
+        # Shared by all validators, so formats get resolved only once
+        self._format_checker = jsonschema.FormatChecker()
+        if schema_dir is not None:
+            self.load_dir(schema_dir)
+
+    def __contains__(self, name):
+        """Check whether a schema is registered."""
+        return name in self._validators
+
+    def __len__(self):
+        """Get number of registered schemas."""
+        return len(self._validators)
+
+    @property
+    def names(self):
+        """Names of registered schemas."""
+        return sorted(self._validators)
+
+    def add(self, name, schema):
+        """Compile a schema and register its validator.
+
+        :param name: Name to register schema as
+        :param schema: Schema (as dict)
+        :raises jsonschema.SchemaError: If the schema is invalid
+        :returns: The validator
+        """
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(
+            schema, format_checker=self._format_checker)
+        self._validators[name] = validator
+        return validator
+
+    def load(self, name, schema_file):
+        """Load a schema from a file, compile and register it.
+
+        :param name: Name to register schema as
+        :param schema_file: Path of schema file
+        :returns: The validator
+        """
+        with open(schema_file, 'r') as file:
+            schema = json.load(file)
+        return self.add(name, schema)
+
+    def load_dir(self, schema_dir):
+        """Load, compile and register all schemas in a directory.
+
+        :param schema_dir: Directory containing ``*.json`` schema files
+        """
+        for filename in sorted(os.listdir(schema_dir)):
+            name, ext = os.path.splitext(filename)
+            if ext == '.json':
+                self.load(name, os.path.join(schema_dir, filename))
+
+    def get(self, name):
+        """Get compiled validator.
+
+        :param name: Name of schema (file name without extension when
+            loaded from a directory)
+        :raises KeyError: If no such schema is registered
+        :returns: Validator
+        """
+        return self._validators[name]
+
+    def validate(self, name, instance):
+        """Validate a document against a schema.
+
+        :param name: Name of schema
+        :param instance: Document to validate (decoded JSON)
+        :raises jsonschema.ValidationError: If validation fails
+        """
+        self._validators[name].validate(instance)
+
+    def loads(self, name, json_str):
+        """Decode a JSON string and validate it against a schema.
+
+        :param name: Name of schema
+        :param json_str: JSON string
+        :raises json.JSONDecodeError: If decoding fails
+        :raises jsonschema.ValidationError: If validation fails
+        :returns: Decoded document
+        """
+        instance = json.loads(json_str)
+        self.validate(name, instance)
+        return instance
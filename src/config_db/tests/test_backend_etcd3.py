@@ -3,10 +3,13 @@
 # pylint: disable=missing-docstring,redefined-outer-name,invalid-name
 
 import os
+import json
 import time
+from unittest import mock
+
 import pytest
 
-from ska_sdp_config import backend
+from ska_sdp_config import backend, memory
 
 PREFIX = "/__test"
 
@@ -133,6 +136,14 @@ def test_list(etcd3):
         key+"/a", key+"/a/d", key+"/a/d/x",
         key+"/ab", key+"/ab/c", key+"/ax"])
 
+    # List with values
+    values, rev = etcd3.list_values(key, recurse=(1, 2))
+    assert [k for k, _, _ in values] == [
+        key+"/a", key+"/a/d", key+"/ab", key+"/ab/c", key+"/ax", key+"/b"]
+    assert all(v == "" for _, v, _ in values)
+    assert all(r.revision == rev.revision for _, _, r in values)
+    assert all(r.mod_revision <= rev.revision for _, _, r in values)
+
     # Remove
     etcd3.delete(key, must_exist=False, recursive=True)
 
@@ -251,6 +262,24 @@ def test_watch(etcd3):
 
     etcd3.delete(key, recursive=True, must_exist=False)
 
+    # Watch several depths at once, getting updates in revision order
+    with etcd3.watch(key+"/", prefix=True, depth=(3, 4)) as watch:
+        time.sleep(0.1)
+
+        etcd3.create(key+"/a/b", "bla")
+        etcd3.create(PREFIX+"/test_watcx/a", "other")
+        etcd3.create(key+"/a", "bla2")
+        etcd3.create(key+"/a/b/c", "too deep")
+        etcd3.update(key+"/a/b", "bla3")
+
+        assert watch.get()[0:2] == (key+"/a/b", 'bla')
+        assert watch.get()[0:2] == (key+"/a", 'bla2')
+        assert watch.get()[0:2] == (key+"/a/b", 'bla3')
+        assert watch.empty()
+
+    etcd3.delete(key, recursive=True, must_exist=False)
+    etcd3.delete(PREFIX+"/test_watcx", recursive=True, must_exist=False)
+
 
 def test_transaction_simple(etcd3):
 
@@ -292,6 +321,149 @@ def test_transaction_simple(etcd3):
     etcd3.delete(key, recursive=True)
 
 
+def chunks(etcd3, key):
+    """Get stored chunks of a value as (key, value, mod revision)."""
+    response = etcd3._client.range(backend._chunk_key(key), prefix=True)
+    # Sort by index, which is at the end of the key
+    return sorted(((kv.key, kv.value, kv.mod_revision)
+                   for kv in response.kvs or []),
+                  key=lambda chunk: chunk[0][-6:])
+
+
+def test_transaction_chunked(etcd3):
+
+    key = PREFIX + "/test_txn_chunked"
+    value = "0123456789" * 3 + "a" + "äöü" * 2
+    etcd3.chunk_size = 10
+    try:
+
+        # Create a value that needs to be chunked
+        for txn in etcd3.txn():
+            txn.create(key, value)
+        assert etcd3.get(key)[0] == value
+        for txn in etcd3.txn():
+            assert txn.get(key) == value
+        assert etcd3.list_keys(PREFIX + "/", recurse=1)[0] == [key]
+        assert etcd3.list_values(PREFIX + "/")[0][0][:2] == (key, value)
+        chunks0 = chunks(etcd3, key)
+        assert len(chunks0) == 5
+        # Characters should not get split across chunks
+        assert chunks0[3][1].decode('utf-8') == "aäöüä"
+
+        # Update last chunk, which should leave the others alone
+        with etcd3.watch(key) as queue:
+            for txn in etcd3.txn():
+                txn.update(key, value[:-1] + "x")
+            assert queue.get(timeout=5)[1] == value[:-1] + "x"
+        assert etcd3.get(key)[0] == value[:-1] + "x"
+        chunks1 = chunks(etcd3, key)
+        assert chunks1[:4] == chunks0[:4]
+        assert len(chunks1) == 5 and chunks1[4] != chunks0[4]
+
+        # Rewriting chunks does not conflict with listing the parent
+        attempts = 0
+        for txn in etcd3.txn():
+            attempts += 1
+            txn.list_keys(PREFIX + "/", recurse=1)
+            if attempts == 1:
+                for txn2 in etcd3.txn():
+                    txn2.update(key, "x" + value[1:])
+            txn.create(key + "_other", "test")
+        assert attempts == 1
+        etcd3.delete(key + "_other")
+
+        # Shrinking removes chunks, small values get stored directly
+        for txn in etcd3.txn():
+            txn.update(key, value[:20])
+        assert etcd3.get(key)[0] == value[:20]
+        assert len(chunks(etcd3, key)) == 2
+        for txn in etcd3.txn():
+            txn.update(key, "small")
+        assert etcd3.get(key)[0] == "small"
+        assert chunks(etcd3, key) == []
+
+        # Deletion removes chunks, even without reading the value
+        for txn in etcd3.txn():
+            txn.update(key, value)
+        for txn in etcd3.txn():
+            txn.delete(key, must_exist=False)
+        assert etcd3.get(key)[0] is None
+        assert chunks(etcd3, key) == []
+
+        # Failed commits remove the chunks they wrote
+        for txn in etcd3.txn():
+            txn.create(key, value)
+        txn = etcd3.txn()
+        txn.update(key, value[::-1])
+        etcd3.update(key, "small")
+        assert not txn.commit()
+        assert chunks(etcd3, key) == []
+
+    finally:
+        etcd3.chunk_size = backend.CHUNK_SIZE
+        etcd3.delete(key, must_exist=False)
+
+
+def test_transaction_chunked_large():
+
+    # Use the in-memory store, which limits request sizes like etcd
+    store = memory.MemoryStore()
+    etcd3 = backend.Etcd3(client=memory.MemoryClient(store))
+    key = PREFIX + "/test_txn_chunked_large"
+
+    # Value of 8 MiB, such as a large processing block definition
+    value = json.dumps([
+        {'id': "field-{:06d}".format(i), 'ra': i / 1000, 'dec': -i / 1000}
+        for i in range(8 * 1024 * 1024 // 50)])[:8 * 1024 * 1024]
+    assert len(value) > 5 * store.max_request_bytes
+    with pytest.raises(RuntimeError, match="too large"):
+        etcd3.create(key, value)
+
+    # Transactions write it in chunks, plus other values
+    with etcd3.watch(PREFIX + "/", prefix=True) as queue:
+        for txn in etcd3.txn():
+            txn.create(key, value)
+            txn.create(key + "_small", "small")
+        assert queue.get(timeout=5) == (key, value, mock.ANY)
+        assert queue.get(timeout=5)[:2] == (key + "_small", "small")
+    assert etcd3.get(key)[0] == value
+    chunks0 = chunks(etcd3, key)
+    assert len(chunks0) == 8
+
+    # Updates only write changed chunks
+    for txn in etcd3.txn():
+        txn.update(key, "(" + txn.get(key)[1:])
+    assert etcd3.get(key)[0] == "(" + value[1:]
+    chunks1 = chunks(etcd3, key)
+    assert chunks1[1:] == chunks0[1:] and chunks1[0] != chunks0[0]
+
+    for txn in etcd3.txn():
+        txn.delete(key)
+    assert chunks(etcd3, key) == []
+
+
+def test_transaction_serializable(etcd3):
+
+    key = PREFIX + "/test_txn_serializable"
+    etcd3.create(key, "test")
+    assert etcd3.get(key, serializable=True)[0] == "test"
+    assert etcd3.list_keys(PREFIX + "/", serializable=True)[0] == [key]
+    for txn in etcd3.txn(serializable=True):
+        assert txn.serializable
+        assert txn.get(key) == "test"
+        assert txn.list_keys(PREFIX + "/") == [key]
+
+        # Serializable transactions are read-only
+        with pytest.raises(RuntimeError, match="serializable"):
+            txn.update(key, "test2")
+        with pytest.raises(RuntimeError, match="serializable"):
+            txn.create(key + "2", "test2")
+        with pytest.raises(RuntimeError, match="serializable"):
+            txn.delete(key)
+    assert etcd3.get(key)[0] == "test"
+    etcd3.delete(key)
+
+
 def test_transaction_delete(etcd3):
 
     key = PREFIX + "/test_txn_delete"
@@ -0,0 +1,157 @@
+"""Tests for output capture."""
+
+import os
+import time
+import threading
+import subprocess
+import pytest
+
+from ska_sdp_config import capture
+
+# pylint: disable=missing-docstring,protected-access
+
+
+def test_ring_limit():
+
+    ring = capture.StreamRing(15)
+    ring.feed(b'line0\nline1\nli')
+    assert ring.tail(10) == [b'line0\n', b'line1\n']
+    ring.feed(b'ne2\nline3\n')
+
+    # Only 15 bytes are kept
+    assert ring.tail(10) == [b'line2\n', b'line3\n']
+    assert ring.tail(1) == [b'line3\n']
+
+    # Incomplete last line gets returned once stream is closed
+    ring.feed(b'end')
+    assert ring.tail(1) == [b'line3\n']
+    ring.close()
+    assert ring.wait_closed(0)
+    assert ring.tail(2) == [b'line3\n', b'end']
+
+
+def test_ring_long_line():
+
+    # Line without newline does not grow beyond the ring size
+    ring = capture.StreamRing(1024)
+    chunk = b'x' * 65536
+    for _ in range(64):
+        ring.feed(chunk)
+    assert ring._partial_size <= 1025
+    ring.feed(b'\nshort')
+    line, = ring.tail(2)
+    assert len(line) == 1024 and line.endswith(capture.TRUNCATED)
+    assert line.startswith(b'xxx')
+    ring.feed(b'\n' + chunk * 2)
+    assert ring.tail(1) == [b'short\n']
+
+    # Same when the line arrives in one piece, or at the end
+    ring.feed(b'\n' + chunk + b'\n')
+    assert ring.tail(1)[0].endswith(capture.TRUNCATED)
+    ring.feed(chunk)
+    ring.close()
+    assert len(ring.tail(1)[0]) == 1024
+    assert sum(len(line) for line in ring.tail(10)) <= 1024
+
+
+def test_ring_spill():
+
+    spill = capture.SpillFile(40)
+    ring = capture.StreamRing(12, spill)
+    ring.feed(b''.join(b'line%d\n' % i for i in range(10)))
+    assert ring.tail(2) == [b'line8\n', b'line9\n']
+
+    # Spill file holds between 20 and 40 bytes worth of older lines
+    lines = ring.tail(100)
+    assert lines[-2:] == [b'line8\n', b'line9\n']
+    assert len(lines) >= 2 + 3
+    assert lines == [b'line%d\n' % i for i in range(10-len(lines), 10)]
+    assert spill.tail(1) == [b'line7\n']
+    ring.release()
+
+
+def test_ring_read():
+
+    ring = capture.StreamRing(18)
+    start = ring.position()
+    assert ring.read(start, timeout=0) == ([], start)
+    ring.feed(b'line0\nline1\n')
+    lines, seq = ring.read(start)
+    assert lines == [b'line0\n', b'line1\n']
+    assert ring.read(start, max_lines=1) == ([b'line0\n'], start + 1)
+
+    # Lines that dropped out of the ring get skipped
+    ring.feed(b'line2\nline3\nline4\n')
+    lines, seq = ring.read(seq)
+    assert lines == [b'line2\n', b'line3\n', b'line4\n']
+    assert ring.read(start) == (lines, seq)
+
+    # Position by time
+    assert ring.position(0) == seq - 3
+    assert ring.position(time.time() + 1) == seq
+
+    # Waiting gets woken up by new lines, and end of stream
+    threading.Timer(0.1, ring.feed, [b'line5\n']).start()
+    lines, seq = ring.read(seq, timeout=5)
+    assert lines == [b'line5\n']
+    threading.Timer(0.1, ring.close).start()
+    assert ring.read(seq, timeout=5) == (None, seq)
+
+
+def test_capture_process():
+
+    proc = subprocess.Popen(
+        ['for i in $(seq 0 99999); do echo $i; done'], shell=True,
+        stdout=subprocess.PIPE)
+    ring = capture.StreamRing(100)
+    capture.capture(proc.stdout, ring)
+    proc.wait()
+    assert ring.wait_closed(10)
+    assert ring.tail(2) == [b'99998\n', b'99999\n']
+
+
+def test_selector_failure():
+
+    # Failing callbacks and polls only affect themselves
+    selector = capture.SelectorThread()
+    read_fd, write_fd = os.pipe()
+    calls = []
+
+    def fail(fd):
+        calls.append(fd)
+        raise RuntimeError("Callback failure")
+
+    def fail_poll():
+        calls.append('poll')
+        raise RuntimeError("Poll failure")
+
+    selector.register(read_fd, fail)
+    selector.add_poll(fail_poll)
+    os.write(write_fd, b'x')
+    proc = subprocess.Popen(['echo Hello'], shell=True,
+                            stdout=subprocess.PIPE)
+    ring = capture.StreamRing(100)
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+
+    def on_readable(_fd):
+        data = os.read(fd, 65536)
+        if data:
+            ring.feed(data)
+        else:
+            selector.unregister(fd)
+            ring.close()
+    selector.register(fd, on_readable)
+    assert ring.wait_closed(10)
+    assert ring.tail(1) == [b'Hello\n']
+    os.write(write_fd, b'x')
+    time.sleep(0.2)
+    assert sorted(calls, key=str) == sorted([read_fd, 'poll'], key=str)
+    proc.wait()
+    proc.stdout.close()
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+if __name__ == '__main__':
+    pytest.main()
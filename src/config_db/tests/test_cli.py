@@ -49,6 +49,11 @@ def test_cli_simple(capsys):
     assert out == "asd\n"
     assert err == ""
 
+    cli.main(['--serializable', 'get', PREFIX+'/test'])
+    out, err = capsys.readouterr()
+    assert out == PREFIX+"/test = asd\n"
+    assert err == ""
+
     cli.main(['create', PREFIX+'/foo', 'bar'])
     out, err = capsys.readouterr()
     assert out == "OK\n"
@@ -82,5 +87,30 @@ def test_cli_simple(capsys):
     assert err == ""
 
 
+def test_cli_logs(capsys, monkeypatch):
+
+    monkeypatch.setenv('SDP_CONFIG_BACKEND', 'memory')
+    cli.main(['--prefix', PREFIX, 'deploy', 'helm', 'test-logs',
+              '{"chart": "test"}'])
+    capsys.readouterr()
+
+    # Logs of Helm deployments are not available
+    with pytest.raises(SystemExit) as exc:
+        cli.main(['--prefix', PREFIX, 'logs', 'test-logs'])
+    assert exc.value.code == 1
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert err.startswith("Cannot show logs of helm deployment test-logs")
+
+    with pytest.raises(SystemExit) as exc:
+        cli.main(['--prefix', PREFIX, 'logs', '-f', 'test-logs'])
+    assert exc.value.code == 1
+    assert "Cannot show logs" in capsys.readouterr()[1]
+
+    with pytest.raises(SystemExit):
+        cli.main(['--prefix', PREFIX, 'logs', 'test-missing'])
+    assert "does not exist" in capsys.readouterr()[1]
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -2,11 +2,16 @@
 
 import os
 import time
+import asyncio
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import yaml
 
 import pytest
 import kubernetes
-from ska_sdp_config import config, entity
+import ska_sdp_config.deploy
+from ska_sdp_config import config, entity, feed
 
 # pylint: disable=missing-docstring,redefined-outer-name
 
@@ -36,6 +41,75 @@ def test_deploy_name():
     assert dpl == eval(repr(dpl))
 
 
+def test_deploy_watch(cfg):
+
+    deploy = entity.Deployment('deploy-test-watch', 'helm', {
+        'chart': 'test'})
+
+    with cfg.watch_deployments(prefix='deploy-test-watch') as dpl_feed:
+        assert dpl_feed.poll(timeout=0.1) == []
+
+        for txn in cfg.txn():
+            txn.create_deployment(deploy)
+        events = dpl_feed.poll(timeout=5)
+        assert events == [feed.Added(deploy, events[0].revision)]
+        assert events[0].id == deploy.deploy_id
+        assert dpl_feed.entities == {deploy.deploy_id: deploy}
+
+        for txn in cfg.txn():
+            txn.delete_deployment(deploy)
+        events = dpl_feed.poll(timeout=5)
+        assert len(events) == 1
+        assert isinstance(events[0], feed.Removed)
+        assert events[0].id == deploy.deploy_id
+        assert dpl_feed.entities == {}
+
+
+def test_deploy_pb_index(cfg):
+
+    pb_id = 'index-00000000-0000'
+    deploys = [
+        entity.Deployment(pb_id + '-a', 'helm', {'chart': 'a'}, pb_id=pb_id),
+        entity.Deployment(pb_id + '-b', 'helm', {'chart': 'b'}, pb_id=pb_id),
+        entity.Deployment('deploy-test-noindex', 'helm', {'chart': 'c'}),
+    ]
+
+    for txn in cfg.txn():
+        assert txn.list_deployments_for_pb(pb_id) == []
+        for deploy in deploys:
+            txn.create_deployment(deploy)
+    for txn in cfg.txn():
+        assert txn.get_deployment(deploys[0].deploy_id).pb_id == pb_id
+        assert txn.list_deployments_for_pb(pb_id) == [
+            deploys[0].deploy_id, deploys[1].deploy_id]
+        assert txn.list_deployments_by_pb() == {
+            pb_id: [deploys[0].deploy_id, deploys[1].deploy_id]}
+
+    # Deployments without processing block can be added to the index
+    pb_id2 = 'index-00000000-0001'
+    for txn in cfg.txn():
+        txn.index_deployment(deploys[2].deploy_id, pb_id2)
+        txn.index_deployment(deploys[1].deploy_id, pb_id)
+        with pytest.raises(ValueError, match="already belongs"):
+            txn.index_deployment(deploys[1].deploy_id, pb_id2)
+        with pytest.raises(ValueError, match="does not exist"):
+            txn.index_deployment('deploy-test-missing', pb_id2)
+    for txn in cfg.txn():
+        assert txn.get_deployment(deploys[2].deploy_id).pb_id == pb_id2
+        assert txn.list_deployments_for_pb(pb_id2) == [deploys[2].deploy_id]
+
+    # Deleting updates index, and does not touch other deployments
+    for txn in cfg.txn():
+        txn.delete_deployment(deploys[0])
+    for txn in cfg.txn():
+        assert txn.list_deployments_for_pb(pb_id) == [deploys[1].deploy_id]
+        assert txn.get_deployment(deploys[1].deploy_id) == deploys[1]
+        for deploy in deploys[1:]:
+            txn.delete_deployment(deploy)
+    for txn in cfg.txn():
+        assert txn.list_deployments_by_pb() == {}
+
+
 def test_deploy_process(cfg):
 
     # Make deployment
@@ -53,6 +127,12 @@ def test_deploy_process(cfg):
             deploy.to_dict()
         txn.delete_deployment(deploy)
 
+    # Only a bounded number of undone processes are remembered
+    assert deploy.deploy_id not in ska_sdp_config.deploy._SUBPROCESS
+    assert cfg.get_deployment_logs(deploy) == [b'Hello World!\n']
+    assert len(ska_sdp_config.deploy._UNDONE) <= \
+        ska_sdp_config.deploy._KEEP_UNDONE
+
 
 def test_deploy_process_log_limit(cfg):
 
@@ -73,6 +153,65 @@ def test_deploy_process_log_limit(cfg):
         txn.delete_deployment(deploy)
 
 
+def test_deploy_process_stderr(cfg):
+
+    # Write enough to stderr that the pipe would fill up if it was
+    # not read
+    deploy = entity.Deployment('deploy-test-stderr', 'process-direct', {
+        'args': ['for i in $(seq 0 9999); do echo err$i >&2; done; '
+                 'echo done'],
+        'shell': True
+    })
+    for txn in cfg.txn():
+        applied = txn.create_deployment(deploy)
+    applied.result(timeout=5)
+    for _ in range(100):
+        if cfg.get_deployment_logs(deploy) == [b'done\n']:
+            break
+        time.sleep(0.1)
+    assert cfg.get_deployment_logs(deploy) == [b'done\n']
+    assert cfg.get_deployment_logs(deploy, 2, stream='stderr') == \
+        [b'err9998\n', b'err9999\n']
+    for txn in cfg.txn():
+        undone = txn.delete_deployment(deploy)
+    undone.result(timeout=15)
+
+
+def test_deploy_process_follow(cfg):
+
+    deploy = entity.Deployment('deploy-test-follow', 'process-direct', {
+        'args': ['echo line0; sleep 0.5; for i in 1 2 3; do echo line$i; '
+                 'done; echo err >&2'],
+        'shell': True
+    })
+    for txn in cfg.txn():
+        applied = txn.create_deployment(deploy)
+    applied.result(timeout=5)
+    time.sleep(0.2)
+
+    # Only new lines by default, or all since a given time
+    assert list(cfg.follow_deployment_logs(deploy, timeout=5)) == \
+        [b'line1\n', b'line2\n', b'line3\n']
+    assert list(cfg.follow_deployment_logs(deploy, since=0)) == \
+        [b'line0\n', b'line1\n', b'line2\n', b'line3\n']
+    assert list(cfg.follow_deployment_logs(deploy, since=0,
+                                           stream='stderr')) == [b'err\n']
+
+    async def follow():
+        return [line async for line in cfg.follow_deployment_logs_async(
+            deploy, since=0)]
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(follow()) == \
+            [b'line0\n', b'line1\n', b'line2\n', b'line3\n']
+    finally:
+        loop.close()
+
+    for txn in cfg.txn():
+        undone = txn.delete_deployment(deploy)
+    undone.result(timeout=15)
+
+
 def test_deploy_kill(cfg):
 
     # Make deployment
@@ -96,6 +235,245 @@ def test_deploy_kill(cfg):
                 [b'Enter\n', b'Exit\n']
 
 
+def test_deploy_failure_status(cfg, caplog):
+
+    # Failing side effects get raised from the commit and reported in
+    # the deployment status
+    deploy = entity.Deployment('deploy-test-fail', 'process-direct', {
+        'args': ['/nonexistent/sdp-test-executable']
+    })
+    with pytest.raises(OSError):
+        for txn in cfg.txn():
+            txn.create_deployment(deploy)
+    for txn in cfg.txn():
+        status = txn.get_deployment_status(deploy.deploy_id)
+        assert status['phase'] == 'failed'
+        assert 'sdp-test-executable' in status['last_error']
+        txn.patch_deployment_status(deploy.deploy_id, {'last_error': None})
+    for txn in cfg.txn():
+        assert 'last_error' not in txn.get_deployment_status(deploy.deploy_id)
+
+    # Failure to undo (there is no process) only gets logged, the
+    # status goes together with the deployment
+    with pytest.raises(ValueError):
+        for txn in cfg.txn():
+            txn.delete_deployment(deploy)
+    assert 'not created by this process' in caplog.text
+    for txn in cfg.txn():
+        assert txn.get_deployment(deploy.deploy_id) is None
+        assert txn.get_deployment_status(deploy.deploy_id) is None
+
+
+def test_deploy_failure_status_async():
+
+    # With side effects in the background, failures get reported via
+    # the returned future
+    deploy = entity.Deployment('deploy-test-fail-async', 'process-direct', {
+        'args': ['/nonexistent/sdp-test-executable']
+    })
+    host = os.getenv('SDP_TEST_HOST', '127.0.0.1')
+    with config.Config(global_prefix=PREFIX, host=host,
+                       side_effect_workers=4) as cfg_async:
+        for txn in cfg_async.txn():
+            applied = txn.create_deployment(deploy)
+            assert txn.get_deployment_status(deploy.deploy_id) is None
+        with pytest.raises(OSError):
+            applied.result(timeout=5)
+        for txn in cfg_async.txn():
+            status = txn.get_deployment_status(deploy.deploy_id)
+            assert status['phase'] == 'failed'
+            undone = txn.delete_deployment(deploy)
+        with pytest.raises(ValueError):
+            undone.result(timeout=5)
+
+
+def test_deploy_kill_parallel(cfg):
+
+    # Processes that ignore SIGTERM must get killed after a grace
+    # period that is shared between all deployments
+    deploys = [
+        entity.Deployment('deploy-test-par{}'.format(i), 'process-direct', {
+            'args': ['trap "" TERM; echo Enter; sleep 10'],
+            'shell': True
+        })
+        for i in range(5)
+    ]
+    for txn in cfg.txn():
+        applied = [txn.create_deployment(deploy) for deploy in deploys]
+    for future in applied:
+        future.result(timeout=5)
+    for deploy in deploys:
+        for _ in range(50):
+            if cfg.get_deployment_logs(deploy):
+                break
+            time.sleep(0.1)
+    for deploy in deploys:
+        info = cfg.get_deployment_process_info(deploy)
+        assert info['returncode'] is None and info['exited'] is None
+
+    start = time.time()
+    ska_sdp_config.deploy._TERMINATE_GRACE = 0.5
+    try:
+        for txn in cfg.txn():
+            for deploy in deploys:
+                undone = txn.delete_deployment(deploy)
+        undone.result(timeout=5)
+    finally:
+        ska_sdp_config.deploy._TERMINATE_GRACE = 10.0
+    assert time.time() - start < 5
+
+    for deploy in deploys:
+        info = cfg.get_deployment_process_info(deploy)
+        assert info['returncode'] == -9
+        assert info['terminated'] is not None
+        assert info['killed'] - info['terminated'] >= 0.5
+        assert info['exited'] >= info['killed']
+        assert info['runtime'] > 0
+
+
+class _FakeKubeHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the Kubernetes API server."""
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length))
+        self.server.requests.append(('POST', self.path, body))
+        if body['metadata']['name'] in self.server.objects:
+            self._reply(409, {'kind': 'Status', 'apiVersion': 'v1',
+                              'status': 'Failure', 'reason': 'Conflict',
+                              'code': 409})
+            return
+        self.server.objects[body['metadata']['name']] = body
+        self._reply(201, body)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self.server.requests.append(('DELETE', self.path, None))
+        body = self.server.objects.pop(self.path.split('/')[-1])
+        # Pod deletion returns the pod, everything else a status
+        if body['kind'] != 'Pod':
+            body = {'kind': 'Status', 'apiVersion': 'v1',
+                    'status': 'Success'}
+        self._reply(200, body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.requests.append(('GET', self.path, None))
+        data = b'Hello from fake API!\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def fake_kube(tmp_path, monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), _FakeKubeHandler)
+    server.requests = []
+    server.objects = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    kubeconfig = tmp_path / 'kubeconfig'
+    kubeconfig.write_text(yaml.dump({
+        'apiVersion': 'v1', 'kind': 'Config',
+        'clusters': [{'name': 'fake', 'cluster': {
+            'server': 'http://127.0.0.1:{}'.format(server.server_port)}}],
+        'users': [{'name': 'fake', 'user': {}}],
+        'contexts': [{'name': 'fake', 'context': {
+            'cluster': 'fake', 'user': 'fake'}}],
+        'current-context': 'fake'
+    }))
+    monkeypatch.setenv('KUBECONFIG', str(kubeconfig))
+    monkeypatch.delenv('KUBERNETES_SERVICE_HOST', raising=False)
+    ska_sdp_config.deploy._reset_kube_client()
+    yield server
+    server.shutdown()
+    server.server_close()
+    ska_sdp_config.deploy._reset_kube_client()
+
+
+def test_deploy_kube_fake(cfg, fake_kube):
+
+    pod = {
+        'apiVersion': 'v1', 'kind': 'Pod',
+        'metadata': {'name': 'test-pod'},
+        'spec': {'containers': [{'image': 'hello-world',
+                                 'name': 'hello-world'}]}
+    }
+    objects = {'apiVersion': 'v1', 'kind': 'List', 'items': [
+        {'apiVersion': 'v1', 'kind': 'ConfigMap',
+         'metadata': {'name': 'test-cm-{}'.format(i), 'namespace': 'sdp'},
+         'data': {'index': str(i)}}
+        for i in range(4)
+    ] + [
+        {'apiVersion': 'apps/v1', 'kind': 'StatefulSet',
+         'metadata': {'name': 'test-sts', 'namespace': 'sdp'},
+         'spec': {'selector': {}, 'serviceName': 'test',
+                  'template': {'spec': {'containers': []}}}},
+        {'apiVersion': 'rbac.authorization.k8s.io/v1', 'kind': 'ClusterRole',
+         'metadata': {'name': 'test-role'}}
+    ]}
+    dpl_pod = entity.Deployment('deploy-test-fkube', 'kubernetes-direct', pod)
+    dpl_list = entity.Deployment('deploy-test-fkube-list',
+                                 'kubernetes-direct', objects)
+
+    for txn in cfg.txn():
+        applied = txn.create_deployment(dpl_pod)
+    applied.result(timeout=5)
+    for txn in cfg.txn():
+        applied = txn.create_deployment(dpl_list)
+    applied.result(timeout=5)
+    posts = sorted(path for method, path, _ in fake_kube.requests
+                   if method == 'POST')
+    assert posts == [
+        '/api/v1/namespaces/default/pods',
+        '/api/v1/namespaces/sdp/configmaps',
+        '/api/v1/namespaces/sdp/configmaps',
+        '/api/v1/namespaces/sdp/configmaps',
+        '/api/v1/namespaces/sdp/configmaps',
+        '/apis/apps/v1/namespaces/sdp/statefulsets',
+        '/apis/rbac.authorization.k8s.io/v1/clusterroles',
+    ]
+
+    # List items get created in order of kind, so that dependencies
+    # exist before the objects using them
+    list_posts = [path for method, path, _ in fake_kube.requests
+                  if method == 'POST'][1:]
+    assert [path.split('/')[-1] for path in list_posts] == \
+        ['configmaps'] * 4 + ['clusterroles', 'statefulsets']
+    assert cfg.get_deployment_logs(dpl_pod) == 'Hello from fake API!\n'
+    assert list(cfg.follow_deployment_logs(dpl_pod, since=0)) == \
+        [b'Hello from fake API!\n']
+    assert 'follow=true' in fake_kube.requests[-1][1]
+
+    # Creating again fails with a conflict
+    with pytest.raises(kubernetes.utils.FailToCreateError) as exc_info:
+        ska_sdp_config.deploy.apply_deployment(dpl_list)
+    assert len(exc_info.value.api_exceptions) == 6
+    assert exc_info.value.api_exceptions[0].reason == 'Conflict'
+
+    for txn in cfg.txn():
+        txn.delete_deployment(dpl_pod)
+        undone = txn.delete_deployment(dpl_list)
+    undone.result(timeout=5)
+    assert fake_kube.objects == {}
+    deletes = sorted(path for method, path, _ in fake_kube.requests
+                     if method == 'DELETE')
+    assert deletes[0] == '/api/v1/namespaces/default/pods/test-pod'
+    assert deletes[-1] == \
+        '/apis/rbac.authorization.k8s.io/v1/clusterroles/test-role'
+
+
 def _have_kubernetes():
 
     # Try in-cluster configuration
@@ -0,0 +1,89 @@
+"""Tests for asynchronous execution of commit hooks."""
+
+import threading
+import time
+import pytest
+
+from ska_sdp_config import hooks
+
+
+def test_hooks_ordered():
+
+    # Side effects sharing a key run in submission order
+    executor = hooks.CommitHookExecutor(max_workers=4)
+    order = []
+
+    def record(value, delay):
+        time.sleep(delay)
+        order.append(value)
+        return value
+
+    futures = [executor.submit(['a'], record, i, 0.05 * (5 - i))
+               for i in range(5)]
+    assert [future.result(timeout=5) for future in futures] == \
+        list(range(5))
+    assert order == list(range(5))
+
+    # Multiple keys wait for all predecessors
+    order.clear()
+    first = executor.submit(['a'], record, 'a', 0.2)
+    second = executor.submit(['b'], record, 'b', 0.1)
+    both = executor.submit(['a', 'b'], record, 'ab', 0)
+    both.result(timeout=5)
+    assert first.done() and second.done()
+    assert order == ['b', 'a', 'ab']
+    executor.shutdown()
+
+
+def test_hooks_concurrency():
+
+    # Unrelated side effects run concurrently, up to the limit
+    executor = hooks.CommitHookExecutor(max_workers=2)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+
+    futures = [executor.submit([str(i)], work) for i in range(6)]
+    for future in futures:
+        future.result(timeout=5)
+    assert running[1] == 2
+    executor.shutdown()
+
+
+def test_hooks_failure():
+
+    # Failures get passed on, but do not block later side effects
+    executor = hooks.CommitHookExecutor()
+
+    def fail():
+        raise ValueError("Failed!")
+
+    failed = executor.submit(['a'], fail)
+    after = executor.submit(['a'], lambda: 'ok')
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+    assert after.result(timeout=5) == 'ok'
+    executor.shutdown()
+
+
+def test_hooks_shutdown():
+
+    # Side effects submitted after shutdown run synchronously
+    executor = hooks.CommitHookExecutor()
+    slow = executor.submit(['a'], time.sleep, 0.2)
+    executor.shutdown(wait=False)
+    after = executor.submit(['a'], lambda: 'after')
+    assert after.result(timeout=5) == 'after'
+    assert slow.done()
+    assert executor.submit(['b'], lambda: 'now').result(timeout=0) == 'now'
+
+
+if __name__ == '__main__':
+    pytest.main()
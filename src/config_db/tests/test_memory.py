@@ -0,0 +1,140 @@
+"""Tests for the in-memory configuration backend."""
+
+import pytest
+
+from ska_sdp_config import config, entity, feed, memory
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+PREFIX = "/__test_memory"
+
+WORKFLOW = {
+    'id': 'test_rt_workflow',
+    'version': '0.0.1',
+    'type': 'realtime'
+}
+
+
+@pytest.fixture
+def cfg(monkeypatch):
+    monkeypatch.setenv('SDP_CONFIG_BACKEND', 'memory')
+    with config.Config(global_prefix=PREFIX) as cfg:
+        cfg._backend.delete(PREFIX, must_exist=False, recursive=True)
+        yield cfg
+
+
+def test_memory_shared(cfg):
+
+    # Clients of the same process share the store
+    assert isinstance(cfg._backend._client, memory.MemoryClient)
+    pb = entity.ProcessingBlock('pb-test-memory', None, WORKFLOW)
+    for txn in cfg.txn():
+        txn.create_processing_block(pb)
+    with config.Config(global_prefix=PREFIX) as cfg2:
+        for txn in cfg2.txn():
+            assert txn.get_processing_block(pb.pb_id) == pb
+
+    # ... but separate stores are separate
+    client = memory.MemoryClient(memory.MemoryStore())
+    assert client.range(b'').kvs is None
+
+
+def test_memory_txn(cfg):
+
+    # Conflicting writes make transactions repeat
+    for txn in cfg.txn():
+        txn.create_processing_block(
+            entity.ProcessingBlock('pb-test-conflict', None, WORKFLOW))
+    attempts = 0
+    for txn in cfg.txn():
+        attempts += 1
+        state = txn.get_processing_block_state('pb-test-conflict')
+        if attempts == 1:
+            for txn2 in cfg.txn():
+                txn2.create_processing_block_state(
+                    'pb-test-conflict', {'state': 'executing'})
+        if state is None:
+            txn.create_processing_block_state(
+                'pb-test-conflict', {'state': 'failed'})
+    assert attempts == 2
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state('pb-test-conflict') == \
+            {'state': 'executing'}
+
+
+def test_memory_lease_and_feed(cfg):
+
+    with cfg.watch_processing_blocks() as pb_feed:
+        assert list(pb_feed.poll(0)) == []
+        with cfg.lease(ttl=1) as lease:
+            for txn in cfg.txn():
+                txn.create_processing_block(
+                    entity.ProcessingBlock('pb-test-lease', None, WORKFLOW))
+                txn.take_processing_block('pb-test-lease', lease)
+            events = list(pb_feed.poll(1))
+            assert [type(event) for event in events] == \
+                [feed.Added, feed.OwnerChanged]
+            for txn in cfg.txn():
+                assert txn.get_processing_block_owner('pb-test-lease')
+
+        # Revoking the lease removes owner
+        for txn in cfg.txn():
+            assert txn.get_processing_block_owner('pb-test-lease') is None
+        assert [type(event) for event in pb_feed.poll(1)] == \
+            [feed.OwnerChanged]
+
+
+def test_memory_history():
+
+    store = memory.MemoryStore(history_revisions=4)
+    client = memory.MemoryClient(store)
+
+    def put(key, value):
+        txn = client.Txn()
+        txn.success(txn.put(key, value))
+        return txn.commit().header.revision
+
+    def delete(key):
+        txn = client.Txn()
+        txn.success(txn.delete(key))
+        return txn.commit().header.revision
+
+    def read(key, revision=None, prefix=True):
+        kvs = client.range(key, revision=revision, prefix=prefix).kvs
+        return [(kv.key, kv.value) for kv in kvs or []]
+
+    # Past revisions can be read, for single keys and ranges
+    rev_a = put(b'/a', b'1')
+    rev_b = put(b'/b', b'1')
+    put(b'/a', b'2')
+    rev_del = delete(b'/b')
+    put(b'/c', b'1')
+    assert read(b'/') == [(b'/a', b'2'), (b'/c', b'1')]
+    assert read(b'/', rev_a) == [(b'/a', b'1')]
+    assert read(b'/', rev_b) == [(b'/a', b'1'), (b'/b', b'1')]
+    assert read(b'/b', rev_b, prefix=False) == [(b'/b', b'1')]
+    assert read(b'/b', rev_del, prefix=False) == []
+
+    # Older history gets compacted once twice the history to keep has
+    # accumulated
+    for i in range(2):
+        rev = put(b'/c', str(i).encode())
+    assert store.compact_revision == 1
+    rev = put(b'/c', b'3')
+    assert store.compact_revision == rev_del == rev - 4
+    assert all(entry[0] >= rev_del for entry in store.history)
+    assert b'/b' not in store._versions  # pylint: disable=protected-access
+    with pytest.raises(ValueError, match="compacted"):
+        read(b'/', rev_b)
+    with pytest.raises(ValueError, match="compacted"):
+        client.Watcher(b'/', start_revision=rev_b, prefix=True).runDaemon()
+    assert read(b'/', rev_del) == [(b'/a', b'2')]
+    assert read(b'/', rev - 1) == [(b'/a', b'2'), (b'/c', b'1')]
+
+    # Watchers can still replay the history kept
+    events = []
+    watcher = client.Watcher(b'/c', start_revision=rev - 1)
+    watcher.onEvent(events.append)
+    watcher.runDaemon()
+    assert [event.value for event in events] == [b'1', b'3']
+    watcher.stop()
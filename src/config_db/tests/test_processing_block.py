@@ -1,9 +1,13 @@
 """High-level API tests on processing blocks."""
 
 import os
+import time
+import asyncio
+import threading
+from concurrent.futures import CancelledError
 import pytest
 
-from ska_sdp_config import config, entity, backend
+from ska_sdp_config import config, entity, backend, feed
 
 # pylint: disable=missing-docstring,redefined-outer-name
 
@@ -194,5 +198,416 @@ def test_pb_state(cfg):
         assert state_out == state2
 
 
+def test_merge_patch():
+
+    # Examples from RFC 7386, appendix A
+    assert config.merge_patch({'a': 'b'}, {'a': 'c'}) == {'a': 'c'}
+    assert config.merge_patch({'a': 'b'}, {'b': 'c'}) == {'a': 'b', 'b': 'c'}
+    assert config.merge_patch({'a': 'b'}, {'a': None}) == {}
+    assert config.merge_patch({'a': 'b', 'b': 'c'}, {'a': None}) == \
+        {'b': 'c'}
+    assert config.merge_patch({'a': ['b']}, {'a': 'c'}) == {'a': 'c'}
+    assert config.merge_patch({'a': 'c'}, {'a': ['b']}) == {'a': ['b']}
+    assert config.merge_patch({'a': {'b': 'c'}},
+                              {'a': {'b': 'd', 'c': None}}) == \
+        {'a': {'b': 'd'}}
+    assert config.merge_patch({'a': [{'b': 'c'}]}, {'a': [1]}) == {'a': [1]}
+    assert config.merge_patch(['a', 'b'], ['c', 'd']) == ['c', 'd']
+    assert config.merge_patch({'a': 'b'}, ['c']) == ['c']
+    assert config.merge_patch({'e': None}, {'a': 1}) == {'e': None, 'a': 1}
+    assert config.merge_patch([1, 2], {'a': 'b', 'c': None}) == {'a': 'b'}
+    assert config.merge_patch({}, {'a': {'bb': {'ccc': None}}}) == \
+        {'a': {'bb': {}}}
+
+    # Target must not get modified
+    target = {'a': {'b': 'c'}}
+    config.merge_patch(target, {'a': {'b': None}})
+    assert target == {'a': {'b': 'c'}}
+
+
+def test_pb_state_patch(cfg):
+
+    pb_id = 'teststate-00000000-0001'
+    for txn in cfg.txn():
+        txn.create_processing_block(
+            entity.ProcessingBlock(pb_id, None, WORKFLOW))
+
+    # Patching non-existing state creates it
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'state': 'executing', 'nested': {'a': 1, 'b': 2}})
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'executing', 'nested': {'a': 1, 'b': 2}}
+
+    # Merge into nested dictionary, remove field
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'nested': {'a': None, 'c': 3}})
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'executing', 'nested': {'b': 2, 'c': 3}}
+
+    # Store field in sub-key
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'link_map': {'scanID': 1}}, fields=('link_map',))
+    for txn in cfg.txn():
+        assert txn.raw.get(cfg.pb_path + pb_id + '/state/link_map') \
+            is not None
+        assert 'link_map' not in txn.raw.get(cfg.pb_path + pb_id + '/state')
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'executing', 'nested': {'b': 2, 'c': 3},
+             'link_map': {'scanID': 1}}
+
+    # Fields stored in sub-keys stay there
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'link_map': {'scanID': 2}, 'state': 'finished'})
+    for txn in cfg.txn():
+        assert 'link_map' not in txn.raw.get(cfg.pb_path + pb_id + '/state')
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'finished', 'nested': {'b': 2, 'c': 3},
+             'link_map': {'scanID': 2}}
+
+    # Independent writers of different fields do not conflict
+    txn1 = cfg.txn().__iter__().__next__()
+    txn2 = cfg.txn().__iter__().__next__()
+    txn1.patch_processing_block_state(pb_id, {'link_map': {'scanID': 3}})
+    txn2.patch_processing_block_state(pb_id, {'addresses': {'scanId': 3}})
+    assert txn1.raw.commit()
+    assert txn2.raw.commit()
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'finished', 'nested': {'b': 2, 'c': 3},
+             'link_map': {'scanID': 3}, 'addresses': {'scanId': 3}}
+
+    # But writers of the same field do
+    txn1 = cfg.txn().__iter__().__next__()
+    txn2 = cfg.txn().__iter__().__next__()
+    txn1.patch_processing_block_state(pb_id, {'link_map': {'scanID': 4}})
+    txn2.patch_processing_block_state(pb_id, {'link_map': {'scanID': 5}})
+    assert txn1.raw.commit()
+    assert not txn2.raw.commit()
+
+    # Removing a field stored in a sub-key deletes it
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(pb_id, {'link_map': None})
+    for txn in cfg.txn():
+        assert txn.raw.get(cfg.pb_path + pb_id + '/state/link_map') is None
+        assert 'link_map' not in txn.get_processing_block_state(pb_id)
+
+    # Moving a field into a sub-key removes it from the state document
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'nested': {'d': 4}}, fields=('nested',))
+    for txn in cfg.txn():
+        assert 'nested' not in txn.raw.get(cfg.pb_path + pb_id + '/state')
+        assert txn.get_processing_block_state(pb_id)['nested'] == \
+            {'b': 2, 'c': 3, 'd': 4}
+
+    # Updating the state only writes sub-keys that changed
+    link_map_path = cfg.pb_path + pb_id + '/state/link_map'
+    for txn in cfg.txn():
+        txn.patch_processing_block_state(
+            pb_id, {'link_map': {'scanID': 6}}, fields=('link_map',))
+    _, rev = cfg._backend.get(link_map_path)
+    for txn in cfg.txn():
+        txn.update_processing_block_state(
+            pb_id, {'state': 'running', 'link_map': {'scanID': 6}})
+    assert cfg._backend.get(link_map_path)[1].mod_revision == \
+        rev.mod_revision
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state(pb_id) == \
+            {'state': 'running', 'link_map': {'scanID': 6}}
+        assert txn.raw.get(cfg.pb_path + pb_id + '/state/nested') is None
+
+    # ... and replaces fields stored in sub-keys as well
+    for txn in cfg.txn():
+        txn.update_processing_block_state(pb_id, {'state': 'failed'})
+    for txn in cfg.txn():
+        assert txn.get_processing_block_state(pb_id) == {'state': 'failed'}
+
+
+def test_pb_sbi_index(cfg):
+
+    sbi_id = 'test-sbi-index'
+    pb_ids = ['index-00000000-0000', 'index-00000000-0001']
+
+    for txn in cfg.txn():
+        assert txn.list_processing_blocks_for_sbi(sbi_id) == []
+        for pb_id in pb_ids:
+            txn.create_processing_block(
+                entity.ProcessingBlock(pb_id, sbi_id, WORKFLOW))
+        txn.create_processing_block(
+            entity.ProcessingBlock('index-00000000-0002', None, WORKFLOW))
+        assert txn.list_processing_blocks_for_sbi(sbi_id) == pb_ids
+
+    for txn in cfg.txn():
+        assert txn.list_processing_blocks_for_sbi(sbi_id) == pb_ids
+        txn.create_processing_block_state(pb_ids[0], {})
+
+    # Deleting a processing block removes it from the index
+    for txn in cfg.txn():
+        txn.delete_processing_block(pb_ids[0])
+    for txn in cfg.txn():
+        assert txn.get_processing_block(pb_ids[0]) is None
+        assert txn.get_processing_block_state(pb_ids[0]) is None
+        assert txn.get_processing_block(pb_ids[1]) is not None
+        assert txn.list_processing_blocks_for_sbi(sbi_id) == pb_ids[1:]
+
+
+def test_pb_watch(cfg):
+
+    workflow = dict(WORKFLOW)
+    workflow['id'] += "-watch"
+    pb_id = 'watch-00000000-0000'
+    pb_id2 = 'watch-00000000-0001'
+
+    # Create a processing block before starting the feed
+    pb = entity.ProcessingBlock(pb_id, None, workflow)
+    for txn in cfg.txn():
+        txn.create_processing_block(pb)
+
+    with cfg.watch_processing_blocks(prefix='watch-') as pb_feed:
+
+        # Should start with snapshot
+        events = pb_feed.poll()
+        assert len(events) == 1
+        assert isinstance(events[0], feed.Added)
+        assert events[0].obj == pb
+        assert pb_feed.entities == {pb_id: pb}
+
+        # Nothing should happen without changes
+        assert pb_feed.poll(timeout=0.1) == []
+
+        # Add state + owner, update processing block
+        for txn in cfg.txn():
+            txn.create_processing_block_state(pb_id, {'state': 'executing'})
+        with cfg.lease() as lease:
+            for txn in cfg.txn():
+                txn.take_processing_block(pb_id, lease)
+            pb2 = entity.ProcessingBlock(pb_id2, None, workflow)
+            for txn in cfg.txn():
+                txn.create_processing_block(pb2)
+            events = []
+            while len(events) < 3:
+                events.extend(pb_feed.poll(timeout=5))
+        events.extend(pb_feed.poll(timeout=5))
+        assert [type(event) for event in events] == [
+            feed.StateChanged, feed.OwnerChanged, feed.Added,
+            feed.OwnerChanged]
+        assert events[0].state == {'state': 'executing'}
+        assert events[0].old is None
+        assert events[1].owner == cfg.owner
+        assert events[2].obj == pb2
+        assert events[3].owner is None
+        assert events[3].old == cfg.owner
+        assert events[1].revision.revision < events[3].revision.revision
+        assert pb_feed.children['state'] == {pb_id: {'state': 'executing'}}
+
+        # State fields stored in sub-keys get merged
+        for txn in cfg.txn():
+            txn.patch_processing_block_state(
+                pb_id, {'link_map': {'scanID': 1}}, fields=('link_map',))
+        events = pb_feed.poll(timeout=5)
+        assert len(events) == 1
+        assert events[0].state == {'state': 'executing',
+                                   'link_map': {'scanID': 1}}
+        assert events[0].old == {'state': 'executing'}
+
+        # Updates and removal
+        pb2.parameters['test'] = 'test'
+        for txn in cfg.txn():
+            txn.update_processing_block(pb2)
+        cfg._backend.delete(cfg.pb_path + pb_id, recursive=True)
+        events = []
+        while len(events) < 3:
+            events.extend(pb_feed.poll(timeout=5))
+        changed, = [ev for ev in events if isinstance(ev, feed.Changed)]
+        assert changed.obj == pb2
+        assert changed.old.parameters == {}
+        removed, = [ev for ev in events if isinstance(ev, feed.Removed)]
+        assert removed.id == pb_id
+        assert removed.old == pb
+        assert set(pb_feed.entities) == {pb_id2}
+
+
+def test_pb_watch_order(cfg):
+
+    workflow = dict(WORKFLOW)
+    workflow['id'] += "-order"
+    pb_id = 'order-00000000-0000'
+    pb = entity.ProcessingBlock(pb_id, None, workflow)
+
+    with cfg.watch_processing_blocks(prefix='order-') as pb_feed:
+        assert pb_feed.poll(timeout=0.1) == []
+
+        # Changes to the entity, its state and state fields (which all
+        # live at different depths) arrive in revision order, while
+        # other keys in the watched range get ignored
+        for txn in cfg.txn():
+            txn.create_processing_block_state(pb_id, {'state': 'a'})
+        for txn in cfg.txn():
+            txn.create_processing_block(pb)
+        for txn in cfg.txn():
+            txn.patch_deployment_status('order-deploy', {'state': 'x'})
+        for txn in cfg.txn():
+            txn.patch_processing_block_state(
+                pb_id, {'resources': ['x']}, fields=('resources',))
+        for txn in cfg.txn():
+            txn.update_processing_block_state(pb_id, {'state': 'b'})
+        events = []
+        while pb_feed.children['state'].get(pb_id) != {'state': 'b'}:
+            events.extend(pb_feed.poll(timeout=5))
+        assert [type(event) for event in events[:3]] == [
+            feed.StateChanged, feed.Added, feed.StateChanged]
+        assert events[2].state == {'state': 'a', 'resources': ['x']}
+        revisions = [event.revision.revision for event in events]
+        assert revisions == sorted(revisions)
+        assert pb_feed.entities == {pb_id: pb}
+        assert pb_feed.revision.revision == revisions[-1]
+        assert pb_feed.poll(timeout=0.1) == []
+    cfg._backend.delete(cfg.deploy_path + 'order-deploy', must_exist=False,
+                        recursive=True)
+
+
+def test_pb_watch_async(cfg):
+
+    workflow = dict(WORKFLOW)
+    workflow['id'] += "-awatch"
+    pb_id = 'awatch-00000000-0000'
+
+    async def follow():
+        events = []
+        async with cfg.watch_processing_blocks(prefix='awatch-') as pb_feed:
+            async for event in pb_feed:
+                events.append(event)
+                if isinstance(event, feed.StateChanged):
+                    return events
+                for txn in cfg.txn():
+                    txn.create_processing_block_state(pb_id, {})
+        return events
+
+    for txn in cfg.txn():
+        txn.create_processing_block(
+            entity.ProcessingBlock(pb_id, None, workflow))
+    loop = asyncio.new_event_loop()
+    try:
+        events = loop.run_until_complete(
+            asyncio.wait_for(follow(), timeout=10))
+    finally:
+        loop.close()
+    assert [type(event) for event in events] == [
+        feed.Added, feed.StateChanged]
+    assert events[1].state == {}
+
+
+def test_controller_shards(cfg):
+
+    ctl = 'test_controller'
+    with cfg.lease(ttl=5) as lease1, cfg.lease(ttl=5) as lease2:
+        for txn in cfg.txn():
+            txn.raw.create(PREFIX + '/test_fenced', '0')
+            txn.register_controller_replica(ctl, 'replica-1', lease1)
+            txn.register_controller_replica(ctl, 'replica-0', lease2)
+        for txn in cfg.txn():
+            assert txn.list_controller_replicas(ctl) == \
+                ['replica-0', 'replica-1']
+            assert txn.list_shard_owners(ctl) == {}
+            txn.claim_shard(ctl, 3, 'replica-1', lease1)
+            txn.claim_shard(ctl, 12, 'replica-0', lease2)
+        for txn in cfg.txn():
+            assert txn.list_shard_owners(ctl) == \
+                {3: 'replica-1', 12: 'replica-0'}
+            assert txn.get_shard_owner(ctl, 3) == 'replica-1'
+            assert txn.get_shard_owner(ctl, 4) is None
+        with pytest.raises(backend.Collision):
+            for txn in cfg.txn():
+                txn.claim_shard(ctl, 3, 'replica-0', lease2)
+
+        # Reading the owner fences: a transaction that saw the old
+        # owner gets repeated after ownership changed
+        owners = []
+        for txn in cfg.txn():
+            owners.append(txn.get_shard_owner(ctl, 3))
+            txn.raw.update(PREFIX + '/test_fenced', str(len(owners)))
+            if len(owners) == 1:
+                for txn2 in cfg.txn():
+                    txn2.release_shard(ctl, 3)
+        assert owners == ['replica-1', None]
+
+    # Revoking leases removes registrations and ownership
+    for txn in cfg.txn():
+        assert txn.list_controller_replicas(ctl) == []
+        assert txn.list_shard_owners(ctl) == {}
+
+
+def test_controller_leader(cfg):
+
+    ctl = 'test_controller'
+    with cfg.lease(ttl=5) as lease1:
+        with cfg.lease(ttl=5) as lease2:
+            for txn in cfg.txn():
+                assert txn.get_controller_leader(ctl) is None
+                txn.claim_controller_leader(ctl, 'replica-1', lease1,
+                                            {'since': 1.0})
+            with pytest.raises(backend.Collision):
+                for txn in cfg.txn():
+                    txn.claim_controller_leader(ctl, 'replica-0', lease2)
+            for txn in cfg.txn():
+                leader = txn.get_controller_leader(ctl)
+                assert leader['replica'] == 'replica-1'
+                assert leader['since'] == 1.0
+                txn.release_controller_leader(ctl)
+            for txn in cfg.txn():
+                txn.claim_controller_leader(ctl, 'replica-0', lease2)
+
+        # Revoking the lease ends leadership
+        for txn in cfg.txn():
+            assert txn.get_controller_leader(ctl) is None
+
+
+def test_pb_wait_for(cfg):
+
+    pb_id = 'test-wait-for-pb'
+    for txn in cfg.txn():
+        txn.create_processing_block(
+            entity.ProcessingBlock(pb_id, None, WORKFLOW))
+
+    # Wait for state to appear, then for a field in a sub-key
+    def write_state():
+        time.sleep(0.2)
+        for txn in cfg.txn():
+            txn.create_processing_block_state(pb_id, {'status': 'RUNNING'})
+        time.sleep(0.2)
+        for txn in cfg.txn():
+            txn.patch_processing_block_state(
+                pb_id, {'receive_addresses': {'scanId': 1}},
+                fields=('receive_addresses',))
+    thread = threading.Thread(target=write_state)
+    thread.start()
+    state, rev = cfg.wait_for_processing_block_state(pb_id, timeout=5)
+    assert state == {'status': 'RUNNING'}
+    state, rev2 = cfg.wait_for_processing_block_state(
+        pb_id, lambda state: 'receive_addresses' in state, timeout=5)
+    assert state['receive_addresses'] == {'scanId': 1}
+    assert rev2.revision > rev.revision
+    thread.join()
+
+    # Plain keys, matching immediately
+    value, _ = cfg.wait_for('/pb/' + pb_id + '/state/receive_addresses')
+    assert value == {'scanId': 1}
+
+    # Timeout and cancellation
+    with pytest.raises(TimeoutError):
+        cfg.wait_for_deployment_status('test-wait-for-dpl', timeout=0.2)
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    with pytest.raises(CancelledError):
+        cfg.wait_for_processing_block_state(
+            pb_id, lambda state: state.get('status') == 'FINISHED',
+            cancel=cancel)
+
 if __name__ == '__main__':
     pytest.main()
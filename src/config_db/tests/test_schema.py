@@ -0,0 +1,48 @@
+"""Tests for the registry of compiled JSON schema validators."""
+
+import json
+import jsonschema
+import pytest
+
+from ska_sdp_config.schema import SchemaRegistry
+
+# pylint: disable=missing-docstring
+
+SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "type": "object",
+    "required": ["id"],
+    "properties": {
+        "id": {"type": "string"},
+        "email": {"type": "string", "format": "email"}
+    }
+}
+
+
+def test_schema_registry(tmp_path):
+
+    with open(tmp_path / 'test.json', 'w') as file:
+        json.dump(SCHEMA, file)
+    (tmp_path / 'README.md').write_text('Not a schema')
+    schemas = SchemaRegistry(str(tmp_path))
+    assert schemas.names == ['test']
+    assert 'test' in schemas and len(schemas) == 1
+
+    # Validators are compiled once and reused
+    assert schemas.get('test') is schemas.get('test')
+    assert schemas.loads('test', '{"id": "a"}') == {'id': 'a'}
+    with pytest.raises(jsonschema.ValidationError):
+        schemas.loads('test', '{"id": 1}')
+    with pytest.raises(json.JSONDecodeError):
+        schemas.loads('test', '{')
+    with pytest.raises(KeyError):
+        schemas.validate('other', {})
+
+    # Formats get checked
+    schemas.validate('test', {'id': 'a', 'email': 'a@example.com'})
+    with pytest.raises(jsonschema.ValidationError):
+        schemas.validate('test', {'id': 'a', 'email': 'example'})
+
+    # Invalid schemas are rejected
+    with pytest.raises(jsonschema.SchemaError):
+        schemas.add('bad', {'type': 'nonsense'})
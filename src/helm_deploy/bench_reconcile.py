@@ -0,0 +1,254 @@
+"""
+Benchmark reconciliation from processing block to Helm release.
+
+Runs the processing controller and the Helm deployment controller in
+one process, against the in-memory configuration backend and the fake
+Helm (`fake_helm.py`) with configurable latency and failure rate. For
+every number of processing blocks given, creates that many real-time
+processing blocks at once and waits until all their workflow releases
+are installed. Every run happens in a fresh subprocess.
+
+Reports end-to-end latency percentiles (processing block created to
+release installed), processing controller passes per second, Helm
+operations and the number of Helm subprocesses started.
+
+Usage:
+  bench_reconcile.py [options] [<pbs>...]
+
+Options:
+  --latency <seconds>      Time fake Helm operations take [default: 0.1]
+  --fail-rate <prob>       Probability of Helm operations failing
+                           [default: 0]
+  --workers <count>        Helm worker threads [default: 4]
+  --retry-delay <seconds>  Delay before retrying failed Helm operations
+                           [default: 1]
+  --timeout <seconds>      Give up waiting after this time [default: 600]
+  --json                   Print results as JSON lines
+  --run <pbs>              Do a single run in this process (internal)
+
+Example:
+  bench_reconcile.py --latency 0.5 --workers 8 10 100 1000
+"""
+
+# pylint: disable=invalid-name,import-outside-toplevel
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import docopt
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+PC_DIR = os.path.join(DIR, '..', 'processing_controller')
+
+WORKFLOW = {'type': 'realtime', 'id': 'bench', 'version': '0.0.1'}
+WORKFLOWS = {
+    'version': {'date-time': '2020-01-01T00:00:00Z'},
+    'repositories': [{'name': 'bench', 'path': 'bench'}],
+    'workflows': [{
+        'type': 'realtime', 'id': 'bench', 'repository': 'bench',
+        'image': 'bench', 'versions': ['0.0.1']
+    }]
+}
+
+
+def percentile(values, pct):
+    """Determine percentile of a sorted list."""
+    return values[min(len(values)-1, int(len(values) * pct / 100))]
+
+
+def setup_environment(args, work_dir):
+    """Create chart repository and workflow definitions, set up environment.
+
+    Has to happen before the controllers get imported, as they read
+    their configuration from the environment at import time.
+    """
+    charts = os.path.join(work_dir, 'charts-src')
+    os.makedirs(os.path.join(charts, 'charts', 'workflow'))
+    with open(os.path.join(charts, 'charts', 'workflow', 'Chart.yaml'),
+              'w') as f:
+        f.write('name: workflow\nversion: 0.0.1\n')
+    for cmd in (['init', '-q'], ['add', '.'],
+                ['-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                 'commit', '-q', '-m', 'Charts']):
+        subprocess.run(['git'] + cmd, cwd=charts, check=True,
+                       stdout=subprocess.DEVNULL)
+    with open(os.path.join(work_dir, 'workflows.json'), 'w') as f:
+        json.dump(WORKFLOWS, f)
+    os.makedirs(os.path.join(work_dir, 'stable'))
+    with open(os.path.join(work_dir, 'stable', 'index.yaml'), 'w') as f:
+        f.write('entries: {}\n')
+
+    os.environ.update({
+        'SDP_CONFIG_BACKEND': 'memory',
+        'SDP_CONFIG_HOST': 'localhost',
+        'SDP_HELM_NAMESPACE': 'sdp',
+        'SDP_LOG_LEVEL': 'WARNING',
+        'SDP_HELM': os.path.join(DIR, 'fake_helm.py'),
+        'SDP_HELM_WORKERS': args['--workers'],
+        'SDP_HELM_RETRY_DELAY': args['--retry-delay'],
+        'SDP_HELM_READY_INTERVAL': '0.1',
+        'SDP_CHART_REPO': charts,
+        'SDP_CHART_REPO_PATH': 'charts',
+        'SDP_CHART_REPO_REF': subprocess.run(
+            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=charts,
+            check=True, stdout=subprocess.PIPE).stdout.decode().strip(),
+        'SDP_WORKFLOWS_URL': 'file://' + os.path.join(work_dir,
+                                                      'workflows.json'),
+        'SDP_WORKFLOWS_CACHE': '',
+        'SDP_PC_SHARDS': '1',
+        'FAKE_HELM_STATE': os.path.join(work_dir, 'helm-state'),
+        'FAKE_HELM_LATENCY': args['--latency'],
+        'FAKE_HELM_FAIL_RATE': args['--fail-rate'],
+        'FAKE_HELM_LOG': os.path.join(work_dir, 'helm-log'),
+    })
+
+
+def start_controllers(work_dir):
+    """Start both controllers in background threads.
+
+    :returns: Lists that will receive the reconciler and Helm pool
+    """
+    sys.path[:0] = [DIR, PC_DIR]
+    import processing_controller
+    import helm_deploy
+
+    # Keep hold of instances to get statistics from
+    reconcilers = []
+    pools = []
+
+    class Reconciler(processing_controller.Reconciler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            reconcilers.append(self)
+
+    class HelmPool(helm_deploy.HelmPool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+
+    processing_controller.Reconciler = Reconciler
+    processing_controller.WORKFLOWS_SCHEMA = os.path.join(
+        PC_DIR, 'workflows_schema.json')
+    helm_deploy.HelmPool = HelmPool
+    helm_deploy.STABLE_REPO = 'file://' + os.path.join(work_dir, 'stable')
+    helm_deploy.chart_base_path = os.path.join(work_dir, 'chart-repo')
+    helm_deploy.VALUES_CACHE = os.path.join(work_dir, 'values-cache')
+
+    for target in (processing_controller.main, helm_deploy.main):
+        threading.Thread(target=target, daemon=True).start()
+    return reconcilers, pools
+
+
+def wait_installed(client, pb_ids, timeout):
+    """Wait until workflow releases of all processing blocks are installed.
+
+    :returns: Dictionary of install time by processing block ID
+    """
+    installed = {}
+    deadline = time.time() + timeout
+    for txn in client.txn():
+        for pb_id in pb_ids:
+            if pb_id in installed:
+                continue
+            status = txn.get_deployment_status(pb_id + '-workflow') or {}
+            if status.get('installed_time') is not None:
+                installed[pb_id] = status['installed_time']
+        if len(installed) < len(pb_ids) and time.time() < deadline:
+            txn.loop(wait=True, timeout=1)
+    return installed
+
+
+def run(args, num_pbs):
+    """Do a single benchmark run.
+
+    :returns: Dictionary of results
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench_reconcile_')
+    setup_environment(args, work_dir)
+    import ska_sdp_config
+    reconcilers, pools = start_controllers(work_dir)
+
+    # Wait for controllers to come up, so start-up is not measured
+    while not reconcilers or not pools:
+        time.sleep(0.1)
+    client = ska_sdp_config.Config()
+
+    # Create processing blocks, in transactions of up to 100
+    start = time.time()
+    created = {}
+    for first in range(0, num_pbs, 100):
+        for txn in client.txn():
+            batch = {}
+            for i in range(first, min(num_pbs, first + 100)):
+                pb_id = 'pb-bench-{:05d}'.format(i)
+                txn.create_processing_block(ska_sdp_config.ProcessingBlock(
+                    pb_id, None, WORKFLOW))
+                batch[pb_id] = time.time()
+        created.update(batch)
+
+    installed = wait_installed(client, list(created),
+                               float(args['--timeout']))
+    elapsed = time.time() - start
+    latencies = sorted(installed[pb_id] - created[pb_id]
+                       for pb_id in installed)
+
+    with open(os.environ['FAKE_HELM_LOG']) as f:
+        commands = {}
+        for line in f:
+            command = line.split()[2]
+            commands[command] = commands.get(command, 0) + 1
+    passes = sum(reconciler.passes for reconciler in reconcilers)
+    return {
+        'pbs': num_pbs,
+        'installed': len(installed),
+        'elapsed': elapsed,
+        'latency_p50': percentile(latencies, 50) if latencies else None,
+        'latency_p90': percentile(latencies, 90) if latencies else None,
+        'latency_p99': percentile(latencies, 99) if latencies else None,
+        'latency_max': latencies[-1] if latencies else None,
+        'pc_passes': passes,
+        'pc_passes_per_s': passes / elapsed,
+        'helm_ops': pools[0].stats(),
+        'helm_subprocesses': commands,
+    }
+
+
+def main():
+    """Run benchmarks, each in its own process."""
+    args = docopt.docopt(__doc__)
+    if args['--run'] is not None:
+        print(json.dumps(run(args, int(args['--run']))))
+        return
+
+    options = ['--latency', args['--latency'],
+               '--fail-rate', args['--fail-rate'],
+               '--workers', args['--workers'],
+               '--retry-delay', args['--retry-delay'],
+               '--timeout', args['--timeout']]
+    if not args['--json']:
+        print("{:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>10}".format(
+            "PBs", "Installed", "Time", "p50", "p90", "p99", "Max",
+            "Passes/s", "Helm procs"))
+    for num_pbs in args['<pbs>'] or ['10', '100']:
+        result = subprocess.run(
+            [sys.executable, __file__, '--run', num_pbs] + options,
+            check=True, stdout=subprocess.PIPE)
+        stats = json.loads(result.stdout.decode().splitlines()[-1])
+        if args['--json']:
+            print(json.dumps(stats))
+            continue
+        print("{:>6} {:>9} {:>7.1f}s {:>7.2f}s {:>7.2f}s {:>7.2f}s {:>7.2f}s "
+              "{:>9.1f} {:>10}".format(
+                  stats['pbs'], stats['installed'], stats['elapsed'],
+                  stats['latency_p50'] or 0, stats['latency_p90'] or 0,
+                  stats['latency_p99'] or 0, stats['latency_max'] or 0,
+                  stats['pc_passes_per_s'],
+                  sum(stats['helm_subprocesses'].values())))
+
+
+if __name__ == '__main__':
+    main()
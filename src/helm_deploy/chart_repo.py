@@ -0,0 +1,287 @@
+"""
+Chart repositories, refreshed in the background.
+
+Charts get taken from a git repository. Instead of pulling on every
+refresh, the commit the remote reference points to gets checked using
+`git ls-remote`, and only fetched if it changed. Charts of every fetched
+commit get extracted into their own directory of a local cache, which
+is swapped in once complete. This way Helm operations that are still
+running keep a consistent set of charts, and going back to a commit
+seen before does not need a fetch at all.
+
+Helm chart repositories (such as "stable") get the same treatment:
+their index gets checked using a conditional request and a digest,
+and `helm repo update` only runs if it changed.
+"""
+
+import os
+import io
+import time
+import shutil
+import hashlib
+import tarfile
+import logging
+import threading
+import subprocess
+import http.client
+import urllib.request
+import urllib.error
+
+log = logging.getLogger('helm_deploy')
+
+
+class HelmRepoIndex:
+    """Index of a Helm chart repository.
+
+    :param name: Name of repository
+    :param url: URL of repository (without "index.yaml")
+    :param update: Called to update the repository if its index changed
+    :param timeout: Timeout for fetching the index, in seconds
+    """
+
+    def __init__(self, name, url, update, timeout=30.0):
+        self.name = name
+        self._url = url.rstrip('/') + '/index.yaml'
+        self._update = update
+        self._timeout = timeout
+        self._etag = None
+        self._last_modified = None
+        self._digest = None
+
+    def refresh(self):
+        """Update the repository, if its index changed.
+
+        :returns: Whether the index changed
+        """
+        request = urllib.request.Request(self._url)
+        if self._etag is not None:
+            request.add_header('If-None-Match', self._etag)
+        if self._last_modified is not None:
+            request.add_header('If-Modified-Since', self._last_modified)
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self._timeout) as f:
+                data = f.read()
+                etag = f.headers.get('ETag')
+                last_modified = f.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                log.error("Cannot fetch index of chart repository {}: {}"
+                          "".format(self.name, e.reason))
+            return False
+        except urllib.error.URLError as e:
+            log.error("Cannot fetch index of chart repository {}: {}".format(
+                self.name, e.reason))
+            return False
+        except (OSError, http.client.HTTPException) as e:
+            # Such as timeouts, or connection lost while reading
+            log.error("Cannot fetch index of chart repository {}: {}".format(
+                self.name, e))
+            return False
+
+        # Not every server supports conditional requests
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self._digest:
+            return False
+        log.info("Index of chart repository {} changed".format(self.name))
+        self._update()
+        self._etag = etag
+        self._last_modified = last_modified
+        self._digest = digest
+        return True
+
+
+class ChartRepository:
+    """Charts from a git repository, cached by commit.
+
+    :param url: URL of git repository
+    :param ref: Reference (branch or tag) to follow
+    :param chart_dir: Directory of charts within the repository
+    :param base_path: Local directory for the repository and cache
+    :param git: Git executable
+    :param timeout: Timeout for git commands, in seconds
+    :param keep: Number of commits to keep charts for
+    :param indexes: List of :class:`HelmRepoIndex` to refresh as well
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, url, ref, chart_dir, base_path, git='git',
+                 timeout=300, keep=3, indexes=()):
+        self._url = url
+        self._ref = ref
+        self._chart_dir = chart_dir
+        self._git_dir = os.path.join(base_path, 'repo.git')
+        self._cache_dir = os.path.join(base_path, 'cache')
+        self._git = git
+        self._timeout = timeout
+        self._keep = keep
+        self._indexes = list(indexes)
+        self._stop = threading.Event()
+        self._thread = None
+
+        #: Commit charts are taken from
+        self.commit = None
+        #: Directory of charts (None if none are available)
+        self.path = None
+        #: Time of last successful refresh, and its duration
+        self.refresh_time = None
+        self.refresh_duration = None
+        #: Number of refreshes, and how many of them fetched
+        self.refreshes = 0
+        self.fetches = 0
+
+        # Use charts of last commit if possible, until refreshed
+        commit = self._local_commit()
+        if commit is not None and \
+                os.path.isdir(os.path.join(self._cache_dir, commit)):
+            self._use(commit)
+
+    def _invoke_git(self, *args):
+        """Invoke git on the local repository.
+
+        :returns: Output of the command, as bytes
+        :raises: `subprocess.CalledProcessError` if command fails
+        """
+        cmd_line = [self._git, '--git-dir', self._git_dir] + list(args)
+        log.debug(" ".join(["$"] + cmd_line))
+        result = subprocess.run(
+            cmd_line, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=self._timeout)
+        if result.returncode != 0:
+            for line in result.stderr.decode().splitlines():
+                log.debug("-> " + line)
+        result.check_returncode()
+        return result.stdout
+
+    def _init(self):
+        """Initialise local repository, if needed."""
+        if os.path.exists(self._git_dir):
+            return
+        log.info("Initialising chart repository in {}".format(
+            self._git_dir))
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._invoke_git('init', '--bare', '-q')
+        self._invoke_git('remote', 'add', 'origin', self._url)
+
+    def _local_commit(self):
+        """Get commit fetched last, or None."""
+        if not os.path.exists(self._git_dir):
+            return None
+        try:
+            out = self._invoke_git('rev-parse', '--verify', '-q',
+                                   'refs/heads/charts')
+        except subprocess.CalledProcessError:
+            return None
+        return out.decode().strip()
+
+    def _remote_commit(self):
+        """Ask the remote which commit the reference points to."""
+        out = self._invoke_git('ls-remote', 'origin', self._ref).decode()
+        for line in out.splitlines():
+            commit, name = line.split('\t', 1)
+            if name in (self._ref, 'refs/heads/' + self._ref,
+                        'refs/tags/' + self._ref):
+                return commit
+        raise ValueError("Reference {} not found in {}!".format(
+            self._ref, self._url))
+
+    def _fetch(self):
+        """Fetch the reference, and record it locally.
+
+        :returns: Commit fetched
+        """
+        self.fetches += 1
+        self._invoke_git('fetch', '-q', '--depth', '1', 'origin', self._ref)
+        commit = self._invoke_git('rev-parse', 'FETCH_HEAD^{commit}')
+        commit = commit.decode().strip()
+        self._invoke_git('update-ref', 'refs/heads/charts', commit)
+        return commit
+
+    def _extract(self, commit):
+        """Extract charts of a commit into the cache."""
+        target = os.path.join(self._cache_dir, commit)
+        if os.path.isdir(target):
+            return
+        data = self._invoke_git('archive', '--format=tar', commit,
+                                self._chart_dir)
+        tmp_dir = target + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            tar.extractall(tmp_dir)
+        os.replace(tmp_dir, target)
+
+    def _use(self, commit):
+        """Switch to charts of a commit."""
+        self.path = os.path.join(self._cache_dir, commit, self._chart_dir)
+        self.commit = commit
+
+    def _prune(self):
+        """Remove charts of old commits from the cache."""
+        entries = [os.path.join(self._cache_dir, name)
+                   for name in os.listdir(self._cache_dir)
+                   if name != self.commit and not name.endswith('.tmp')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[max(0, self._keep - 1):]:
+            log.debug("Removing charts {}".format(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def refresh(self):
+        """Fetch charts, if the remote reference changed.
+
+        :returns: Whether charts changed
+        """
+        start = time.time()
+        self.refreshes += 1
+        try:
+            self._init()
+            commit = self._remote_commit()
+            changed = commit != self.commit
+            if changed:
+                if not os.path.isdir(os.path.join(self._cache_dir, commit)):
+                    commit = self._fetch()
+                self._extract(commit)
+                log.info("Using charts from commit {}".format(commit))
+                self._use(commit)
+                os.utime(os.path.join(self._cache_dir, commit))
+                self._prune()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+                OSError, ValueError, tarfile.TarError) as e:
+            log.error("Could not refresh chart repository: {}".format(e))
+            return False
+
+        for index in self._indexes:
+            try:
+                index.refresh()
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired, OSError):
+                log.error("Could not update chart repository {}!".format(
+                    index.name))
+
+        self.refresh_time = time.time()
+        self.refresh_duration = self.refresh_time - start
+        log.debug("Refreshing charts took {:.2f} s".format(
+            self.refresh_duration))
+        return changed
+
+    def start(self, interval):
+        """Refresh charts in a background thread.
+
+        :param interval: Time between refreshes, in seconds
+        """
+        def run():
+            while not self._stop.wait(interval):
+                # Keep refreshing, whatever goes wrong
+                try:
+                    self.refresh()
+                except Exception:  # pylint: disable=broad-except
+                    log.exception("Refreshing charts failed")
+        self._thread = threading.Thread(
+            target=run, name='chart-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop background refresh."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
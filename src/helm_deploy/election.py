@@ -0,0 +1,176 @@
+"""
+Leader election between replicas of a controller.
+
+Replicas register themselves and compete for a leader key in the
+configuration database, held by their lease. If the leader dies, its
+lease expires, the key disappears and a standby replica takes over.
+Standby replicas watch the leader key, so they notice immediately.
+
+The leader should check leadership within every transaction it acts
+in (see :meth:`LeaderElection.fence`): a leader that lost its lease
+without noticing (e.g. due to a network partition) will then stop
+acting, as the key will have changed.
+"""
+
+import time
+import logging
+import threading
+
+log = logging.getLogger('helm_deploy')
+
+
+class LeaderElection:
+    """Lease-based leader election through the configuration database.
+
+    :param client: Configuration client
+    :param controller: Name of controller
+    :param replica: ID of this replica
+    :param lease: Lease to hold registration and leadership with
+    """
+
+    def __init__(self, client, controller, replica, lease):
+        self._client = client
+        self._controller = controller
+        self.replica = replica
+        self._lease = lease
+
+        #: Election state: "standby" or "leader"
+        self.state = 'standby'
+        #: Replica ID of current leader (as last seen)
+        self.leader = None
+        #: Time this replica became leader
+        self.elected_time = None
+        #: Time from noticing that there is no leader (or from
+        #: starting) to becoming leader. Does not include the time it
+        #: took for the lease of a dead leader to expire.
+        self.failover_duration = None
+        self._vacant_since = time.time()
+
+        for txn in client.txn():
+            txn.register_controller_replica(controller, replica, lease)
+
+    @property
+    def is_leader(self):
+        """Whether this replica is the leader."""
+        return self.state == 'leader'
+
+    def _observe(self, leader):
+        """Record leader seen in the configuration."""
+        replica = None if leader is None else leader['replica']
+        if replica is None and self.leader is not None:
+            self._vacant_since = time.time()
+        if replica != self.leader:
+            log.info("Leader of {}: {}".format(self._controller, replica))
+        self.leader = replica
+
+    def campaign(self):
+        """Try to become leader, if there is none.
+
+        :returns: Whether this replica is the leader
+        """
+        if self.is_leader:
+            return True
+        for txn in self._client.txn():
+            leader = txn.get_controller_leader(self._controller)
+            now = time.time()
+            if leader is None:
+                self._observe(None)
+                txn.claim_controller_leader(
+                    self._controller, self.replica, self._lease,
+                    {'since': now,
+                     'failover_duration': now - self._vacant_since})
+        self._observe(leader)
+        if leader is not None:
+            return False
+        self.state = 'leader'
+        self.leader = self.replica
+        self.elected_time = now
+        self.failover_duration = now - self._vacant_since
+        log.info("Became leader of {} after {:.1f} s".format(
+            self._controller, self.failover_duration))
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for the leader to change (or timeout).
+
+        :param timeout: Maximum time to wait, in seconds
+        """
+        first = True
+        for txn in self._client.txn():
+            leader = txn.get_controller_leader(self._controller)
+            if first and (leader is not None) == (self.leader is not None):
+                first = False
+                txn.loop(wait=True, timeout=timeout)
+        self._observe(leader)
+
+    def notify_lost(self, callback):
+        """Call a function once this replica is no longer the leader.
+
+        Watches the leader key from a background thread, so the
+        function gets called from that thread.
+
+        :param callback: Function to call
+        """
+        path = '/controller/{}/leader'.format(self._controller)
+
+        def run():
+            try:
+                self._client.wait_for(path, lambda leader: (
+                    leader is None or leader['replica'] != self.replica))
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("Could not watch leader of {}: {}".format(
+                    self._controller, e))
+            callback()
+
+        threading.Thread(target=run, name='leader-watch',
+                         daemon=True).start()
+
+    def fence(self, txn):
+        """Check leadership within a transaction.
+
+        The transaction will only commit if leadership did not change.
+
+        :param txn: Transaction
+        :returns: Whether this replica is (still) the leader
+        """
+        leader = txn.get_controller_leader(self._controller)
+        if leader is None or leader['replica'] != self.replica:
+            if self.is_leader:
+                log.error("Lost leadership of {}!".format(self._controller))
+            self.state = 'standby'
+            return False
+        return True
+
+    def check(self):
+        """Check leadership in a transaction of its own.
+
+        For checking before acting outside of transactions (such as
+        running Helm). Leadership might still get lost right after.
+
+        :returns: Whether this replica is (still) the leader
+        """
+        for txn in self._client.txn():
+            is_leader = self.fence(txn)
+        return is_leader
+
+    def resign(self):
+        """Give up leadership."""
+        if not self.is_leader:
+            return
+        for txn in self._client.txn():
+            if self.fence(txn):
+                txn.release_controller_leader(self._controller)
+        self.state = 'standby'
+
+    def status(self):
+        """Get election state, for reporting.
+
+        :returns: Dictionary with state, leader, and time of and time
+            taken by failover
+        """
+        return {
+            'state': self.state,
+            'leader': self.leader,
+            'elected_time': self.elected_time,
+            'failover_duration': self.failover_duration,
+        }
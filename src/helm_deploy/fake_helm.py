@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the `helm` executable, for tests and benchmarks.
+
+Supports the subset of Helm 3 used by the Helm deployment controller.
+Releases are recorded as JSON files in a state directory instead of
+being deployed. Point `SDP_HELM` at this script to use it.
+
+Environment Variables:
+  FAKE_HELM_STATE      State directory (default ./fake-helm-state)
+  FAKE_HELM_LATENCY    Seconds install/upgrade/uninstall take (default 0)
+  FAKE_HELM_FAIL_RATE  Probability of install/upgrade/uninstall failing
+                       (default 0)
+  FAKE_HELM_LOG        File to append a line per invocation to, with
+                       start and end time and arguments
+"""
+
+import os
+import sys
+import json
+import time
+import random
+
+STATE = os.getenv('FAKE_HELM_STATE', 'fake-helm-state')
+LATENCY = float(os.getenv('FAKE_HELM_LATENCY', '0'))
+FAIL_RATE = float(os.getenv('FAKE_HELM_FAIL_RATE', '0'))
+LOG = os.getenv('FAKE_HELM_LOG')
+
+
+def fail(message):
+    """Exit with an error, like Helm does."""
+    print("Error: " + message)
+    sys.exit(1)
+
+
+def parse(args):
+    """Split arguments into positional arguments and options."""
+    positional = []
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-'):
+            if arg in ('--wait', '--install', '--atomic', '-q', '--short'):
+                options[arg] = True
+            else:
+                options.setdefault(arg, []).append(args[i+1])
+                i += 1
+        else:
+            positional.append(arg)
+        i += 1
+    return positional, options
+
+
+def set_value(values, key, value):
+    """Set a dotted key in nested values, as `helm --set` does."""
+    *path, last = key.split('.')
+    for part in path:
+        values = values.setdefault(part, {})
+    values[last] = value
+
+
+def release_values(options):
+    """Determine values given by values files and --set."""
+    values = {}
+    for name in options.get('-f', []) + options.get('--values', []):
+        with open(name) as f:
+            # Values files written by helm_deploy are JSON (valid YAML)
+            values.update(json.load(f))
+    for setting in options.get('--set', []):
+        for item in setting.split(','):
+            key, _, value = item.partition('=')
+            set_value(values, key, value)
+    return values
+
+
+def release_path(namespace, release):
+    """Path of the file recording a release."""
+    return os.path.join(STATE, namespace, release + '.json')
+
+
+def slow_and_flaky(command):
+    """Simulate latency and failures of cluster operations."""
+    time.sleep(LATENCY)
+    if FAIL_RATE > 0 and random.random() < FAIL_RATE:
+        fail("{}: simulated failure".format(command))
+
+
+def install(namespace, release, chart, options, upgrade=False):
+    """Install (or upgrade) a release."""
+    path = release_path(namespace, release)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    revision = 1
+    if os.path.exists(path):
+        if not upgrade:
+            fail("cannot re-use a name that is still in use")
+        with open(path) as f:
+            revision = json.load(f)['revision'] + 1
+    elif upgrade and '--install' not in options:
+        fail('"{}" has no deployed releases'.format(release))
+    slow_and_flaky('install')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'chart': chart, 'values': release_values(options),
+                   'revision': revision}, f)
+    os.replace(tmp_path, path)
+    print("NAME: {}\nNAMESPACE: {}\nSTATUS: deployed\nREVISION: {}".format(
+        release, namespace, revision))
+
+
+def main(args):
+    """Run fake Helm command."""
+    positional, options = parse(args)
+    namespace = options.get('-n', ['default'])[0]
+    command = positional[0] if positional else ''
+
+    if command == 'install':
+        install(namespace, positional[1], positional[2], options)
+    elif command == 'upgrade':
+        install(namespace, positional[1], positional[2], options, True)
+    elif command == 'uninstall':
+        path = release_path(namespace, positional[1])
+        if not os.path.exists(path):
+            fail("uninstall: Release not loaded: {}: release: not found"
+                 .format(positional[1]))
+        slow_and_flaky('uninstall')
+        os.remove(path)
+        print('release "{}" uninstalled'.format(positional[1]))
+    elif command == 'list':
+        directory = os.path.join(STATE, namespace)
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.json'):
+                    print(name[:-len('.json')])
+    elif positional[:2] == ['get', 'values']:
+        path = release_path(namespace, positional[2])
+        if not os.path.exists(path):
+            fail("release: not found")
+        with open(path) as f:
+            print(json.dumps(json.load(f)['values']))
+    elif positional[:2] == ['get', 'manifest']:
+        # Releases of the fake Helm have no Kubernetes objects
+        if not os.path.exists(release_path(namespace, positional[2])):
+            fail("release: not found")
+    elif command == 'repo':
+        pass
+    else:
+        fail("unknown command {}".format(" ".join(positional)))
+
+
+if __name__ == '__main__':
+    START = time.time()
+    try:
+        main(sys.argv[1:])
+    finally:
+        if LOG is not None:
+            with open(LOG, 'a') as log_file:
+                print(START, time.time(), *sys.argv[1:], file=log_file)
@@ -11,15 +11,42 @@ import os
 import time
 import subprocess
 import signal
+import socket
+import threading
+import queue
+import re
 import shutil
+import json
+import hashlib
+import logging
 import ska_sdp_config
 from ska_sdp_logging import core_logging
+from helm_pool import HelmPool
+from chart_repo import ChartRepository, HelmRepoIndex
+from release_status import check_release
+from election import LeaderElection
 from dotenv import load_dotenv
 load_dotenv()
 
 # Load environment
 HELM = shutil.which(os.getenv('SDP_HELM', 'helm'))
 HELM_TIMEOUT = int(os.getenv('SDP_HELM_TIMEOUT', str(300)))
+HELM_WORKERS = int(os.getenv('SDP_HELM_WORKERS', '4'))
+# Time to wait before retrying a failed Helm operation
+HELM_RETRY_DELAY = float(os.getenv('SDP_HELM_RETRY_DELAY', '10'))
+# How long releases may take to become ready, and how often to check
+HELM_READY_TIMEOUT = float(os.getenv('SDP_HELM_READY_TIMEOUT', '600'))
+HELM_READY_INTERVAL = float(os.getenv('SDP_HELM_READY_INTERVAL', '2'))
+# Leader election: replica ID, lease time-to-live, and how often
+# standby replicas refresh their cache of releases
+REPLICA_ID = os.getenv('SDP_HELM_REPLICA_ID',
+                       '{}-{}'.format(socket.gethostname(), os.getpid()))
+LEASE_TTL = int(os.getenv('SDP_HELM_LEASE_TTL', '10'))
+STANDBY_REFRESH = float(os.getenv('SDP_HELM_STANDBY_REFRESH', '30'))
+# Chart value to store deployment content hash in
+HASH_VALUE = 'sdpDeploymentHash'
+# Directory to write values files to
+VALUES_CACHE = os.getenv('SDP_HELM_VALUES_CACHE', 'values-cache')
 HELM_REPO = os.getenv('SDP_HELM_REPO')
 HELM_REPO_CA = os.getenv('SDP_HELM_REPO_CA')
 NAMESPACE = os.getenv('SDP_HELM_NAMESPACE', 'sdp')
@@ -30,13 +57,34 @@ CHART_REPO = os.getenv('SDP_CHART_REPO', 'https://gitlab.com/ska-telescope/sdp-p
 CHART_REPO_REF = os.getenv('SDP_CHART_REPO_REF', 'master')
 CHART_REPO_PATH = os.getenv('SDP_CHART_REPO_PATH', 'src/helm_deploy/charts')
 CHART_REPO_REFRESH = int(os.getenv('SDP_CHART_REFRESH', '300'))
+STABLE_REPO = 'https://kubernetes-charts.storage.googleapis.com/'
 
 # Initialise logger
 log = core_logging.init(name='helm_deploy', level=LOG_LEVEL)
 
-# Where we are going to check out the charts
+# Where we are going to check out the charts. Charts get refreshed in
+# the background, see main()
 chart_base_path = 'chart-repo'
-chart_path = os.path.join(chart_base_path, CHART_REPO_PATH)
+charts = None
+
+# Leader election. Helm operations and status reports only go ahead
+# while this replica is the leader, see main()
+election = None
+
+
+class _NotifyingQueue(queue.Queue):
+    """Queue that sets an event whenever an item gets put.
+
+    Used to wake up the main loop on changes to deployments.
+    """
+
+    def __init__(self, event):
+        super().__init__()
+        self._event = event
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self._event.set()
 
 
 def invoke(*cmd_line, cwd):
@@ -68,35 +116,14 @@ def helm_invoke(*args):
     :returns: Output of the command
     :raises: `subprocess.CalledProcessError` if command returns an error status
     """
-    return invoke(*([HELM] + list(args)), cwd=chart_path)
-
-
-def update_chart_repos():
-    """Update the chart repository."""
-    # Does not exist? Initialise
-    if not os.path.exists(chart_base_path):
-        log.info("Initialising chart repos in {}".format(chart_path))
-        os.mkdir(chart_base_path)
-        invoke(GIT, "init", cwd=chart_base_path)
-        invoke(GIT, "config", "core.sparseCheckout", "true",
-               cwd=chart_base_path)
-        with open(os.path.join(chart_base_path, ".git", "info",
-                               "sparse-checkout"), "w") as f:
-            print(CHART_REPO_PATH, file=f)
-        invoke(GIT, "remote", "add", "origin", CHART_REPO,
-               cwd=chart_base_path)
-        invoke(GIT, "fetch", "--depth", "1", "origin", CHART_REPO_REF,
-               cwd=chart_base_path)
-        invoke(GIT, "checkout", CHART_REPO_REF,
-               cwd=chart_base_path)
-    else:
-        log.info("Refreshing chart repos in {}".format(chart_path))
-        invoke(GIT, "pull", "origin", CHART_REPO_REF,
-               cwd=chart_base_path)
-
-
-def delete_helm(txn, dpl_id):
-    """Delete a Helm deployment."""
+    return invoke(*([HELM] + list(args)), cwd=charts.path)
+
+
+def delete_helm(dpl_id):
+    """Delete a Helm deployment.
+
+    Runs in a worker thread of the Helm pool.
+    """
 
     # Try to delete
     log.info("Delete deployment {}...".format(dpl_id))
@@ -108,121 +135,430 @@ def delete_helm(txn, dpl_id):
         return False # Assume it was already gone
 
 
-def create_helm(txn, dpl_id, deploy):
-    """Create a new Helm deployment."""
+def deployment_hash(deploy):
+    """Determine content hash of a Helm deployment's chart and values."""
+    content = json.dumps({'chart': deploy.args.get('chart'),
+                          'values': deploy.args.get('values', {})},
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def values_tree(values):
+    """Convert dotted keys of values into nested dictionaries.
+
+    Keys like "env.SDP_CONFIG_HOST" were interpreted by `helm --set`,
+    so get the same meaning in values files.
+    """
+    tree = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            value = values_tree(value)
+        *path, last = key.split('.')
+        node = tree
+        for part in path:
+            node = node.setdefault(part, {})
+        if isinstance(value, dict) and isinstance(node.get(last), dict):
+            node[last].update(value)
+        else:
+            node[last] = value
+    return tree
+
+
+def write_values_file(values):
+    """Write values into a file in the values cache.
+
+    Files are named after the hash of their content, so identical
+    values are written only once. JSON is valid YAML, so Helm can
+    read them directly.
+
+    :returns: Path of values file
+    """
+    content = json.dumps(values, sort_keys=True, indent=1).encode()
+    path = os.path.join(os.path.abspath(VALUES_CACHE), "{}.yaml".format(
+        hashlib.sha256(content).hexdigest()))
+    if not os.path.exists(path):
+        os.makedirs(VALUES_CACHE, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+
+def get_release_hash(dpl_id):
+    """Read the deployment hash stored in the values of a release.
+
+    Runs in a worker thread of the Helm pool.
+
+    :returns: Hash, or empty string if not known
+    """
+    out = helm_invoke('get', 'values', dpl_id, '-n', NAMESPACE,
+                      '-o', 'json')
+    values = json.loads(out) or {}
+    return values.get(HASH_VALUE, '')
+
+
+def report_status(client, dpl_id, patch):
+    """Patch the status of a deployment, unless it got deleted.
+
+    Does nothing if this replica is no longer the leader.
+
+    :param client: Configuration client (None to skip reporting)
+    :param patch: Merge patch to apply to status
+    """
+    if client is None:
+        return
+    for txn in client.txn():
+        if election is not None and not election.fence(txn):
+            return
+        if txn.get_deployment(dpl_id) is not None:
+            txn.patch_deployment_status(dpl_id, patch)
+
+
+def create_helm(dpl_id, deploy, upgrade=False, client=None, requested=None):
+    """Create a new Helm deployment, or upgrade an existing one.
+
+    Runs in a worker thread of the Helm pool. The content hash gets
+    stored as a chart value, so that it is known after a restart.
+
+    :param upgrade: Upgrade existing release
+    :param client: Configuration client to report status with
+    :param requested: Time the deployment was requested
+    :returns: Deployment hash, or False if it failed
+    """
 
     # Attempt install
-    log.info("Creating deployment {}...".format(dpl_id))
+    log.info("{} deployment {}...".format(
+        "Upgrading" if upgrade else "Creating", dpl_id))
+    report_status(client, dpl_id, {
+        'phase': 'upgrading' if upgrade else 'installing',
+        'chart': deploy.args.get('chart'),
+        'requested_time': requested,
+        'installed_time': None, 'ready_time': None, 'endpoints': None
+    })
 
     # Build command line
-    cmd = ['install', dpl_id, deploy.args.get('chart'),
-           '-n', NAMESPACE]
+    dpl_hash = deployment_hash(deploy)
+    cmd = [dpl_id, deploy.args.get('chart'), '-n', NAMESPACE]
     if HELM_REPO is not None:
         cmd.extend(['--repo', HELM_REPO])
     if HELM_REPO_CA is not None:
         cmd.extend(['--ca-file', HELM_REPO_CA])
 
-    # Encode any parameters
-    if 'values' in deploy.args and isinstance(deploy.args, dict):
-        val_str = ",".join(["{}={}".format(k,v) for
-                            k,v in deploy.args['values'].items()])
-        cmd.extend(['--set', val_str])
+    # Pass parameters as values file
+    values = deploy.args.get('values')
+    values = values_tree(values) if isinstance(values, dict) else {}
+    values[HASH_VALUE] = dpl_hash
+    try:
+        cmd.extend(['-f', write_values_file(values)])
+    except OSError as e:
+        log.error("Could not write values of deployment {}: {}".format(
+            dpl_id, e))
+        return False
 
     # Make the call
+    out = None
     try:
-        helm_invoke(*cmd)
-        return True
+        out = helm_invoke(*(['upgrade' if upgrade else 'install'] + cmd))
 
     except subprocess.CalledProcessError as e:
 
-        # Already exists? Purge
-        if "already exists" in e.stdout.decode():
+        # Already exists (unknown to us)? Upgrade instead
+        error = e.stdout.decode()
+        if not upgrade and ("already exists" in error or
+                            "still in use" in error):
             try:
-                log.info("Purging deployment {}...".format(dpl_id))
-                helm_invoke('uninstall', dpl_id, '-n', NAMESPACE)
-                txn.loop()  # Force loop, this will cause a re-attempt
-            except subprocess.CalledProcessError:
-                log.error("Could not purge deployment {}!".format(dpl_id))
+                log.info("Upgrading existing deployment {}...".format(dpl_id))
+                out = helm_invoke(*(['upgrade'] + cmd))
+            except subprocess.CalledProcessError as e2:
+                log.error("Could not upgrade deployment {}!".format(dpl_id))
+                error = e2.stdout.decode()
         else:
-            log.error("Could not create deployment {}!".format(dpl_id))
+            log.error("Could not {} deployment {}!".format(
+                "upgrade" if upgrade else "create", dpl_id))
+
+    if out is None:
+        report_status(client, dpl_id, {
+            'phase': 'failed', 'last_error': error.strip(),
+            'last_error_time': time.time()
+        })
+        return False
+
+    revision = re.search(r'^REVISION: *(\d+)', out, re.MULTILINE)
+    report_status(client, dpl_id, {
+        'phase': 'installed',
+        'revision': int(revision.group(1)) if revision else None,
+        'hash': dpl_hash,
+        'installed_time': time.time()
+    })
+    return dpl_hash
+
+
+def probe_helm(dpl_id, client, deadline):
+    """Check whether a release is ready, and report it if so.
+
+    Runs in a worker thread of the Helm pool.
+
+    :param client: Configuration client to report status with
+    :param deadline: Time after which to give up waiting
+    :returns: Whether to stop checking (ready or timed out)
+    """
+    try:
+        manifest = helm_invoke('get', 'manifest', dpl_id, '-n', NAMESPACE)
+        waiting, endpoints = check_release(manifest, NAMESPACE)
+    except Exception as e:  # pylint: disable=broad-except
+        log.warning("Could not check readiness of {}: {}".format(dpl_id, e))
+        waiting, endpoints = [str(e)], None
+
+    now = time.time()
+    if waiting:
+        if now < deadline:
+            return False
+        log.error("Deployment {} not ready in time, waiting for {}".format(
+            dpl_id, ", ".join(waiting)))
+        report_status(client, dpl_id, {
+            'phase': 'failed', 'last_error_time': now,
+            'last_error': "Not ready after {:.0f} s, waiting for {}".format(
+                HELM_READY_TIMEOUT, ", ".join(waiting))
+        })
+        return True
 
-    return False
+    for txn in client.txn():
+        if election is not None and not election.fence(txn):
+            return True
+        status = txn.get_deployment_status(dpl_id) or {}
+        if status.get('phase') == 'ready' or \
+                txn.get_deployment(dpl_id) is None:
+            return True
+        txn.patch_deployment_status(dpl_id, {
+            'phase': 'ready', 'ready_time': now, 'endpoints': endpoints})
+    if status.get('requested_time') is not None:
+        log.info("Deployment {} (chart {}) ready after {:.1f} s".format(
+            dpl_id, status.get('chart'), now - status['requested_time']))
+    return True
+
+
+def refresh_releases(client, pool, deploys):
+    """Update cache of existing releases and their deployment hashes.
+
+    Hashes get taken from deployment statuses of completed
+    installations, and looked up from the release otherwise (in the
+    background, using the Helm pool).
+
+    :param client: Configuration client
+    :param pool: Helm pool
+    :param deploys: Dictionary of deployment hash by release to update
+    :returns: Set of releases not reported as ready
+    """
+    releases = helm_invoke('list', '-q', '-n', NAMESPACE).split('\n')
+    releases = set(releases).difference(set(['']))
+    for dpl_id in set(deploys) - releases:
+        if not pool.busy(dpl_id):
+            del deploys[dpl_id]
+    for txn in client.txn():
+        statuses = {dpl_id: txn.get_deployment_status(dpl_id) or {}
+                    for dpl_id in releases}
+
+    not_ready = set()
+    for dpl_id, status in statuses.items():
+        if status.get('phase') != 'ready':
+            not_ready.add(dpl_id)
+        if status.get('phase') in ('installed', 'ready') and \
+                status.get('hash'):
+            deploys[dpl_id] = status['hash']
+        elif dpl_id not in deploys:
+            deploys[dpl_id] = None
+            pool.submit(dpl_id, 'inspect', get_release_hash, dpl_id)
+    return not_ready
+
+
+# pylint: disable=too-many-arguments
+def reconcile(client, pool, dpl_id, deploy, deploys, waiting, now):
+    """Start Helm operation needed for a deployment, if any.
+
+    :param client: Configuration client
+    :param pool: Helm pool
+    :param dpl_id: Deployment (and release) name
+    :param deploy: Deployment as followed, None if deleted (or invalid)
+    :param deploys: Dictionary of deployment hash by release
+    :param waiting: Readiness deadline and next check time by release
+    :param now: Current time
+    """
 
+    # Deleted? Make sure first, as invalid deployments do not show up
+    # in the change feed either.
+    if deploy is None:
+        if dpl_id not in deploys:
+            return
+        try:
+            for txn in client.txn():
+                exists = txn.get_deployment(dpl_id) is not None
+        except ValueError as e:
+            log.warning("Deployment {} failed validation: {}!".format(
+                dpl_id, str(e)))
+            return
+        if not exists:
+            waiting.pop(dpl_id, None)
+            pool.submit(dpl_id, 'uninstall', delete_helm, dpl_id)
+        return
+
+    # Right type?
+    if deploy.type != 'helm':
+        return
+
+    # Create it, or upgrade if it changed. Otherwise check whether it
+    # became ready, if still waiting for that.
+    if dpl_id not in deploys:
+        pool.submit(dpl_id, 'install', create_helm, dpl_id, deploy,
+                    False, client, now)
+    elif deploys[dpl_id] != deployment_hash(deploy):
+        pool.submit(dpl_id, 'upgrade', create_helm, dpl_id, deploy,
+                    True, client, now)
+    elif dpl_id in waiting and waiting[dpl_id][1] <= now:
+        pool.submit(dpl_id, 'probe', probe_helm, dpl_id, client,
+                    waiting[dpl_id][0])
 
 
 def main():
     """Main loop of Helm controller."""
 
-    # Instantiate configuration
+    # Instantiate configuration, register for leader election
+    global charts, election
     client = ska_sdp_config.Config()
-
-    # TODO: Service lease + leader election
-
-    # Obtain charts
-    update_chart_repos()
-    next_chart_refresh = time.time() + CHART_REPO_REFRESH
-
-    # Load Helm repository
-    helm_invoke("repo", "add", "stable", "https://kubernetes-charts.storage.googleapis.com/")
-    helm_invoke("repo", "update")
+    lease = client.lease(ttl=LEASE_TTL)
+    lease.__enter__()
+    election = LeaderElection(client, 'helm_deploy', REPLICA_ID, lease)
+
+    # Obtain charts, refresh in the background from now on. Helm
+    # repository gets updated only if its index changed.
+    stable = HelmRepoIndex('stable', STABLE_REPO,
+                           lambda: helm_invoke("repo", "update"))
+    charts = ChartRepository(CHART_REPO, CHART_REPO_REF, CHART_REPO_PATH,
+                             chart_base_path, GIT, HELM_TIMEOUT,
+                             indexes=[stable])
+    helm_invoke("repo", "add", "stable", STABLE_REPO)
+    charts.refresh()
+    charts.start(CHART_REPO_REFRESH)
+
+    # Helm operations run in the background, so that slow ones do not
+    # hold up others or stop us from reacting to changes. Operations
+    # changing releases check leadership right before they start. The
+    # main loop gets woken up once they finish.
+    wake = threading.Event()
+    pool = HelmPool(HELM_WORKERS, guard=lambda op: (
+        op.action == 'inspect' or election.check()), notify=wake.set)
+    retry_after = {}
+
+    # Known releases, with content hash of their deployment (None
+    # while not known yet). Standby replicas keep this (and charts)
+    # up to date, so they can take over quickly.
+    deploys = {}
+    while not election.campaign():
+        log.debug("Standing by, leader is {}".format(election.leader))
+        refresh_releases(client, pool, deploys)
+        for op in pool.collect():
+            if op.action == 'inspect' and op.release in deploys:
+                deploys[op.release] = op.result if op.error is None else ''
+        election.wait(STANDBY_REFRESH)
+
+    # Follow deployments, and wake up if leadership gets lost
+    dpl_feed = client.watch_deployments(snapshot=False)
+    dpl_feed.start(_NotifyingQueue(wake))
+    election.notify_lost(wake.set)
 
     # Show
     log.info("Loading helm deployments...")
-
-    # Query helm for active deployments. Filter for active ones.
-    deploys = helm_invoke('list', '-q', '-n', NAMESPACE).split('\n')
-    deploys = set(deploys).difference(set(['']))
+    not_ready = refresh_releases(client, pool, deploys)
     log.info("Found {} existing deployments.".format(len(deploys)))
-
-    # Wait for something to happen
-    for txn in client.txn():
-
-        # Refresh charts?
-        if time.time() > next_chart_refresh:
-            next_chart_refresh = time.time() + CHART_REPO_REFRESH
-
-            try:
-                helm_invoke("repo", "update")
-            except subprocess.CalledProcessError as e:
-                log.error("Could not refresh global chart repository!")
-
-            try:
-                update_chart_repos()
-            except subprocess.CalledProcessError as e:
-                log.error("Could not refresh chart repository!")
-
-        # List deployments
-        target_deploys = txn.list_deployments()
-
-        # Check for deployments that we should delete
-        for dpl_id in list(deploys):
-            if dpl_id not in target_deploys:
-                if delete_helm(txn, dpl_id):
-                    deploys.remove(dpl_id)
-
-        # Check for deployments we should add
-        for dpl_id in target_deploys:
-            if dpl_id not in deploys:
-
-                # Get details
-                try:
-                    deploy = txn.get_deployment(dpl_id)
-                except ValueError as e:
-                    log.warning("Deployment {} failed validation: {}!".format(
-                        dpl_id, str(e)))
-                    continue
-
-                # Right type?
-                if deploy.type != 'helm':
-                    continue
-
-                # Create it
-                if create_helm(txn, dpl_id, deploy):
-                    deploys.add(dpl_id)
-
-        # Loop around, wait if we made no change
-        txn.loop(wait=True, timeout=next_chart_refresh - time.time())
-
+    log.info("Election: {}".format(election.status()))
+
+    # Releases to check readiness of: deadline, and time of next check
+    now = time.time()
+    waiting = {dpl_id: (now + HELM_READY_TIMEOUT, now)
+               for dpl_id in not_ready}
+
+    # Releases and deployments to look at. Only the ones that changed,
+    # had operations finish, or are due for a retry or readiness check
+    # get looked at again.
+    dirty = set(deploys) | set(dpl_feed.entities)
+    while True:
+
+        # Still leader? Stop if not, a standby will take over.
+        if not election.check():
+            break
+
+        # Collect changes, and results of finished operations
+        for event in dpl_feed.poll(0):
+            dirty.add(event.id)
+        for op in pool.collect():
+            dirty.add(op.release)
+            if op.action in ('install', 'upgrade') and op.result:
+                deploys[op.release] = op.result
+                waiting[op.release] = (op.finished + HELM_READY_TIMEOUT,
+                                       op.finished)
+            elif op.action == 'inspect':
+                # Unknown hash will cause an upgrade if still wanted
+                deploys[op.release] = op.result if op.error is None else ''
+                waiting[op.release] = (op.finished + HELM_READY_TIMEOUT,
+                                       op.finished)
+            elif op.action == 'probe':
+                if op.result:
+                    waiting.pop(op.release, None)
+                elif op.release in waiting:
+                    waiting[op.release] = (
+                        waiting[op.release][0],
+                        op.finished + HELM_READY_INTERVAL)
+            elif op.action == 'uninstall' and op.result:
+                deploys.pop(op.release, None)
+            elif not op.cancelled:
+                retry_after[op.release] = time.time() + HELM_RETRY_DELAY
+
+        # Retries and readiness checks that are due
+        now = time.time()
+        for dpl_id, when in list(retry_after.items()):
+            if when <= now:
+                del retry_after[dpl_id]
+                dirty.add(dpl_id)
+        dirty.update(dpl_id for dpl_id, (_, when) in waiting.items()
+                     if when <= now)
+
+        # Operations in flight get looked at again once they finish
+        for dpl_id in dirty:
+            if pool.busy(dpl_id) or dpl_id in retry_after:
+                continue
+            reconcile(client, pool, dpl_id, dpl_feed.entities.get(dpl_id),
+                      deploys, waiting, now)
+
+            # Readiness check not possible right now (e.g. not a Helm
+            # deployment)? Try again later, until the deadline.
+            if dpl_id in waiting and not pool.busy(dpl_id):
+                deadline, when = waiting[dpl_id]
+                if deadline < now:
+                    del waiting[dpl_id]
+                elif when <= now:
+                    waiting[dpl_id] = (deadline, now + HELM_READY_INTERVAL)
+        dirty = set()
+
+        # Wait for something to happen, or the next retry or readiness
+        # check to become due
+        due = list(retry_after.values()) + [
+            when for dpl_id, (_, when) in waiting.items()
+            if not pool.busy(dpl_id)]
+        timeout = max(0.0, min(due) - time.time()) if due else None
+        if pool.in_flight or due:
+            log.debug("{} Helm operations in flight, {} waiting for retry, "
+                      "{} for readiness".format(
+                          pool.in_flight, len(retry_after), len(waiting)))
+        wake.wait(timeout)
+        wake.clear()
+
+    # Lost leadership: cancel queued operations, and do not wait for
+    # those in flight (their status reports are fenced anyway)
+    log.info("Abandoning {} Helm operations in flight".format(
+        pool.in_flight))
+    pool.shutdown(wait=False, cancel=True)
+    logging.shutdown()
+    os._exit(1)  # pylint: disable=protected-access
 
 
 def terminate(signal, frame):
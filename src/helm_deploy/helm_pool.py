@@ -0,0 +1,178 @@
+"""
+Worker pool for Helm operations.
+
+Helm operations can take minutes, so they get run by a bounded pool of
+worker threads instead of the main loop. Operations on the same release
+get run in the order they were submitted, operations on different
+releases run concurrently. The main loop keeps track of which releases
+have work in flight, and collects results once operations finish.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+from ska_sdp_config.hooks import CommitHookExecutor
+
+log = logging.getLogger('helm_deploy')
+
+
+class Operation:
+    """Helm operation submitted to the pool.
+
+    :param release: Release name
+    :param action: Name of the action (such as "install")
+    """
+
+    def __init__(self, release, action):
+        self.release = release
+        self.action = action
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        #: Whether the operation got cancelled before it started
+        self.cancelled = False
+
+    @property
+    def duration(self):
+        """Time the operation took to run, in seconds."""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def wait_time(self):
+        """Time the operation waited for a worker, in seconds."""
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    def __repr__(self):
+        """Build string representation."""
+        return "Operation({}, {})".format(self.action, self.release)
+
+
+class HelmPool:
+    """Bounded pool running Helm operations, serialised per release.
+
+    :param workers: Maximum number of operations to run concurrently
+    :param history: Number of finished operations to keep statistics for
+    :param guard: Called with every operation right before it starts.
+        If it returns False, the operation gets cancelled instead.
+    :param notify: Called (from a worker thread) whenever an operation
+        finished, so the main loop can wait for results
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, workers=4, history=1000, guard=None, notify=None):
+        self._executor = CommitHookExecutor(workers)
+        self._guard = guard
+        self._notify = notify
+        self._cancel = False
+        self._lock = threading.Lock()
+        self._in_flight = {}  # Operations by release
+        self._done = deque()
+        #: Finished operations, most recent last
+        self.history = deque(maxlen=history)
+
+    def submit(self, release, action, function, *args):
+        """Run a Helm operation in the background.
+
+        :param release: Release name the operation acts on
+        :param action: Name of action, for logging and statistics
+        :param function: Function to call
+        :param args: Arguments to pass
+        :returns: :class:`Operation`
+        """
+        operation = Operation(release, action)
+
+        def run():
+            try:
+                operation.cancelled = self._cancel or (
+                    self._guard is not None and not self._guard(operation))
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("Could not check {} of {}: {}".format(
+                    action, release, e))
+                operation.cancelled = True
+            if operation.cancelled:
+                log.info("{} of {} cancelled".format(action, release))
+            else:
+                operation.started = time.time()
+                try:
+                    operation.result = function(*args)
+                except Exception as e:  # pylint: disable=broad-except
+                    log.error("{} of {} failed: {}".format(
+                        action, release, e))
+                    operation.error = e
+            operation.finished = time.time()
+            if not operation.cancelled:
+                log.info("{} of {} took {:.1f} s (waited {:.1f} s)".format(
+                    action, release, operation.duration,
+                    operation.wait_time))
+            with self._lock:
+                ops = self._in_flight.get(release, [])
+                ops.remove(operation)
+                if not ops:
+                    del self._in_flight[release]
+                self._done.append(operation)
+            if not operation.cancelled:
+                self.history.append(operation)
+            if self._notify is not None:
+                self._notify()
+
+        with self._lock:
+            self._in_flight.setdefault(release, []).append(operation)
+        self._executor.submit([release], run)
+        return operation
+
+    def busy(self, release):
+        """Check whether operations on a release are in flight."""
+        with self._lock:
+            return release in self._in_flight
+
+    @property
+    def in_flight(self):
+        """Number of operations submitted but not finished yet."""
+        with self._lock:
+            return sum(len(ops) for ops in self._in_flight.values())
+
+    def collect(self):
+        """Get operations that finished since the last call.
+
+        :returns: List of :class:`Operation`, in order of finishing
+        """
+        with self._lock:
+            done = list(self._done)
+            self._done.clear()
+        return done
+
+    def stats(self):
+        """Get duration statistics of finished operations, by action.
+
+        :returns: Dictionary mapping action to a dictionary with count,
+            failures, and mean and maximum duration
+        """
+        result = {}
+        for operation in list(self.history):
+            stats = result.setdefault(operation.action, {
+                'count': 0, 'failures': 0, 'mean': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            if operation.error is not None or operation.result is False:
+                stats['failures'] += 1
+            stats['mean'] += operation.duration
+            stats['max'] = max(stats['max'], operation.duration)
+        for stats in result.values():
+            stats['mean'] /= stats['count']
+        return result
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop the pool.
+
+        :param wait: Wait for operations in flight to finish
+        :param cancel: Cancel operations that have not started yet
+        """
+        self._cancel = self._cancel or cancel
+        self._executor.shutdown(wait)
@@ -0,0 +1,123 @@
+"""
+Readiness of Helm releases.
+
+Finds the objects of a release from its manifest (`helm get manifest`),
+then asks Kubernetes whether they are ready: services need at least
+one ready endpoint address, deployments and stateful sets need all
+their replicas ready. Services also give the endpoints clients should
+connect to, which get reported in the deployment status.
+"""
+
+import logging
+import yaml
+
+log = logging.getLogger('helm_deploy')
+
+_KUBE_API = None
+
+
+def _kube_api():
+    """Get Kubernetes API client, or None if not available."""
+    global _KUBE_API  # pylint: disable=global-statement
+    if _KUBE_API is None:
+        try:
+            import kubernetes  # pylint: disable=import-outside-toplevel
+            try:
+                kubernetes.config.load_incluster_config()
+            except kubernetes.config.ConfigException:
+                kubernetes.config.load_kube_config()
+            _KUBE_API = kubernetes.client.ApiClient()
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("Cannot check readiness using Kubernetes: {}"
+                        "".format(e))
+            _KUBE_API = False
+    return _KUBE_API or None
+
+
+def manifest_objects(manifest):
+    """Parse objects from a release manifest.
+
+    :param manifest: Manifest, as multi-document YAML
+    :returns: List of objects (as dictionaries)
+    """
+    return [obj for obj in yaml.safe_load_all(manifest)
+            if isinstance(obj, dict) and 'kind' in obj]
+
+
+def _name_and_namespace(obj, namespace):
+    metadata = obj.get('metadata', {})
+    return metadata.get('name'), metadata.get('namespace', namespace)
+
+
+def endpoints(objects, namespace):
+    """Determine endpoints of services of a release.
+
+    :param objects: Objects of release, see :func:`manifest_objects`
+    :param namespace: Namespace of release
+    :returns: List of "host:port" strings
+    """
+    result = []
+    for obj in objects:
+        if obj['kind'] != 'Service':
+            continue
+        name, obj_namespace = _name_and_namespace(obj, namespace)
+        for port in obj.get('spec', {}).get('ports', []):
+            result.append("{}.{}:{}".format(name, obj_namespace,
+                                            port['port']))
+    return result
+
+
+def not_ready(objects, namespace, core_api, apps_api):
+    """Find objects of a release that are not ready yet.
+
+    :param objects: Objects of release, see :func:`manifest_objects`
+    :param namespace: Namespace of release
+    :param core_api: Kubernetes `CoreV1Api`
+    :param apps_api: Kubernetes `AppsV1Api`
+    :returns: List of "kind/name" strings
+    """
+    result = []
+    for obj in objects:
+        kind = obj['kind']
+        name, obj_namespace = _name_and_namespace(obj, namespace)
+        if kind == 'Service':
+            # Services without selector do not get endpoints managed
+            if not obj.get('spec', {}).get('selector'):
+                continue
+            ready = any(subset.addresses for subset in
+                        core_api.read_namespaced_endpoints(
+                            name, obj_namespace).subsets or [])
+        elif kind in ('Deployment', 'StatefulSet'):
+            if kind == 'Deployment':
+                workload = apps_api.read_namespaced_deployment_status(
+                    name, obj_namespace)
+            else:
+                workload = apps_api.read_namespaced_stateful_set_status(
+                    name, obj_namespace)
+            ready = (workload.status.ready_replicas or 0) >= \
+                (workload.spec.replicas or 0)
+        else:
+            continue
+        if not ready:
+            result.append("{}/{}".format(kind, name))
+    return result
+
+
+def check_release(manifest, namespace):
+    """Check readiness of a release.
+
+    If Kubernetes cannot be reached, releases are assumed to be ready.
+
+    :param manifest: Manifest of release
+    :param namespace: Namespace of release
+    :returns: Tuple of list of objects not ready yet, and endpoints
+    """
+    objects = manifest_objects(manifest)
+    api = _kube_api() if objects else None
+    if api is None:
+        return [], endpoints(objects, namespace)
+    import kubernetes  # pylint: disable=import-outside-toplevel
+    waiting = not_ready(objects, namespace,
+                        kubernetes.client.CoreV1Api(api),
+                        kubernetes.client.AppsV1Api(api))
+    return waiting, endpoints(objects, namespace)
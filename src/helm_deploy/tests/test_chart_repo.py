@@ -0,0 +1,155 @@
+"""Tests for chart repository refresh, using a local bare git repository."""
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chart_repo import ChartRepository, HelmRepoIndex  # noqa: E402
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+
+def git(*args, cwd):
+    subprocess.run(['git', '-c', 'user.name=test', '-c',
+                    'user.email=test@example.com'] + list(args),
+                   cwd=cwd, check=True, stdout=subprocess.PIPE)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """Bare repository with a function to commit a chart version to it."""
+    work = tmp_path / 'work'
+    bare = tmp_path / 'remote.git'
+    work.mkdir()
+    git('init', '-q', str(bare), '--bare', cwd=str(tmp_path))
+    git('init', '-q', cwd=str(work))
+    git('checkout', '-q', '-b', 'master', cwd=str(work))
+    git('remote', 'add', 'origin', str(bare), cwd=str(work))
+
+    def commit(version):
+        chart = work / 'charts' / 'test'
+        chart.mkdir(parents=True, exist_ok=True)
+        (chart / 'Chart.yaml').write_text(
+            'name: test\nversion: {}\n'.format(version))
+        (work / 'README').write_text(version)
+        git('add', '.', cwd=str(work))
+        git('commit', '-q', '-m', version, cwd=str(work))
+        git('push', '-q', 'origin', 'master', cwd=str(work))
+
+    commit.url = str(bare)
+    return commit
+
+
+def chart_version(charts):
+    with open(os.path.join(charts.path, 'test', 'Chart.yaml')) as f:
+        return f.read().split()[-1]
+
+
+def test_chart_repo(remote, tmp_path):
+
+    remote('0.1')
+    charts = ChartRepository(remote.url, 'master', 'charts',
+                             str(tmp_path / 'local'))
+    assert charts.path is None
+    assert charts.refresh()
+    assert chart_version(charts) == '0.1'
+    assert charts.fetches == 1
+    assert charts.refresh_time is not None
+    assert charts.refresh_duration >= 0
+
+    # Unchanged remote does not get fetched again
+    assert not charts.refresh()
+    assert charts.fetches == 1
+
+    # New commit gets its own directory, old one stays around
+    old_path = charts.path
+    remote('0.2')
+    assert charts.refresh()
+    assert chart_version(charts) == '0.2'
+    assert charts.fetches == 2
+    assert charts.path != old_path and os.path.isdir(old_path)
+
+    # Only files from the chart directory get extracted
+    assert not os.path.exists(os.path.join(charts.path, '..', 'README'))
+
+    # Restart uses cached charts right away
+    charts = ChartRepository(remote.url, 'master', 'charts',
+                             str(tmp_path / 'local'))
+    assert chart_version(charts) == '0.2'
+    assert not charts.refresh()
+    assert charts.fetches == 0
+
+    # Old charts get pruned
+    for version in ('0.3', '0.4', '0.5'):
+        remote(version)
+        assert charts.refresh()
+    assert not os.path.isdir(old_path)
+    assert len(os.listdir(str(tmp_path / 'local' / 'cache'))) == 3
+
+
+def test_chart_repo_unreachable(tmp_path):
+
+    charts = ChartRepository(str(tmp_path / 'missing.git'), 'master',
+                             'charts', str(tmp_path / 'local'))
+    assert not charts.refresh()
+    assert charts.path is None
+    assert charts.refresh_time is None
+
+
+def test_helm_repo_index(tmp_path):
+
+    (tmp_path / 'index.yaml').write_text('entries: {}\n')
+    updates = []
+    index = HelmRepoIndex('test', (tmp_path).as_uri(),
+                          lambda: updates.append(1))
+    assert index.refresh()
+    assert not index.refresh()
+    (tmp_path / 'index.yaml').write_text('entries: {test: []}\n')
+    assert index.refresh()
+    assert len(updates) == 2
+
+
+def test_helm_repo_index_stalled():
+
+    # Server accepting connections, but never responding
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        index = HelmRepoIndex('test', 'http://127.0.0.1:{}'.format(
+            server.getsockname()[1]), lambda: None, timeout=0.2)
+        start = time.time()
+        assert not index.refresh()
+        assert time.time() - start < 5
+
+
+def test_chart_repo_refresh_failure(remote, tmp_path, monkeypatch):
+
+    # Background refresh survives unexpected failures
+    remote('0.1.0')
+    charts = ChartRepository(remote.url, 'master', 'charts',
+                             str(tmp_path / 'local'))
+    calls = []
+    refresh = charts.refresh
+
+    def fail_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("Unexpected")
+        return refresh()
+    monkeypatch.setattr(charts, 'refresh', fail_once)
+    charts.start(0.05)
+    deadline = time.time() + 10
+    while charts.path is None and time.time() < deadline:
+        time.sleep(0.05)
+    charts.stop()
+    assert len(calls) >= 2
+    assert chart_version(charts) == '0.1.0'
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,70 @@
+"""Tests for leader election between controller replicas."""
+
+import os
+import sys
+import threading
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ska_sdp_config  # noqa: E402
+from election import LeaderElection  # noqa: E402
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+PREFIX = "/__test_election"
+
+
+@pytest.fixture
+def cfg(monkeypatch):
+    monkeypatch.setenv('SDP_CONFIG_BACKEND', 'memory')
+    with ska_sdp_config.Config(global_prefix=PREFIX) as cfg:
+        cfg._backend.delete(PREFIX, must_exist=False, recursive=True)
+        yield cfg
+
+
+def test_election(cfg):
+
+    lease1 = cfg.lease()
+    lease2 = cfg.lease()
+    with lease1, lease2:
+        first = LeaderElection(cfg, 'test', 'replica-1', lease1)
+        second = LeaderElection(cfg, 'test', 'replica-2', lease2)
+
+        # First one to campaign wins
+        assert first.campaign()
+        assert not second.campaign()
+        assert second.leader == 'replica-1'
+        for txn in cfg.txn():
+            assert first.fence(txn)
+            assert not second.fence(txn)
+            leader = txn.get_controller_leader('test')
+        assert leader['replica'] == 'replica-1'
+        assert second.status()['state'] == 'standby'
+
+    # Dead leader gets replaced
+    lease3 = cfg.lease()
+    with lease3:
+        third = LeaderElection(cfg, 'test', 'replica-3', lease3)
+        assert third.campaign()
+        assert third.is_leader
+        assert third.failover_duration >= 0
+        for txn in cfg.txn():
+            assert not first.fence(txn)
+        assert not first.is_leader
+        assert third.check()
+        assert not second.check()
+
+        # Resigning frees the position, which the leader gets notified
+        # of in the background
+        lost = threading.Event()
+        third.notify_lost(lost.set)
+        assert not lost.wait(0.2)
+        third.resign()
+        for txn in cfg.txn():
+            assert txn.get_controller_leader('test') is None
+        assert lost.wait(5)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,116 @@
+"""Tests for the Helm operations worker pool, using the fake Helm."""
+
+import os
+import sys
+import time
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from helm_pool import HelmPool  # noqa: E402
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+FAKE_HELM = os.path.join(os.path.dirname(__file__), '..', 'fake_helm.py')
+
+
+@pytest.fixture
+def fake_helm(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_HELM_STATE', str(tmp_path / 'state'))
+    monkeypatch.setenv('FAKE_HELM_LOG', str(tmp_path / 'log'))
+    monkeypatch.setenv('FAKE_HELM_LATENCY', '0.3')
+
+    def helm(*args):
+        result = subprocess.run(
+            [sys.executable, FAKE_HELM] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return result.returncode == 0
+
+    def log():
+        with open(str(tmp_path / 'log')) as f:
+            return [line.split() for line in f]
+    helm.log = log
+    return helm
+
+
+def test_fake_helm(fake_helm, monkeypatch):
+
+    monkeypatch.setenv('FAKE_HELM_LATENCY', '0')
+    assert fake_helm('install', 'rel', 'chart', '-n', 'sdp',
+                     '--set', 'a.b=1,c=2')
+    assert not fake_helm('install', 'rel', 'chart', '-n', 'sdp')
+    assert fake_helm('uninstall', 'rel', '-n', 'sdp')
+    assert not fake_helm('uninstall', 'rel', '-n', 'sdp')
+    monkeypatch.setenv('FAKE_HELM_FAIL_RATE', '1')
+    assert not fake_helm('install', 'rel', 'chart', '-n', 'sdp')
+
+
+def test_pool_concurrent(fake_helm):
+
+    # Operations on different releases run concurrently
+    pool = HelmPool(workers=4)
+    start = time.time()
+    ops = [pool.submit('rel{}'.format(i), 'install', fake_helm,
+                       'install', 'rel{}'.format(i), 'chart', '-n', 'sdp')
+           for i in range(4)]
+    assert pool.in_flight == 4
+    assert pool.busy('rel0')
+    pool.shutdown()
+    assert time.time() - start < 4 * 0.3
+    assert all(op.result for op in ops)
+    assert not pool.busy('rel0')
+    assert pool.collect() != [] and pool.collect() == []
+
+    stats = pool.stats()
+    assert stats['install']['count'] == 4
+    assert stats['install']['failures'] == 0
+    assert stats['install']['mean'] >= 0.3
+
+
+def test_pool_serialised(fake_helm):
+
+    # Operations on the same release run in submission order,
+    # without overlapping. Each one finishing gets notified.
+    notified = []
+    pool = HelmPool(workers=4, notify=lambda: notified.append(
+        len(pool.collect())))
+    install = pool.submit('rel', 'install', fake_helm,
+                          'install', 'rel', 'chart', '-n', 'sdp')
+    uninstall = pool.submit('rel', 'uninstall', fake_helm,
+                            'uninstall', 'rel', '-n', 'sdp')
+    pool.shutdown()
+    assert install.result and uninstall.result
+    assert uninstall.started >= install.finished
+    (start1, end1, cmd1, *_), (start2, _, cmd2, *_) = fake_helm.log()
+    assert (cmd1, cmd2) == ('install', 'uninstall')
+    assert float(start2) >= float(end1)
+    assert notified == [1, 1]
+
+
+def test_pool_cancel(fake_helm):
+
+    # Operations the guard rejects get cancelled
+    pool = HelmPool(workers=1, guard=lambda op: op.action != 'uninstall')
+    install = pool.submit('rel', 'install', fake_helm,
+                          'install', 'rel', 'chart', '-n', 'sdp')
+    uninstall = pool.submit('rel', 'uninstall', fake_helm,
+                            'uninstall', 'rel', '-n', 'sdp')
+
+    # Shutting down with cancel stops operations that did not start
+    other = pool.submit('rel2', 'install', fake_helm,
+                        'install', 'rel2', 'chart', '-n', 'sdp')
+    while install.started is None:
+        time.sleep(0.01)
+    pool.shutdown(cancel=True)
+    assert install.result and not install.cancelled
+    assert uninstall.cancelled and uninstall.result is None
+    assert other.cancelled and other.started is None
+    assert [cmd for _, _, cmd, *_ in fake_helm.log()] == ['install']
+    assert not pool.busy('rel') and not pool.busy('rel2')
+    assert len(pool.collect()) == 3
+    assert pool.stats()['install']['count'] == 1
+
+
+if __name__ == '__main__':
+    pytest.main()
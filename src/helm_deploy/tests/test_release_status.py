@@ -0,0 +1,99 @@
+"""Tests for readiness checks of Helm releases."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from release_status import manifest_objects, endpoints, \
+    not_ready  # noqa: E402
+
+# pylint: disable=missing-docstring,too-few-public-methods
+
+MANIFEST = """
+---
+# Source: dask/templates/scheduler-service.yaml
+apiVersion: v1
+kind: Service
+metadata:
+  name: test-scheduler
+spec:
+  selector:
+    component: scheduler
+  ports:
+    - name: scheduler
+      port: 8786
+    - name: bokeh
+      port: 80
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: test-external
+  namespace: other
+spec:
+  type: ExternalName
+  externalName: example.com
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: test-worker
+spec:
+  replicas: 2
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: test-config
+"""
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCoreApi:
+    def __init__(self, addresses):
+        self.addresses = addresses
+
+    def read_namespaced_endpoints(self, name, namespace):
+        assert (name, namespace) == ('test-scheduler', 'sdp')
+        return Obj(subsets=[Obj(addresses=self.addresses)])
+
+
+class FakeAppsApi:
+    def __init__(self, ready):
+        self.ready = ready
+
+    def read_namespaced_deployment_status(self, name, namespace):
+        assert (name, namespace) == ('test-worker', 'sdp')
+        return Obj(spec=Obj(replicas=2),
+                   status=Obj(ready_replicas=self.ready))
+
+
+def test_manifest():
+
+    objects = manifest_objects(MANIFEST)
+    assert [obj['kind'] for obj in objects] == \
+        ['Service', 'Service', 'Deployment', 'ConfigMap']
+    assert endpoints(objects, 'sdp') == \
+        ['test-scheduler.sdp:8786', 'test-scheduler.sdp:80']
+    assert manifest_objects('') == []
+
+
+def test_not_ready():
+
+    objects = manifest_objects(MANIFEST)
+    assert not_ready(objects, 'sdp', FakeCoreApi(None), FakeAppsApi(None)) \
+        == ['Service/test-scheduler', 'Deployment/test-worker']
+    assert not_ready(objects, 'sdp', FakeCoreApi(['10.0.0.1']),
+                     FakeAppsApi(1)) == ['Deployment/test-worker']
+    assert not_ready(objects, 'sdp', FakeCoreApi(['10.0.0.1']),
+                     FakeAppsApi(2)) == []
+
+
+if __name__ == '__main__':
+    pytest.main()
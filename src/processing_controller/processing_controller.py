@@ -7,17 +7,42 @@ database.
 
 import os
 import signal
+import socket
 import json
 import time
-import urllib
+import queue
+import threading
+import hashlib
+import http.client
+import urllib.request
+import urllib.error
 import jsonschema
 import ska_sdp_config
+from ska_sdp_config import feed
+from ska_sdp_config.schema import SchemaRegistry
 from ska_sdp_logging import core_logging
+import scheduler
+import sharding
 
 LOG_LEVEL = os.getenv('SDP_LOG_LEVEL', 'DEBUG')
 WORKFLOWS_URL = os.getenv('SDP_WORKFLOWS_URL',
                           'https://gitlab.com/ska-telescope/sdp-prototype/raw/master/src/workflows/workflows.json')
 WORKFLOWS_REFRESH = int(os.getenv('SDP_WORKFLOWS_REFRESH', '300'))
+WORKFLOWS_TIMEOUT = float(os.getenv('SDP_WORKFLOWS_TIMEOUT', '30'))
+WORKFLOWS_CACHE = os.getenv('SDP_WORKFLOWS_CACHE',
+                            '/tmp/sdp_workflows_cache.json') or None
+RESYNC_INTERVAL = int(os.getenv('SDP_PC_RESYNC_INTERVAL', '600'))
+BATCH_CAPACITY = os.getenv('SDP_BATCH_CAPACITY', '')
+BATCH_MAX_RUNNING = int(os.getenv('SDP_BATCH_MAX_RUNNING', '4'))
+BATCH_POLICY = os.getenv('SDP_BATCH_POLICY', 'priority')
+NUM_SHARDS = int(os.getenv('SDP_PC_SHARDS', '16'))
+REPLICA_ID = os.getenv('SDP_PC_REPLICA_ID',
+                       '{}-{}'.format(socket.gethostname(), os.getpid()))
+LEASE_TTL = int(os.getenv('SDP_PC_LEASE_TTL', '10'))
+
+# Processing block states that count as finished.
+
+FINISHED_STATES = {'finished': True, 'failed': False, 'cancelled': False}
 
 # Location of the schema file for validating the workflow definitions.
 
@@ -36,29 +61,13 @@ def get_environment_variables(var: list) -> dict:
     return values
 
 
-def update_workflow_definition(definition_url, schema_file):
-    """Update workflow definitions."""
-
-    # Read schema file.
-    with open(schema_file, 'r') as f:
-        schema = json.load(f)
-
-    # Fetch workflow definition file from URL, parse as JSON and validate
-    # against the schema.
-    LOG.debug('Fetching workflow definitions from %s', definition_url)
-    try:
-        with urllib.request.urlopen(definition_url) as f:
-            definition = json.loads(f.read())
-        jsonschema.validate(definition, schema)
-    except urllib.error.URLError as e:
-        LOG.error('Cannot fetch workflow definitions: %s', e.reason)
-        return {}, {}, {}
-    except json.JSONDecodeError as e:
-        LOG.error('Cannot decode workflow definitions as JSON: %s', e.msg)
-        return {}, {}, {}
-    except jsonschema.ValidationError as e:
-        LOG.error('Cannot validate workflow definitions: %s', e.message)
-        return {}, {}, {}
+def parse_workflow_definition(definition):
+    """Parse validated workflow definitions into lookup tables.
+
+    :param definition: Workflow definition document
+    :returns: Tuple of version, realtime workflow images and batch
+        workflow images (by workflow ID and version)
+    """
 
     # Get version of workflow definition file.
     version = definition['version']
@@ -110,102 +119,687 @@ def update_workflow_definition(definition_url, schema_file):
     return version, realtime, batch
 
 
-def get_pb_id_from_deploy_id(deploy_id: str) -> str:
-    """Get processing block ID from deployment ID.
+class WorkflowDefinitions:
+    """Workflow definitions, refreshed in the background.
 
-    This assumes that all deployments associated with a processing
-    block of ID `[type]-[date]-[number]` have a deployment ID of the
-    form `[type]-[date]-[number]-*`.
+    Definitions get fetched using conditional requests (ETag and
+    Last-Modified headers), so an unchanged document does not get
+    transferred or parsed again. The last good document is kept in an
+    on-disk cache, which gets used at startup and whenever fetching
+    fails. Lookup tables get replaced atomically, so readers always
+    see a consistent set of definitions.
+
+    :param url: URL to fetch definitions from (any URL supported by
+        `urllib`, including `file://`)
+    :param schema_file: Schema to validate definitions against
+    :param cache_file: File to cache definitions in (None to disable)
+    :param on_change: Called from the refresh thread whenever the
+        definitions changed
+    :param timeout: Timeout for fetching definitions, in seconds
     """
-    return '-'.join(deploy_id.split('-')[0:3])
 
+    # pylint: disable=too-many-arguments
+    def __init__(self, url, schema_file, cache_file=None, on_change=None,
+                 timeout=30.0):
+        self._url = url
+        self._timeout = timeout
+        self._cache_file = cache_file
+        self._on_change = on_change
+        self._etag = None
+        self._last_modified = None
+        self._digest = None
+        self._definition = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Compile validator once
+        self._schemas = SchemaRegistry()
+        self._schemas.load('workflows', schema_file)
+
+        #: Tuple of version, realtime and batch workflows, swapped as one
+        self.tables = ({}, {}, {})
+        #: Time of last successful refresh, and its duration
+        self.refresh_time = None
+        self.refresh_duration = None
+
+        self._load_cache()
+
+    @property
+    def version(self):
+        """Version of workflow definitions."""
+        return self.tables[0]
+
+    @property
+    def realtime(self):
+        """Realtime workflow images, by workflow ID and version."""
+        return self.tables[1]
+
+    @property
+    def batch(self):
+        """Batch workflow images, by workflow ID and version."""
+        return self.tables[2]
+
+    def _load_cache(self):
+        """Initialise definitions from the on-disk cache, if possible."""
+        if self._cache_file is None or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, 'rb') as f:
+                data = f.read()
+            cached = json.loads(data)
+            self._install(cached['definition'])
+        except (OSError, ValueError, KeyError,
+                jsonschema.ValidationError) as e:
+            LOG.warning('Cannot use cached workflow definitions: %s', e)
+            return
+        LOG.debug('Using cached workflow definitions from %s',
+                  self._cache_file)
+        self._digest = cached.get('digest')
+        # Validators are only meaningful for the same URL
+        if cached.get('url') == self._url:
+            self._etag = cached.get('etag')
+            self._last_modified = cached.get('last_modified')
+
+    def _save_cache(self):
+        """Write definitions to the on-disk cache, atomically."""
+        if self._cache_file is None or self._definition is None:
+            return
+        cached = {
+            'url': self._url,
+            'etag': self._etag,
+            'last_modified': self._last_modified,
+            'digest': self._digest,
+            'definition': self._definition,
+        }
+        tmp_file = self._cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_file, self._cache_file)
+        except OSError as e:
+            LOG.warning('Cannot write workflow definitions cache: %s', e)
+
+    def _install(self, definition):
+        """Validate definitions and swap in new lookup tables."""
+        self._schemas.validate('workflows', definition)
+        self.tables = parse_workflow_definition(definition)
+        self._definition = definition
+
+    def refresh(self):
+        """Fetch workflow definitions, if they changed.
+
+        :returns: Whether the definitions changed
+        """
+        LOG.debug('Fetching workflow definitions from %s', self._url)
+        start = time.time()
+        request = urllib.request.Request(self._url)
+        if self._etag is not None:
+            request.add_header('If-None-Match', self._etag)
+        if self._last_modified is not None:
+            request.add_header('If-Modified-Since', self._last_modified)
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self._timeout) as f:
+                data = f.read()
+                etag = f.headers.get('ETag')
+                last_modified = f.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                LOG.debug('Workflow definitions not modified')
+                self.refresh_time = time.time()
+                self.refresh_duration = self.refresh_time - start
+                return False
+            LOG.error('Cannot fetch workflow definitions: %s', e.reason)
+            return False
+        except urllib.error.URLError as e:
+            LOG.error('Cannot fetch workflow definitions: %s', e.reason)
+            return False
+        except (OSError, http.client.HTTPException) as e:
+            # Such as timeouts, or connection lost while reading
+            LOG.error('Cannot fetch workflow definitions: %s', e)
+            return False
+
+        # Servers might not support conditional requests (and file://
+        # URLs never do), so compare content as well
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self._digest:
+            LOG.debug('Workflow definitions unchanged')
+            changed = False
+        else:
+            try:
+                definition = json.loads(data)
+                self._install(definition)
+            except json.JSONDecodeError as e:
+                LOG.error('Cannot decode workflow definitions as JSON: %s',
+                          e.msg)
+                return False
+            except UnicodeDecodeError as e:
+                LOG.error('Cannot decode workflow definitions: %s', e)
+                return False
+            except jsonschema.ValidationError as e:
+                LOG.error('Cannot validate workflow definitions: %s',
+                          e.message)
+                return False
+            changed = True
+        if changed or (etag, last_modified) != \
+                (self._etag, self._last_modified):
+            self._etag = etag
+            self._last_modified = last_modified
+            self._digest = digest
+            self._save_cache()
+        self.refresh_time = time.time()
+        self.refresh_duration = self.refresh_time - start
+        return changed
+
+    def start(self, interval):
+        """Refresh definitions in a background thread.
+
+        :param interval: Time between refreshes, in seconds
+        """
+        def run():
+            while True:
+                # Keep refreshing, whatever goes wrong
+                try:
+                    if self.refresh() and self._on_change is not None:
+                        self._on_change()
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception('Refreshing workflow definitions failed')
+                if self._stop.wait(interval):
+                    return
+        self._thread = threading.Thread(
+            target=run, name='workflow-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop background refresh."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
-def main():
-    """Main loop."""
 
-    # Get environment variables to pass to workflow containers.
-    values_env = get_environment_variables(['SDP_CONFIG_HOST',
-                                            'SDP_HELM_NAMESPACE'])
+def get_pb_id_from_deploy_id(deploy_id: str) -> str:
+    """Infer processing block ID from deployment ID.
 
-    # Fetch workflow definitions.
-    workflows_version, workflows_realtime, workflows_batch = \
-        update_workflow_definition(WORKFLOWS_URL, WORKFLOWS_SCHEMA)
-    next_workflows_refresh = time.time() + WORKFLOWS_REFRESH
+    Only used for deployments created before deployments recorded the
+    processing block they belong to. This assumes that all deployments
+    associated with a processing block of ID `[type]-[date]-[number]`
+    have a deployment ID of the form `[type]-[date]-[number]-*`.
 
-    # Connect to configuration database.
-    client = ska_sdp_config.Config()
+    :returns: Processing block ID, or None if the deployment ID does
+        not have that form
+    """
+    parts = deploy_id.split('-')
+    if len(parts) < 4:
+        return None
+    return '-'.join(parts[0:3])
 
-    LOG.debug("Starting main loop...")
-    for txn in client.txn():
 
-        # Update workflow definitions if it is time to do so.
+def migrate_deployment_index(txn):
+    """Add deployments without processing block to the index.
+
+    :param txn: Transaction to use
+    :returns: Number of deployments added
+    """
+    indexed = {deploy_id
+               for deploy_ids in txn.list_deployments_by_pb().values()
+               for deploy_id in deploy_ids}
+    count = 0
+    for deploy_id in txn.list_deployments():
+        if deploy_id in indexed:
+            continue
+        pb_id = get_pb_id_from_deploy_id(deploy_id)
+        deploy = txn.get_deployment(deploy_id)
+        if pb_id is None or deploy is None or deploy.pb_id is not None:
+            continue
+        txn.index_deployment(deploy_id, pb_id)
+        count += 1
+    return count
+
 
-        if time.time() >= next_workflows_refresh:
-            LOG.debug('Updating workflow definitions')
-            workflows_version, workflows_realtime, workflows_batch = \
-                update_workflow_definition(WORKFLOWS_URL, WORKFLOWS_SCHEMA)
-            next_workflows_refresh = time.time() + WORKFLOWS_REFRESH
+class _NotifyingQueue(queue.Queue):
+    """Queue that sets an event whenever an item gets put.
 
-        # Get lists of processing blocks and deployments.
+    Used to wait on multiple change feeds at once.
+    """
 
-        current_pbs = txn.list_processing_blocks()
-        current_deployments = txn.list_deployments()
+    def __init__(self, event):
+        super().__init__()
+        self._event = event
 
-        # Make list of current PBs with deployments, inferred from the deployment IDs.
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self._event.set()
 
-        current_pbs_with_deployment = list(set(map(get_pb_id_from_deploy_id, current_deployments)))
 
-        LOG.debug("Current PBs: {}".format(current_pbs))
-        LOG.debug("Current deployments: {}".format(current_deployments))
-        LOG.debug("Current PBs with deployment: {}".format(current_pbs_with_deployment))
+class Reconciler:
+    """Incrementally reconciles processing blocks and deployments.
 
-        # Delete deployments not associated with processing blocks.
+    Keeps a model of processing blocks and their deployments, which is
+    kept up-to-date using change feeds. Only processing blocks that
+    changed (or whose deployments changed) since the last pass get
+    looked at, so the cost of a pass is proportional to the number of
+    changes, not the number of processing blocks. A periodic full
+    resync acts as a safety net.
 
-        for deploy_id in current_deployments:
-            # Get ID of associated processing block by taking prefix of deployment ID.
-            pb_id = get_pb_id_from_deploy_id(deploy_id)
-            if pb_id not in current_pbs:
-                LOG.info("Deleting deployment {}".format(deploy_id))
-                deploy = txn.get_deployment(deploy_id)
-                txn.delete_deployment(deploy)
+    Batch processing blocks get queued in a scheduler, and get
+    deployed once it dispatches them (see :meth:`dispatch`).
 
-        # Deploy workflow for processing blocks without deployments.
+    If shards are given, only processing blocks in shards owned by
+    this replica get acted on, fenced by checking ownership within the
+    transaction. Batch processing blocks only get scheduled if this
+    replica was elected to do batch admission, fenced by checking
+    leadership.
 
-        for pb_id in current_pbs:
-            if pb_id in current_pbs_with_deployment:
+    :param client: Configuration client
+    :param values_env: Values to pass to workflow Helm charts
+    :param batch_scheduler: Scheduler for batch processing blocks
+    :param shards: :class:`sharding.ShardManager`, or None to act on
+        all processing blocks
+    """
+
+    def __init__(self, client, values_env, batch_scheduler=None,
+                 shards=None):
+        self._client = client
+        self._values_env = values_env
+        self.shards = shards
+        if batch_scheduler is None:
+            batch_scheduler = scheduler.BatchScheduler()
+        self.scheduler = batch_scheduler
+        self._wake = threading.Event()
+        self._pb_feed = client.watch_processing_blocks()
+        self._dpl_feed = client.watch_deployments()
+        self._pb_feed.start(_NotifyingQueue(self._wake))
+        self._dpl_feed.start(_NotifyingQueue(self._wake))
+        self._wake.set()  # Process snapshot
+
+        # Deployment IDs by processing block ID
+        self.deploys_by_pb = {}
+        # Processing blocks to look at in the next pass
+        self.dirty = set()
+        # Dirty processing blocks that could not be acted on in the
+        # last pass, because shard ownership was in flux
+        self.deferred = set()
+        self.resync_requested = False
+
+        # Statistics
+        self.passes = 0
+        self.last_pass_pbs = 0
+        self.last_pass_duration = 0.0
+        self.resyncs = 0
+
+    @property
+    def pbs(self):
+        """Known processing blocks, by ID."""
+        return self._pb_feed.entities
+
+    def close(self):
+        """Stop following changes."""
+        self._pb_feed.close()
+        self._dpl_feed.close()
+
+    def wait(self, timeout=None):
+        """Wait for changes, and update the model.
+
+        :param timeout: Maximum time to wait in seconds
+        :returns: Whether any processing blocks need reconciling
+        """
+        if not self.dirty - self.deferred:
+            self._wake.wait(timeout)
+        self._wake.clear()
+        for event in self._pb_feed.poll(0):
+            if isinstance(event, (feed.Added, feed.Changed, feed.Removed)):
+                self.dirty.add(event.id)
+            if isinstance(event, feed.Removed):
+                self.scheduler.remove(event.id)
+            elif isinstance(event, feed.StateChanged) and event.state:
+                # Finished processing blocks free capacity, and might
+                # satisfy dependencies of batch processing blocks
+                state = event.state.get('state')
+                if state in FINISHED_STATES:
+                    self.scheduler.finished(event.id, time.time(),
+                                            FINISHED_STATES[state])
+        for event in self._dpl_feed.poll(0):
+            if isinstance(event, feed.Removed):
+                self._unindex(event.old)
+            elif isinstance(event, feed.Changed):
+                self._unindex(event.old)
+                self._index(event.obj)
+            else:
+                self._index(event.obj)
+        return bool(self.dirty)
+
+    def _index(self, dpl):
+        if dpl.pb_id is not None:
+            self.deploys_by_pb.setdefault(dpl.pb_id, set()).add(
+                dpl.deploy_id)
+            # Only needs action if the processing block is gone
+            if dpl.pb_id not in self.pbs:
+                self.dirty.add(dpl.pb_id)
+
+    def _unindex(self, dpl):
+        if dpl.pb_id is not None:
+            deploy_ids = self.deploys_by_pb.get(dpl.pb_id, set())
+            deploy_ids.discard(dpl.deploy_id)
+            if not deploy_ids:
+                self.deploys_by_pb.pop(dpl.pb_id, None)
+                # Processing block might need a new deployment
+                if dpl.pb_id in self.pbs:
+                    self.dirty.add(dpl.pb_id)
+
+    def _owns(self, pb_id):
+        return self.shards is None or self.shards.owns(pb_id)
+
+    def _fence(self, txn, pb_id):
+        return self.shards is None or self.shards.fence(txn, pb_id)
+
+    def _admits_batch(self):
+        return self.shards is None or self.shards.is_leader
+
+    def _fence_batch(self, txn):
+        return self.shards is None or self.shards.fence_leader(txn)
+
+    def shards_changed(self):
+        """Adjust to shards or leadership gained or lost by this replica.
+
+        Processing blocks of owned shards get marked dirty, as do all
+        batch processing blocks if this replica does batch admission.
+        Otherwise the scheduler gets emptied.
+        """
+        for pb_id in list(self.pbs) + list(self.deploys_by_pb):
+            if self._owns(pb_id):
+                self.dirty.add(pb_id)
+        if self._admits_batch():
+            self.dirty.update(pb_id for pb_id, pb in self.pbs.items()
+                              if pb.workflow['type'] == 'batch')
+        else:
+            for pb_id in list(self.scheduler.queued) + \
+                    list(self.scheduler.running):
+                self.scheduler.remove(pb_id)
+
+    def resync(self, txn):
+        """Rebuild the index from the database, marking everything dirty.
+
+        :param txn: Transaction to use
+        """
+        self.deploys_by_pb = {
+            pb_id: set(deploy_ids)
+            for pb_id, deploy_ids in txn.list_deployments_by_pb().items()
+        }
+        self.dirty = set(txn.list_processing_blocks())
+        self.dirty.update(self.deploys_by_pb)
+        self.resyncs += 1
+        self.resync_requested = False
+
+    def request_resync(self):
+        """Ask for a full resync in the next pass (thread-safe)."""
+        self.resync_requested = True
+        self._wake.set()
+
+    def reconcile(self, txn, workflows_realtime):
+        """Reconcile all processing blocks marked dirty.
+
+        Might get called repeatedly if the transaction gets retried.
+
+        :param txn: Transaction to use
+        :param workflows_realtime: Realtime workflow images, by ID and
+            version
+        """
+        start = time.time()
+        self.deferred = set()
+        for pb_id in self.dirty:
+            pb = self.pbs.get(pb_id)
+            if pb is not None and pb.workflow['type'] == 'batch':
+                # Batch processing blocks only get dispatched by the
+                # replica doing batch admission (which is fenced)
+                if self._admits_batch():
+                    self._track_batch(txn, pb)
+                continue
+            if not self._owns(pb_id):
+                continue
+            if not self._fence(txn, pb_id):
+                self.deferred.add(pb_id)
+                continue
+            deploy_ids = txn.list_deployments_for_pb(pb_id)
+            if pb is None:
+                # Delete deployments not associated with processing blocks
+                for deploy_id in deploy_ids:
+                    LOG.info("Deleting deployment {}".format(deploy_id))
+                    deploy = txn.get_deployment(deploy_id)
+                    if deploy is not None:
+                        txn.delete_deployment(deploy)
+            elif not deploy_ids:
+                self._deploy_workflow(txn, pb, workflows_realtime)
+        self.passes += 1
+        self.last_pass_pbs = len(self.dirty)
+        self.last_pass_duration = time.time() - start
+
+    def reconciled(self):
+        """Finish a pass, after its transaction committed.
+
+        Processing blocks that could not be acted on stay dirty.
+        """
+        self.dirty = self.deferred
+
+    def _track_batch(self, txn, pb):
+        """Make sure the scheduler knows about a batch processing block."""
+        if pb.pb_id in self.scheduler:
+            return
+        state = self._pb_feed.children['state'].get(pb.pb_id) or {}
+        if state.get('state') in FINISHED_STATES:
+            return
+        job = scheduler.Job.from_pb(pb, time.time(),
+                                    self.scheduler.next_seq())
+        if txn.list_deployments_for_pb(pb.pb_id):
+            # Already dispatched, e.g. before a restart
+            self.scheduler.adopt(job, time.time())
+            return
+        LOG.info("Queueing batch PB {}".format(pb.pb_id))
+        try:
+            self.scheduler.submit(job)
+        except ValueError as e:
+            # Can never run, as it requests more than the capacity
+            LOG.error(str(e))
+            if self._fence_batch(txn):
+                self._fail(txn, pb.pb_id)
+            return
+
+        # Report dependencies that have finished already
+        for dep in job.dependencies:
+            dep_state = self._pb_feed.children['state'].get(dep) or {}
+            if dep_state.get('state') in FINISHED_STATES:
+                self.scheduler.finished(
+                    dep, time.time(), FINISHED_STATES[dep_state['state']])
+
+    @staticmethod
+    def _fail(txn, pb_id):
+        """Mark processing block as failed, if it still exists."""
+        if txn.get_processing_block(pb_id) is not None:
+            txn.patch_processing_block_state(pb_id, {'state': 'failed'})
+
+    def dispatch(self, workflows_batch):
+        """Deploy batch processing blocks the scheduler dispatches.
+
+        :param workflows_batch: Batch workflow images, by ID and version
+        :returns: Number of processing blocks dispatched
+        """
+        now = time.time()
+        dispatch, reject = self.scheduler.schedule(now)
+        if not dispatch and not reject:
+            return 0
+        for job in reject:
+            LOG.error("Dependency of batch PB {} failed".format(job.pb_id))
+            self.scheduler.finished(job.pb_id, now, False)
+        deploys = []
+        dispatched = []
+        for job in dispatch:
+            pb = self.pbs.get(job.pb_id)
+            if pb is None:
+                # Deleted since getting queued
+                self.scheduler.remove(job.pb_id)
                 continue
-            pb = txn.get_processing_block(pb_id)
-            wf_type = pb.workflow['type']
             wf_id = pb.workflow['id']
             wf_version = pb.workflow['version']
-            LOG.info("PB {} has no deployment (workflow type = {}, ID = {}, version = {})"
-                     "".format(pb_id, wf_type, wf_id, wf_version))
-            if wf_type == "realtime":
-                if (wf_id, wf_version) in workflows_realtime:
-                    LOG.info("Deploying realtime workflow ID = {}, version = {}"
-                             "".format(wf_id, wf_version))
-                    wf_image = workflows_realtime[(wf_id, wf_version)]
-                    deploy_id = "{}-workflow".format(pb_id)
-                    # Values to pass to workflow Helm chart.
-                    # Copy environment variable values and add argument values.
-                    values = dict(values_env)
-                    values['wf_image'] = wf_image
-                    values['pb_id'] = pb_id
-                    deploy = ska_sdp_config.Deployment(
-                        deploy_id, 'helm', {'chart': 'workflow', 'values': values}
-                    )
-                    LOG.info("Creating deployment {}".format(deploy_id))
+            if (wf_id, wf_version) not in workflows_batch:
+                LOG.error("Workflow ID = {} version = {} is not supported"
+                          "".format(wf_id, wf_version))
+                reject.append(job)
+                self.scheduler.finished(job.pb_id, now, False)
+                continue
+            LOG.info("Dispatching batch PB {} (workflow ID = {}, "
+                     "version = {}) after {:.1f} s".format(
+                         job.pb_id, wf_id, wf_version, now - job.submitted))
+            deploys.append(self._make_deployment(
+                job.pb_id, workflows_batch[(wf_id, wf_version)]))
+            dispatched.append(job)
+
+        # Processing blocks that cannot run are marked as failed
+        fenced = False
+        for txn in self._client.txn():
+            fenced = self._fence_batch(txn)
+            if not fenced:
+                break
+            for deploy in deploys:
+                if not self._exists(txn, deploy):
                     txn.create_deployment(deploy)
-                else:
-                    # Unknown realtime workflow ID and version.
-                    LOG.error("Workflow ID = {} version = {} is not supported".format(wf_id, wf_version))
-            elif wf_type == "batch":
-                LOG.warning("Batch workflows are not supported at present")
+            for job in reject:
+                self._fail(txn, job.pb_id)
+        if not fenced:
+            # Another replica took over batch admission. Return the
+            # jobs to the queue until rebalancing catches up.
+            LOG.warning("Lost batch admission, not dispatching {} PBs"
+                        "".format(len(dispatched)))
+            for job in dispatched:
+                self.scheduler.requeue(job)
+            return 0
+        return len(deploys)
+
+    def _make_deployment(self, pb_id, wf_image):
+        """Make workflow deployment for processing block."""
+        deploy_id = "{}-workflow".format(pb_id)
+        # Values to pass to workflow Helm chart.
+        # Copy environment variable values and add argument values.
+        values = dict(self._values_env)
+        values['wf_image'] = wf_image
+        values['pb_id'] = pb_id
+        return ska_sdp_config.Deployment(
+            deploy_id, 'helm', {'chart': 'workflow', 'values': values},
+            pb_id=pb_id
+        )
+
+    @staticmethod
+    def _exists(txn, deploy):
+        """Check whether a deployment exists already.
+
+        Might happen if it is not in the index, e.g. because it was
+        created before deployments recorded their processing block.
+        """
+        if txn.get_deployment(deploy.deploy_id) is None:
+            return False
+        LOG.warning("Deployment {} exists already".format(deploy.deploy_id))
+        return True
+
+    def _deploy_workflow(self, txn, pb, workflows_realtime):
+        """Deploy workflow for processing block without deployments."""
+        pb_id = pb.pb_id
+        wf_type = pb.workflow['type']
+        wf_id = pb.workflow['id']
+        wf_version = pb.workflow['version']
+        LOG.info("PB {} has no deployment (workflow type = {}, ID = {}, "
+                 "version = {})".format(pb_id, wf_type, wf_id, wf_version))
+        if wf_type == "realtime":
+            if (wf_id, wf_version) in workflows_realtime:
+                LOG.info("Deploying realtime workflow ID = {}, version = {}"
+                         "".format(wf_id, wf_version))
+                deploy = self._make_deployment(
+                    pb_id, workflows_realtime[(wf_id, wf_version)])
+                if self._exists(txn, deploy):
+                    return
+                LOG.info("Creating deployment {}".format(deploy.deploy_id))
+                txn.create_deployment(deploy)
             else:
-                LOG.error("Unknown workflow type: {}".format(wf_type))
+                # Unknown realtime workflow ID and version.
+                LOG.error("Workflow ID = {} version = {} is not supported"
+                          "".format(wf_id, wf_version))
+        else:
+            LOG.error("Unknown workflow type: {}".format(wf_type))
+
+
+def main():
+    """Main loop."""
+
+    # Get environment variables to pass to workflow containers.
+    values_env = get_environment_variables(['SDP_CONFIG_HOST',
+                                            'SDP_HELM_NAMESPACE'])
+
+    # Connect to configuration database, start following changes.
+    client = ska_sdp_config.Config()
+    batch_scheduler = scheduler.BatchScheduler(
+        scheduler.capacity_from_string(BATCH_CAPACITY), BATCH_MAX_RUNNING,
+        BATCH_POLICY)
+    shards = sharding.ShardManager(client, REPLICA_ID, NUM_SHARDS, LEASE_TTL)
+    reconciler = Reconciler(client, values_env, batch_scheduler, shards)
+
+    # Fetch workflow definitions in the background. Changed
+    # definitions might affect any processing block, so resync.
+    workflows = WorkflowDefinitions(
+        WORKFLOWS_URL, WORKFLOWS_SCHEMA, WORKFLOWS_CACHE,
+        on_change=reconciler.request_resync, timeout=WORKFLOWS_TIMEOUT)
+    workflows.start(WORKFLOWS_REFRESH)
+    next_resync = time.time()
+    next_rebalance = time.time()
+
+    LOG.debug("Starting main loop...")
+    while True:
+
+        # Rebalance shards between replicas. Replicas that died drop
+        # out once their lease expires.
+
+        if time.time() >= next_rebalance:
+            old_shards = (set(shards.owned), shards.is_leader)
+            shards.rebalance()
+            if (shards.owned, shards.is_leader) != old_shards:
+                reconciler.shards_changed()
+            next_rebalance = time.time() + LEASE_TTL / 2
+
+        # Periodically do a full resync as a safety net
+
+        if time.time() >= next_resync or reconciler.resync_requested:
+            LOG.debug('Full resync')
+            for txn in client.txn():
+                migrated = migrate_deployment_index(txn)
+            if migrated:
+                LOG.info("Added {} deployments to index".format(migrated))
+            for txn in client.txn():
+                reconciler.resync(txn)
+            next_resync = time.time() + RESYNC_INTERVAL
+
+        # Reconcile processing blocks that changed
+
+        if reconciler.dirty:
+            workflows_realtime = workflows.realtime
+            for txn in client.txn():
+                reconciler.reconcile(txn, workflows_realtime)
+            LOG.debug("Reconciled {} PBs in {:.1f} ms (pass {})".format(
+                reconciler.last_pass_pbs,
+                1000 * reconciler.last_pass_duration, reconciler.passes))
+            reconciler.reconciled()
+
+            # Shard ownership changed under us, so rebalance soon
+            if reconciler.deferred:
+                LOG.info("Deferring {} PBs".format(len(reconciler.deferred)))
+                next_rebalance = min(next_rebalance, time.time() + 1)
+
+        # Dispatch queued batch processing blocks
+
+        if batch_scheduler.queued:
+            if reconciler.dispatch(workflows.batch):
+                LOG.debug("Batch scheduler: {}".format(
+                    batch_scheduler.metrics(time.time())))
 
         LOG.debug("Waiting...")
-        txn.loop(wait=True, timeout=next_workflows_refresh - time.time())
+        reconciler.wait(max(0, min(next_resync, next_rebalance) -
+                               time.time()))
 
 
 def terminate(signal, frame):
@@ -0,0 +1,308 @@
+"""
+Batch processing block scheduler.
+
+Batch processing blocks get queued, and dispatched once their
+dependencies have finished and the cluster has capacity for them. The
+scheduler does not talk to the configuration database itself, and
+takes the current time as a parameter, so the same code can be driven
+by the processing controller or by an offline simulation (see
+`simulate_scheduler.py`).
+
+Capacity is modelled as a number of named resources (such as "cpu" or
+"memory"). Processing blocks request resources using the "resources"
+workflow parameter, and get ordered using the "priority" parameter
+(higher first), then first-in first-out.
+"""
+
+import json
+from collections import deque
+
+#: Scheduling policies
+POLICIES = ('fifo', 'priority', 'backfill')
+
+
+def capacity_from_string(text):
+    """Parse a capacity specification.
+
+    :param text: JSON object mapping resource name to amount, e.g.
+        '{"cpu": 16, "memory": 64}'. Empty means unlimited.
+    :returns: Dictionary of resource amounts
+    """
+    if not text:
+        return {}
+    capacity = json.loads(text)
+    if not isinstance(capacity, dict):
+        raise ValueError("Capacity must be a JSON object!")
+    return {name: float(amount) for name, amount in capacity.items()}
+
+
+class Job:
+    """Batch processing block tracked by the scheduler.
+
+    :param pb_id: Processing block ID
+    :param priority: Priority, higher gets dispatched first
+    :param resources: Resources required, by name
+    :param dependencies: IDs of processing blocks to wait for
+    :param submitted: Time the job was queued
+    :param seq: Submission sequence number (for FIFO order)
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, pb_id, priority, resources, dependencies,
+                 submitted, seq):
+        self.pb_id = pb_id
+        self.priority = priority
+        self.resources = resources
+        self.dependencies = dependencies
+        self.submitted = submitted
+        self.seq = seq
+        self.dispatched = None
+
+    @classmethod
+    def from_pb(cls, pb, submitted, seq):
+        """Create job from a processing block.
+
+        :param pb: Processing block
+        :param submitted: Time the job was queued
+        :param seq: Submission sequence number
+        """
+        params = pb.parameters
+        deps = [dep['pbId'] for dep in pb.dependencies]
+        return cls(pb.pb_id, params.get('priority', 0),
+                   dict(params.get('resources', {})), deps, submitted, seq)
+
+    def sort_key(self, policy):
+        """Key to order queued jobs by under the given policy."""
+        if policy == 'fifo':
+            return (self.seq,)
+        return (-self.priority, self.seq)
+
+
+class BatchScheduler:
+    """Queues batch processing blocks and decides when to dispatch.
+
+    Policies:
+
+    - `fifo`: submission order, the first job waits until it fits
+    - `priority`: priority, then submission order; the first job waits
+      until it fits
+    - `backfill`: like `priority`, but later jobs may start if they
+      fit while the first job is waiting for capacity
+
+    :param capacity: Available resources, by name. Resources not
+        listed are unlimited.
+    :param max_running: Maximum number of jobs running at once
+    :param policy: Scheduling policy, see :data:`POLICIES`
+    :param window: Time window for throughput, in seconds
+    """
+
+    def __init__(self, capacity=None, max_running=4, policy='priority',
+                 window=3600.0):
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy {}!".format(policy))
+        self.capacity = dict(capacity or {})
+        self.max_running = max_running
+        self.policy = policy
+        self._window = window
+        self._seq = 0
+
+        #: Queued jobs, by processing block ID
+        self.queued = {}
+        #: Running jobs, by processing block ID
+        self.running = {}
+        #: Resources in use, by name
+        self.used = {name: 0.0 for name in self.capacity}
+        # Processing blocks that have finished (ID -> success), as
+        # long as queued jobs depend on them
+        self._done = {}
+
+        # Statistics
+        self.dispatched_total = 0
+        self.completed_total = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._completions = deque()
+
+    def __contains__(self, pb_id):
+        """Check whether a processing block is queued or running."""
+        return pb_id in self.queued or pb_id in self.running
+
+    def submit(self, job):
+        """Queue a job. Ignored if it is already known.
+
+        Dependencies that finished before the job got queued need to
+        be reported using :meth:`finished` afterwards.
+
+        :param job: :class:`Job` to queue
+        """
+        if job.pb_id in self:
+            return
+        for name, amount in job.resources.items():
+            if amount > self.capacity.get(name, amount):
+                raise ValueError(
+                    "Processing block {} requests more {} ({}) than "
+                    "available ({})!".format(job.pb_id, name, amount,
+                                             self.capacity[name]))
+        self.queued[job.pb_id] = job
+
+    def next_seq(self):
+        """Get next submission sequence number."""
+        self._seq += 1
+        return self._seq
+
+    def adopt(self, job, now):
+        """Register a job that is already running (e.g. after restart).
+
+        :param job: :class:`Job` that was dispatched earlier
+        :param now: Current time
+        """
+        self._unqueue(job.pb_id)
+        if job.pb_id not in self.running:
+            job.dispatched = now
+            self._start(job)
+
+    def _unqueue(self, pb_id):
+        """Remove a job from the queue, if it is queued.
+
+        Forgets whether its dependencies finished, unless other queued
+        jobs depend on them as well.
+        """
+        job = self.queued.pop(pb_id, None)
+        if job is None:
+            return
+        for dep in job.dependencies:
+            if not any(dep in other.dependencies
+                       for other in self.queued.values()):
+                self._done.pop(dep, None)
+
+    def _start(self, job):
+        self.running[job.pb_id] = job
+        for name, amount in job.resources.items():
+            if name in self.used:
+                self.used[name] += amount
+
+    def _release(self, job):
+        for name, amount in job.resources.items():
+            if name in self.used:
+                self.used[name] -= amount
+
+    def finished(self, pb_id, now, success=True):
+        """Record that a processing block has finished.
+
+        Works for any processing block, so batch processing blocks
+        can depend on real-time ones. Queued processing blocks (e.g.
+        cancelled before getting dispatched) get removed from the
+        queue. The outcome is only remembered while queued jobs
+        depend on it.
+
+        :param pb_id: Processing block ID
+        :param now: Current time
+        :param success: Whether it finished successfully
+        """
+        self._unqueue(pb_id)
+        if any(pb_id in job.dependencies for job in self.queued.values()):
+            self._done[pb_id] = success
+        job = self.running.pop(pb_id, None)
+        if job is not None:
+            self._release(job)
+            self.completed_total += 1
+            self._completions.append(now)
+
+    def remove(self, pb_id):
+        """Stop tracking a processing block (e.g. because it was deleted).
+
+        Whether it finished is still remembered, as other processing
+        blocks might depend on it.
+        """
+        self._unqueue(pb_id)
+        job = self.running.pop(pb_id, None)
+        if job is not None:
+            self._release(job)
+
+    def requeue(self, job):
+        """Return a dispatched job to the queue.
+
+        Used if dispatching failed, e.g. because the deployment could
+        not be created.
+
+        :param job: :class:`Job` returned by :meth:`schedule`
+        """
+        if self.running.pop(job.pb_id, None) is None:
+            return
+        self._release(job)
+        self.dispatched_total -= 1
+        self.wait_total -= job.dispatched - job.submitted
+        job.dispatched = None
+        self.queued[job.pb_id] = job
+        # Dependencies had all succeeded for it to get dispatched
+        for dep in job.dependencies:
+            self._done[dep] = True
+
+    def _fits(self, job):
+        return all(self.used[name] + job.resources.get(name, 0) <=
+                   self.capacity[name] for name in self.capacity)
+
+    def schedule(self, now):
+        """Decide which queued jobs to dispatch.
+
+        :param now: Current time
+        :returns: Tuple of lists of jobs to dispatch, and jobs to
+            reject because a dependency failed
+        """
+        dispatch = []
+        reject = []
+        order = sorted(self.queued.values(),
+                       key=lambda job: job.sort_key(self.policy))
+        for job in order:
+            if len(self.running) >= self.max_running:
+                break
+
+            # Dependencies finished?
+            if any(self._done.get(dep) is False for dep in job.dependencies):
+                self._unqueue(job.pb_id)
+                reject.append(job)
+                continue
+            if not all(self._done.get(dep) for dep in job.dependencies):
+                continue
+
+            # Enough resources?
+            if not self._fits(job):
+                if self.policy == 'backfill':
+                    continue
+                break
+
+            self._unqueue(job.pb_id)
+            job.dispatched = now
+            self._start(job)
+            dispatch.append(job)
+            wait = now - job.submitted
+            self.dispatched_total += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        return dispatch, reject
+
+    def metrics(self, now):
+        """Get scheduler metrics.
+
+        :param now: Current time
+        :returns: Dictionary with queue depth, number of running jobs,
+            mean and maximum wait time, total completed, throughput
+            (jobs completed per second over the window) and
+            utilisation of every resource
+        """
+        while self._completions and \
+                self._completions[0] < now - self._window:
+            self._completions.popleft()
+        return {
+            'queue_depth': len(self.queued),
+            'running': len(self.running),
+            'wait_mean': (self.wait_total / self.dispatched_total
+                          if self.dispatched_total else 0.0),
+            'wait_max': self.wait_max,
+            'completed': self.completed_total,
+            'throughput': len(self._completions) / self._window,
+            'utilisation': {
+                name: self.used[name] / amount if amount else 0.0
+                for name, amount in self.capacity.items()
+            },
+        }
@@ -0,0 +1,232 @@
+"""
+Partitioning of processing blocks between processing controller replicas.
+
+Processing block IDs get hashed onto a fixed number of shards. Every
+replica registers itself in the configuration database, and owns a
+set of shards, both held by the replica's lease: if a replica dies,
+its lease expires and the remaining replicas take over its shards.
+
+Shards get assigned to replicas using rendezvous hashing with a
+balance limit, so every replica can work out the same assignment
+independently, and only few shards move when replicas come or go.
+Replicas only release shards they should no longer own, and only claim
+shards that are free, so a shard is never owned twice. On top of
+that, reading the shard owner inside every transaction that acts on a
+processing block fences against a replica that lost ownership without
+noticing yet: the transaction fails to commit and gets repeated.
+
+Admission of batch processing blocks needs a view of the capacity of
+the whole cluster, so it is not sharded. Instead, one replica gets
+elected to do it for all processing blocks, fenced the same way using
+the controller's leader key.
+
+If the lease of a replica expires anyway (for example because it could
+not reach the database for a while), or its state cannot be checked,
+the replica drops its shards and leadership, and registers again using
+a new lease.
+"""
+
+import hashlib
+import logging
+
+LOG = logging.getLogger('processing_controller')
+
+
+def _hash(text):
+    """Stable hash of a string (unlike `hash`, not salted per process)."""
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], 'big')
+
+
+def shard_of(pb_id, num_shards):
+    """Determine shard a processing block belongs to.
+
+    :param pb_id: Processing block ID
+    :param num_shards: Number of shards
+    :returns: Shard index
+    """
+    return _hash(pb_id) % num_shards
+
+
+def assign_shards(num_shards, replicas):
+    """Assign shards to replicas.
+
+    Every shard goes to the replica ranking highest for it that has not
+    reached its fair share yet.
+
+    :param num_shards: Number of shards
+    :param replicas: List of replica IDs
+    :returns: Dictionary mapping shard index to replica ID
+    """
+    if not replicas:
+        return {}
+    limit = -(-num_shards // len(replicas))
+    counts = {replica: 0 for replica in replicas}
+    assignment = {}
+    for shard in range(num_shards):
+        ranked = sorted(replicas, reverse=True, key=lambda replica: _hash(
+            "{}/{}".format(shard, replica)))
+        for replica in ranked:
+            if counts[replica] < limit:
+                assignment[shard] = replica
+                counts[replica] += 1
+                break
+    return assignment
+
+
+class ShardManager:
+    """Tracks and rebalances shard ownership of one replica.
+
+    :param client: Configuration client
+    :param replica: ID of this replica
+    :param num_shards: Number of shards
+    :param lease_ttl: Time to live of the lease holding registration,
+        ownership and leadership, in seconds
+    :param controller: Name of controller
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, client, replica, num_shards, lease_ttl=10,
+                 controller='processing_controller'):
+        self._client = client
+        self.replica = replica
+        self.num_shards = num_shards
+        self._lease_ttl = lease_ttl
+        self._lease = None
+        self._controller = controller
+        #: Shards owned by this replica
+        self.owned = set()
+        #: Whether this replica does batch admission
+        self.is_leader = False
+        self.rebalances = 0
+        self.registrations = 0
+
+    def _ensure_lease(self):
+        """Get a live lease, replacing it if it expired.
+
+        Failing to check the lease counts as it having expired.
+
+        :raises: Whatever granting a new lease raises
+        """
+        if self._lease is not None:
+            try:
+                if self._lease.alive():
+                    return self._lease
+                LOG.error("Lease of replica {} expired, registering again"
+                          "".format(self.replica))
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.error("Could not check lease of replica {}, "
+                          "registering again: {}".format(self.replica, e))
+            self._drop_lease()
+        lease = self._client.lease(ttl=self._lease_ttl)
+        lease.__enter__()
+        self._lease = lease
+        return lease
+
+    def _drop_lease(self):
+        """Release the lease (stopping its keep-alive), and everything
+        held by it."""
+        lease, self._lease = self._lease, None
+        self.owned = set()
+        self.is_leader = False
+        if lease is None:
+            return
+        try:
+            lease.__exit__(None, None, None)
+        except Exception as e:  # pylint: disable=broad-except
+            # Most likely expired already
+            LOG.warning("Could not revoke lease of replica {}: {}".format(
+                self.replica, e))
+
+    def close(self):
+        """Give up registration, shards and leadership."""
+        self._drop_lease()
+
+    def rebalance(self):
+        """Release and claim shards to match the current replica set.
+
+        Also registers the replica if needed, and competes for
+        leadership.
+
+        :returns: Set of newly gained shards
+        """
+        try:
+            lease = self._ensure_lease()
+        except Exception as e:  # pylint: disable=broad-except
+            # Try again at the next rebalance, owning nothing meanwhile
+            LOG.error("Could not get lease for replica {}: {}".format(
+                self.replica, e))
+            self._drop_lease()
+            return set()
+        for txn in self._client.txn():
+            replicas = txn.list_controller_replicas(self._controller)
+            register = self.replica not in replicas
+            if register:
+                txn.register_controller_replica(
+                    self._controller, self.replica, lease)
+                replicas = sorted(replicas + [self.replica])
+            owners = txn.list_shard_owners(self._controller)
+            target = assign_shards(self.num_shards, replicas)
+            owned = set()
+            for shard in range(self.num_shards):
+                owner = owners.get(shard)
+                if owner == self.replica:
+                    if target.get(shard) == self.replica:
+                        owned.add(shard)
+                    else:
+                        txn.release_shard(self._controller, shard)
+                elif owner is None and target.get(shard) == self.replica:
+                    txn.claim_shard(self._controller, shard, self.replica,
+                                    lease)
+                    owned.add(shard)
+            leader = txn.get_controller_leader(self._controller)
+            if leader is None:
+                txn.claim_controller_leader(self._controller, self.replica,
+                                            lease)
+                is_leader = True
+            else:
+                is_leader = leader['replica'] == self.replica
+        if register:
+            self.registrations += 1
+        gained = owned - self.owned
+        lost = self.owned - owned
+        if gained or lost:
+            self.rebalances += 1
+            LOG.info("Shards of replica {}: {} (gained {}, lost {})".format(
+                self.replica, sorted(owned), sorted(gained), sorted(lost)))
+        if is_leader != self.is_leader:
+            LOG.info("Replica {} {} batch admission".format(
+                self.replica, "took over" if is_leader else "stopped"))
+        self.owned = owned
+        self.is_leader = is_leader
+        return gained
+
+    def owns(self, pb_id):
+        """Check whether a processing block is in an owned shard.
+
+        Only reflects the last rebalance, use :meth:`fence` in
+        transactions acting on the processing block.
+        """
+        return shard_of(pb_id, self.num_shards) in self.owned
+
+    def fence(self, txn, pb_id):
+        """Check ownership of a processing block within a transaction.
+
+        The transaction will only commit if ownership did not change.
+
+        :param txn: Transaction
+        :param pb_id: Processing block ID
+        :returns: Whether this replica owns the processing block
+        """
+        shard = shard_of(pb_id, self.num_shards)
+        return txn.get_shard_owner(self._controller, shard) == self.replica
+
+    def fence_leader(self, txn):
+        """Check leadership within a transaction.
+
+        The transaction will only commit if leadership did not change.
+
+        :param txn: Transaction
+        :returns: Whether this replica does batch admission
+        """
+        leader = txn.get_controller_leader(self._controller)
+        return leader is not None and leader['replica'] == self.replica
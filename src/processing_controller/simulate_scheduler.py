@@ -0,0 +1,132 @@
+"""
+Offline simulation of batch scheduling policies.
+
+Generates a random workload of batch processing blocks (arrival
+times, durations, resource requests, priorities and dependencies),
+then replays it against the batch scheduler once per policy, using
+simulated time. Reports wait times (overall and for high-priority
+processing blocks), makespan, throughput and mean resource
+utilisation.
+
+Usage:
+  simulate_scheduler.py [options]
+
+Options:
+  --pbs <count>          Number of processing blocks [default: 500]
+  --arrival <seconds>    Mean time between arrivals [default: 60]
+  --duration <seconds>   Mean processing time [default: 600]
+  --capacity <json>      Cluster capacity [default: {"cpu": 32}]
+  --max-cpu <amount>     Maximum CPUs requested per PB [default: 16]
+  --max-running <count>  Maximum PBs running at once [default: 8]
+  --dependency <prob>    Probability of depending on an earlier PB
+                         [default: 0.2]
+  --seed <seed>          Random seed [default: 1]
+"""
+
+# pylint: disable=invalid-name
+
+import heapq
+import random
+import docopt
+import scheduler
+
+
+def make_workload(args):
+    """Generate list of (arrival, duration, job) tuples."""
+    rng = random.Random(int(args['--seed']))
+    workload = []
+    arrival = 0.0
+    for i in range(int(args['--pbs'])):
+        arrival += rng.expovariate(1 / float(args['--arrival']))
+        duration = rng.expovariate(1 / float(args['--duration']))
+        deps = []
+        if workload and rng.random() < float(args['--dependency']):
+            deps.append(rng.choice(workload[-10:])[2].pb_id)
+        job = scheduler.Job(
+            'pb-sim-{:05d}'.format(i), rng.choice([0, 0, 0, 1]),
+            {'cpu': rng.randint(1, int(args['--max-cpu']))}, deps,
+            arrival, i)
+        workload.append((arrival, duration, job))
+    return workload
+
+
+def percentile(values, pct):
+    """Determine percentile of a sorted list."""
+    return values[min(len(values)-1, int(len(values) * pct / 100))]
+
+
+def simulate(workload, capacity, max_running, policy):
+    """Run workload through the scheduler, return statistics."""
+    sched = scheduler.BatchScheduler(capacity, max_running, policy)
+    durations = {job.pb_id: duration for _, duration, job in workload}
+    # Events are (time, order, kind, job)
+    events = [(arrival, job.seq, 'submit', job)
+              for arrival, _, job in workload]
+    heapq.heapify(events)
+    # Outcome of finished jobs, reported to dependents queued later
+    finished = {}
+    waits = []
+    high_waits = []
+    busy = 0.0
+    now = 0.0
+    while events:
+        time, _, kind, job = heapq.heappop(events)
+        busy += (time - now) * sum(sched.used.values())
+        now = time
+        if kind == 'submit':
+            sched.submit(scheduler.Job(
+                job.pb_id, job.priority, job.resources, job.dependencies,
+                now, job.seq))
+            for dep in job.dependencies:
+                if dep in finished:
+                    sched.finished(dep, now, finished[dep])
+        else:
+            finished[job.pb_id] = True
+            sched.finished(job.pb_id, now)
+        dispatch, reject = sched.schedule(now)
+        for started in dispatch:
+            waits.append(now - started.submitted)
+            if started.priority > 0:
+                high_waits.append(now - started.submitted)
+            heapq.heappush(events, (now + durations[started.pb_id],
+                                    started.seq, 'finish', started))
+        for rejected in reject:
+            finished[rejected.pb_id] = False
+            sched.finished(rejected.pb_id, now, False)
+    waits.sort()
+    high_waits.sort()
+    metrics = sched.metrics(now)
+    return {
+        'completed': metrics['completed'],
+        'stuck': metrics['queue_depth'],
+        'wait_mean': sum(waits) / max(1, len(waits)),
+        'wait_p95': percentile(waits, 95) if waits else 0.0,
+        'high_wait_mean': sum(high_waits) / max(1, len(high_waits)),
+        'makespan': now,
+        'throughput': metrics['completed'] / now * 3600 if now else 0.0,
+        'utilisation': busy / now / sum(capacity.values())
+                       if now and capacity else 0.0,
+    }
+
+
+def main():
+    """Compare scheduling policies."""
+    args = docopt.docopt(__doc__)
+    capacity = scheduler.capacity_from_string(args['--capacity'])
+    workload = make_workload(args)
+    print("{:<10} {:>9} {:>6} {:>10} {:>10} {:>10} {:>10} {:>8} {:>6}".format(
+        "Policy", "Completed", "Stuck", "Wait mean", "Wait p95",
+        "High wait", "Makespan", "PBs/h", "Util"))
+    for policy in scheduler.POLICIES:
+        stats = simulate(workload, capacity, int(args['--max-running']),
+                         policy)
+        print("{:<10} {:>9} {:>6} {:>9.0f}s {:>9.0f}s {:>9.0f}s {:>9.0f}s "
+              "{:>8.1f} {:>5.0f}%".format(
+                  policy, stats['completed'], stats['stuck'],
+                  stats['wait_mean'], stats['wait_p95'],
+                  stats['high_wait_mean'], stats['makespan'],
+                  stats['throughput'], 100 * stats['utilisation']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Tests for reconciling processing blocks and deployments."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ska_sdp_config  # noqa: E402
+import scheduler  # noqa: E402
+import sharding  # noqa: E402
+from processing_controller import Reconciler, \
+    migrate_deployment_index  # noqa: E402
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+PREFIX = "/__test_reconciler"
+REALTIME = {'type': 'realtime', 'id': 'test_realtime', 'version': '0.1.0'}
+BATCH = {'type': 'batch', 'id': 'test_batch', 'version': '0.1.0'}
+WORKFLOWS_REALTIME = {('test_realtime', '0.1.0'): 'test/realtime:0.1.0'}
+WORKFLOWS_BATCH = {('test_batch', '0.1.0'): 'test/batch:0.1.0'}
+
+
+@pytest.fixture
+def cfg(monkeypatch):
+    monkeypatch.setenv('SDP_CONFIG_BACKEND', 'memory')
+    with ska_sdp_config.Config(global_prefix=PREFIX) as cfg:
+        cfg._backend.delete(PREFIX, must_exist=False, recursive=True)
+        yield cfg
+
+
+def make_pb(pb_id, workflow, **parameters):
+    return ska_sdp_config.ProcessingBlock(pb_id, None, workflow,
+                                          parameters=parameters)
+
+
+def run_pass(cfg, reconciler):
+    """Update model and reconcile, like one pass of the main loop."""
+    reconciler.wait(0)
+    if reconciler.dirty:
+        for txn in cfg.txn():
+            reconciler.reconcile(txn, WORKFLOWS_REALTIME)
+        reconciler.reconciled()
+    return reconciler.dispatch(WORKFLOWS_BATCH)
+
+
+def deployments(cfg):
+    for txn in cfg.txn():
+        return txn.list_deployments_by_pb()
+
+
+def test_reconcile_realtime(cfg):
+
+    reconciler = Reconciler(cfg, {})
+    try:
+        pb_id = 'realtime-20200101-0000'
+        for txn in cfg.txn():
+            txn.create_processing_block(make_pb(pb_id, REALTIME))
+        run_pass(cfg, reconciler)
+        assert deployments(cfg) == {pb_id: [pb_id + '-workflow']}
+        for txn in cfg.txn():
+            dpl = txn.get_deployment(pb_id + '-workflow')
+        assert dpl.args['values']['wf_image'] == 'test/realtime:0.1.0'
+
+        # Nothing to do without changes
+        passes = reconciler.passes
+        run_pass(cfg, reconciler)
+        assert reconciler.passes == passes
+
+        # Deleting the processing block deletes its deployment
+        for txn in cfg.txn():
+            txn.delete_processing_block(pb_id)
+        run_pass(cfg, reconciler)
+        assert deployments(cfg) == {}
+        for txn in cfg.txn():
+            assert txn.list_deployments() == []
+    finally:
+        reconciler.close()
+
+
+def test_reconcile_legacy_deployment(cfg):
+
+    # Deployment created before deployments recorded their processing
+    # block must not get created again
+    pb_id = 'realtime-20200101-0001'
+    for txn in cfg.txn():
+        txn.create_processing_block(make_pb(pb_id, REALTIME))
+        txn.create_deployment(ska_sdp_config.Deployment(
+            pb_id + '-workflow', 'helm', {'chart': 'workflow'}))
+    reconciler = Reconciler(cfg, {})
+    try:
+        run_pass(cfg, reconciler)
+        for txn in cfg.txn():
+            assert txn.list_deployments() == [pb_id + '-workflow']
+            assert migrate_deployment_index(txn) == 1
+        assert deployments(cfg) == {pb_id: [pb_id + '-workflow']}
+        for txn in cfg.txn():
+            assert migrate_deployment_index(txn) == 0
+    finally:
+        reconciler.close()
+
+
+def test_reconcile_batch(cfg):
+
+    sched = scheduler.BatchScheduler({'cpu': 4}, max_running=4)
+    reconciler = Reconciler(cfg, {}, sched)
+    try:
+        first = 'batch-20200101-0000'
+        second = 'batch-20200101-0001'
+        huge = 'batch-20200101-0002'
+        for txn in cfg.txn():
+            txn.create_processing_block(
+                make_pb(first, BATCH, resources={'cpu': 3}, priority=1))
+            txn.create_processing_block(
+                make_pb(second, BATCH, resources={'cpu': 3}))
+            txn.create_processing_block(
+                make_pb(huge, BATCH, resources={'cpu': 8}))
+        assert run_pass(cfg, reconciler) == 1
+        assert deployments(cfg) == {first: [first + '-workflow']}
+        assert list(sched.queued) == [second]
+
+        # Processing block that can never fit gets marked as failed
+        for txn in cfg.txn():
+            assert txn.get_processing_block_state(huge) == \
+                {'state': 'failed'}
+
+        # Finishing frees capacity for the next one
+        for txn in cfg.txn():
+            txn.create_processing_block_state(first, {'state': 'finished'})
+        assert run_pass(cfg, reconciler) == 1
+        assert sorted(deployments(cfg)) == [first, second]
+    finally:
+        reconciler.close()
+
+
+def test_reconcile_batch_cancelled(cfg):
+
+    sched = scheduler.BatchScheduler({'cpu': 4})
+    reconciler = Reconciler(cfg, {}, sched)
+    try:
+        first = 'batch-20200101-0004'
+        second = 'batch-20200101-0005'
+        for txn in cfg.txn():
+            txn.create_processing_block(
+                make_pb(first, BATCH, resources={'cpu': 3}, priority=1))
+            txn.create_processing_block(
+                make_pb(second, BATCH, resources={'cpu': 3}))
+        assert run_pass(cfg, reconciler) == 1
+        assert list(sched.queued) == [second]
+
+        # Cancelled while queued, so never gets dispatched
+        for txn in cfg.txn():
+            txn.create_processing_block_state(second, {'state': 'cancelled'})
+        run_pass(cfg, reconciler)
+        for txn in cfg.txn():
+            txn.create_processing_block_state(first, {'state': 'finished'})
+        assert run_pass(cfg, reconciler) == 0
+        assert deployments(cfg) == {first: [first + '-workflow']}
+        assert first not in sched and second not in sched
+    finally:
+        reconciler.close()
+
+
+def test_reconcile_batch_fence(cfg):
+
+    leader = sharding.ShardManager(cfg, 'replica-1', 4, controller='test')
+    other = sharding.ShardManager(cfg, 'replica-2', 4, controller='test')
+    leader.rebalance()
+    other.rebalance()
+    assert leader.is_leader and not other.is_leader
+
+    # Replica that wrongly believes it does batch admission does not
+    # dispatch, and keeps the job queued
+    other.is_leader = True
+    sched = scheduler.BatchScheduler({'cpu': 4})
+    reconciler = Reconciler(cfg, {}, sched, other)
+    try:
+        pb_id = 'batch-20200101-0003'
+        for txn in cfg.txn():
+            txn.create_processing_block(
+                make_pb(pb_id, BATCH, resources={'cpu': 2}))
+        assert run_pass(cfg, reconciler) == 0
+        assert deployments(cfg) == {}
+        assert list(sched.queued) == [pb_id]
+        assert not sched.running and sched.used == {'cpu': 0}
+
+        # Once it notices, it stops scheduling
+        other.rebalance()
+        reconciler.shards_changed()
+        assert pb_id not in sched
+    finally:
+        reconciler.close()
+        leader.close()
+        other.close()
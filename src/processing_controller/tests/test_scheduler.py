@@ -0,0 +1,155 @@
+"""Tests for the batch processing block scheduler."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from scheduler import BatchScheduler, Job, capacity_from_string  # noqa: E402
+
+# pylint: disable=missing-docstring,protected-access
+
+
+def make_job(sched, pb_id, priority=0, cpu=1, deps=(), now=0.0):
+    return Job(pb_id, priority, {'cpu': cpu}, list(deps), now,
+               sched.next_seq())
+
+
+def ids(jobs):
+    return [job.pb_id for job in jobs]
+
+
+def test_capacity_from_string():
+
+    assert capacity_from_string('') == {}
+    assert capacity_from_string('{"cpu": 16, "memory": 64}') == \
+        {'cpu': 16.0, 'memory': 64.0}
+    with pytest.raises(ValueError):
+        capacity_from_string('[1, 2]')
+
+
+def test_admission_order():
+
+    # Priority first, then submission order
+    sched = BatchScheduler({'cpu': 4}, max_running=10)
+    for pb_id, priority in [('a', 0), ('b', 5), ('c', 0)]:
+        sched.submit(make_job(sched, pb_id, priority, cpu=2))
+    dispatch, reject = sched.schedule(1.0)
+    assert ids(dispatch) == ['b', 'a'] and reject == []
+    assert sched.used == {'cpu': 4}
+    assert sched.schedule(2.0) == ([], [])
+
+    # Finishing releases capacity
+    sched.finished('b', 3.0)
+    assert sched.used == {'cpu': 2}
+    assert ids(sched.schedule(4.0)[0]) == ['c']
+    metrics = sched.metrics(4.0)
+    assert metrics['queue_depth'] == 0
+    assert metrics['running'] == 2
+    assert metrics['completed'] == 1
+    assert metrics['wait_max'] == 4.0
+    assert metrics['utilisation'] == {'cpu': 1.0}
+
+    # FIFO ignores priority
+    sched = BatchScheduler({'cpu': 4}, policy='fifo')
+    for pb_id, priority in [('a', 0), ('b', 5)]:
+        sched.submit(make_job(sched, pb_id, priority, cpu=4))
+    assert ids(sched.schedule(1.0)[0]) == ['a']
+
+
+def test_backfill():
+
+    for policy, expected in [('priority', []), ('backfill', ['small'])]:
+        sched = BatchScheduler({'cpu': 4}, policy=policy)
+        sched.submit(make_job(sched, 'running', cpu=2))
+        assert ids(sched.schedule(0.0)[0]) == ['running']
+        sched.submit(make_job(sched, 'big', priority=1, cpu=4))
+        sched.submit(make_job(sched, 'small', cpu=2))
+        assert ids(sched.schedule(1.0)[0]) == expected
+
+
+def test_max_running():
+
+    sched = BatchScheduler(max_running=2)
+    for pb_id in 'abc':
+        sched.submit(make_job(sched, pb_id))
+    assert ids(sched.schedule(0.0)[0]) == ['a', 'b']
+    sched.finished('a', 1.0)
+    assert ids(sched.schedule(1.0)[0]) == ['c']
+
+
+def test_dependencies():
+
+    sched = BatchScheduler()
+    sched.submit(make_job(sched, 'dep-ok', deps=['first']))
+    sched.submit(make_job(sched, 'dep-fail', deps=['second']))
+    assert sched.schedule(0.0) == ([], [])
+
+    sched.finished('first', 1.0, True)
+    sched.finished('second', 1.0, False)
+    dispatch, reject = sched.schedule(1.0)
+    assert ids(dispatch) == ['dep-ok']
+    assert ids(reject) == ['dep-fail']
+    assert 'dep-fail' not in sched
+
+    # Outcomes are forgotten once no queued job depends on them, so
+    # dependencies of later jobs need to be reported again
+    assert not sched._done
+    sched.submit(make_job(sched, 'dep-later', deps=['first']))
+    assert sched.schedule(2.0) == ([], [])
+    sched.finished('first', 2.0, True)
+    assert ids(sched.schedule(2.0)[0]) == ['dep-later']
+    assert not sched._done
+
+
+def test_finished_while_queued():
+
+    # Processing block cancelled before getting dispatched
+    sched = BatchScheduler(max_running=1)
+    sched.submit(make_job(sched, 'running'))
+    sched.submit(make_job(sched, 'cancelled'))
+    sched.submit(make_job(sched, 'dependent', deps=['cancelled']))
+    assert ids(sched.schedule(0.0)[0]) == ['running']
+    sched.finished('cancelled', 1.0, False)
+    assert 'cancelled' not in sched
+    assert sched.metrics(1.0)['completed'] == 0
+    sched.finished('running', 2.0)
+    dispatch, reject = sched.schedule(2.0)
+    assert dispatch == [] and ids(reject) == ['dependent']
+    assert not sched.queued and not sched._done
+
+
+def test_submit_oversize():
+
+    sched = BatchScheduler({'cpu': 4})
+    with pytest.raises(ValueError, match="more cpu"):
+        sched.submit(make_job(sched, 'huge', cpu=8))
+    assert 'huge' not in sched
+
+
+def test_requeue_and_remove():
+
+    sched = BatchScheduler({'cpu': 4})
+    job = make_job(sched, 'a', cpu=3)
+    sched.submit(job)
+    assert ids(sched.schedule(1.0)[0]) == ['a']
+    assert sched.used == {'cpu': 3}
+
+    # Requeueing releases capacity and undoes the dispatch
+    sched.requeue(job)
+    assert sched.used == {'cpu': 0}
+    assert list(sched.queued) == ['a'] and not sched.running
+    assert sched.dispatched_total == 0 and job.dispatched is None
+    assert ids(sched.schedule(2.0)[0]) == ['a']
+
+    # Removing a running job releases capacity as well
+    sched.remove('a')
+    assert sched.used == {'cpu': 0}
+    assert 'a' not in sched
+
+    # Adopting counts a job as running without dispatching it
+    sched.adopt(make_job(sched, 'b', cpu=4), 3.0)
+    assert list(sched.running) == ['b']
+    sched.submit(make_job(sched, 'c', cpu=1))
+    assert sched.schedule(3.0) == ([], [])
@@ -0,0 +1,165 @@
+"""Tests for partitioning processing blocks between controller replicas."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ska_sdp_config  # noqa: E402
+from sharding import ShardManager, assign_shards, shard_of  # noqa: E402
+
+# pylint: disable=missing-docstring,redefined-outer-name
+# pylint: disable=protected-access
+
+PREFIX = "/__test_sharding"
+NUM_SHARDS = 16
+
+
+@pytest.fixture
+def cfg(monkeypatch):
+    monkeypatch.setenv('SDP_CONFIG_BACKEND', 'memory')
+    with ska_sdp_config.Config(global_prefix=PREFIX) as cfg:
+        cfg._backend.delete(PREFIX, must_exist=False, recursive=True)
+        yield cfg
+
+
+def settle(managers):
+    """Rebalance until no replica changes its shards anymore."""
+    for mgr in managers:
+        mgr.rebalance()  # Make sure all are registered
+    for _ in range(10):
+        before = [(set(mgr.owned), mgr.is_leader) for mgr in managers]
+        for mgr in managers:
+            mgr.rebalance()
+        if before == [(mgr.owned, mgr.is_leader) for mgr in managers]:
+            return
+    raise AssertionError("Shard ownership did not settle")
+
+
+def test_assign_shards():
+
+    pb_ids = ['pb-test-{:04d}'.format(i) for i in range(100)]
+    assert all(0 <= shard_of(pb_id, NUM_SHARDS) < NUM_SHARDS
+               for pb_id in pb_ids)
+    assert shard_of(pb_ids[0], NUM_SHARDS) == shard_of(pb_ids[0], NUM_SHARDS)
+    assert assign_shards(NUM_SHARDS, []) == {}
+
+    # Balanced, with few shards moving when a replica gets added
+    replicas = ['replica-1', 'replica-2', 'replica-3']
+    assignment = assign_shards(NUM_SHARDS, replicas)
+    assert sorted(assignment) == list(range(NUM_SHARDS))
+    for replica in replicas:
+        assert list(assignment.values()).count(replica) <= 6
+    assignment2 = assign_shards(NUM_SHARDS, replicas + ['replica-4'])
+    moved = [shard for shard in assignment
+             if assignment[shard] != assignment2[shard]]
+    assert len(moved) < NUM_SHARDS // 2
+    assert assign_shards(NUM_SHARDS, list(reversed(replicas))) == assignment
+
+
+def test_shard_manager(cfg):
+
+    first = ShardManager(cfg, 'replica-1', NUM_SHARDS, controller='test')
+    second = ShardManager(cfg, 'replica-2', NUM_SHARDS, controller='test')
+    try:
+        # A single replica owns everything, and does batch admission
+        assert first.rebalance() == set(range(NUM_SHARDS))
+        assert first.is_leader
+
+        # Shards get split once the second replica registers
+        settle([first, second])
+        assert first.owned.isdisjoint(second.owned)
+        assert first.owned | second.owned == set(range(NUM_SHARDS))
+        assert first.owned and second.owned
+        assert first.is_leader and not second.is_leader
+
+        pb_id = 'pb-test-0000'
+        owner, other = (first, second) if first.owns(pb_id) else \
+            (second, first)
+        assert not other.owns(pb_id)
+        for txn in cfg.txn():
+            assert owner.fence(txn, pb_id)
+            assert not other.fence(txn, pb_id)
+            assert first.fence_leader(txn)
+            assert not second.fence_leader(txn)
+
+        # Leaving hands over shards and leadership
+        first.close()
+        assert not first.owned and not first.is_leader
+        second.rebalance()
+        assert second.owned == set(range(NUM_SHARDS))
+        assert second.is_leader
+    finally:
+        first.close()
+        second.close()
+
+
+def test_shard_manager_lease_expiry(cfg):
+
+    first = ShardManager(cfg, 'replica-1', NUM_SHARDS, controller='test')
+    second = ShardManager(cfg, 'replica-2', NUM_SHARDS, controller='test')
+    try:
+        settle([first, second])
+        assert first.registrations == 1
+        first_owned = set(first.owned)
+
+        # Lease expiring removes registration and ownership
+        first._lease.revoke()
+        second.rebalance()
+        assert second.owned == set(range(NUM_SHARDS))
+        assert second.is_leader
+        for txn in cfg.txn():
+            assert txn.list_controller_replicas('test') == ['replica-2']
+            assert not first.fence_leader(txn)
+
+        # The replica notices and registers again with a new lease
+        first.rebalance()
+        assert first.registrations == 2
+        for txn in cfg.txn():
+            assert txn.list_controller_replicas('test') == [
+                'replica-1', 'replica-2']
+        settle([first, second])
+        assert first.owned == first_owned
+        assert second.is_leader and not first.is_leader
+    finally:
+        first.close()
+        second.close()
+
+
+def test_shard_manager_lease_check_failure(cfg):
+
+    first = ShardManager(cfg, 'replica-1', NUM_SHARDS, controller='test')
+    try:
+        first.rebalance()
+        old_lease = first._lease
+        assert first.owned == set(range(NUM_SHARDS))
+
+        # Failing to check the lease counts as losing it: the old lease
+        # gets revoked and the replica registers again with a new one
+        def alive():
+            raise ConnectionError("Database unavailable")
+        old_lease.alive = alive
+        first.rebalance()
+        assert first._lease is not old_lease
+        assert first.registrations == 2
+        assert first.owned == set(range(NUM_SHARDS))
+        assert first.is_leader
+        assert old_lease.ID not in old_lease._store.leases
+
+        # If no new lease can be granted, ownership is dropped until the
+        # next rebalance
+        lease = cfg.lease
+
+        def no_lease(*_args, **_kwargs):
+            raise ConnectionError("Database unavailable")
+        cfg.lease = no_lease
+        first._lease.revoke()
+        assert first.rebalance() == set()
+        assert first._lease is None
+        assert not first.owned and not first.is_leader
+        cfg.lease = lease
+        assert first.rebalance() == set(range(NUM_SHARDS))
+        assert first.registrations == 3
+    finally:
+        first.close()
@@ -0,0 +1,145 @@
+"""Tests for fetching and caching workflow definitions."""
+
+import os
+import sys
+import json
+import time
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from processing_controller import WorkflowDefinitions  # noqa: E402
+
+# pylint: disable=missing-docstring
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), '..',
+                           'workflows_schema.json')
+
+
+def make_definition(versions):
+    return {
+        'about': ['Test workflow definitions'],
+        'version': {'date-time': '2020-01-01T00:00:00Z'},
+        'repositories': [{'name': 'test', 'path': 'test-repo'}],
+        'workflows': [
+            {'type': 'realtime', 'id': 'test_realtime', 'repository': 'test',
+             'image': 'workflow-test-realtime', 'versions': versions},
+            {'type': 'batch', 'id': 'test_batch', 'repository': 'test',
+             'image': 'workflow-test-batch', 'versions': ['0.1.0']},
+        ]
+    }
+
+
+def write(path, content):
+    with open(path, 'w') as file:
+        file.write(content)
+
+
+def test_workflows_refresh(tmp_path):
+
+    path = str(tmp_path / 'workflows.json')
+    url = 'file://' + path
+    cache_file = str(tmp_path / 'cache.json')
+    write(path, json.dumps(make_definition(['0.1.0'])))
+
+    changes = []
+    workflows = WorkflowDefinitions(url, SCHEMA_FILE, cache_file,
+                                    on_change=lambda: changes.append(1))
+    assert workflows.realtime == {}
+    assert workflows.refresh()
+    assert workflows.realtime == {
+        ('test_realtime', '0.1.0'): 'test-repo/workflow-test-realtime:0.1.0'}
+    assert workflows.batch == {
+        ('test_batch', '0.1.0'): 'test-repo/workflow-test-batch:0.1.0'}
+    assert workflows.refresh_time is not None
+
+    # Unchanged content is not installed again
+    tables = workflows.tables
+    assert not workflows.refresh()
+    assert workflows.tables is tables
+
+    # Changed content is
+    write(path, json.dumps(make_definition(['0.1.0', '0.2.0'])))
+    assert workflows.refresh()
+    assert ('test_realtime', '0.2.0') in workflows.realtime
+
+    # Invalid content is ignored, keeping the last good definitions
+    tables = workflows.tables
+    write(path, '{"invalid": ')
+    assert not workflows.refresh()
+    write(path, json.dumps({'workflows': []}))
+    assert not workflows.refresh()
+    assert workflows.tables is tables
+
+    # Background refresh calls back on changes only
+    write(path, json.dumps(make_definition(['0.3.0'])))
+    workflows.start(3600)
+    workflows.stop()
+    assert changes == [1]
+    assert list(workflows.realtime) == [('test_realtime', '0.3.0')]
+
+
+def test_workflows_cache(tmp_path):
+
+    path = str(tmp_path / 'workflows.json')
+    cache_file = str(tmp_path / 'cache.json')
+    write(path, json.dumps(make_definition(['0.1.0'])))
+    workflows = WorkflowDefinitions('file://' + path, SCHEMA_FILE, cache_file)
+    assert workflows.refresh()
+
+    # Cache gets used at startup, and if fetching fails
+    os.remove(path)
+    workflows = WorkflowDefinitions('file://' + path, SCHEMA_FILE, cache_file)
+    assert list(workflows.realtime) == [('test_realtime', '0.1.0')]
+    assert not workflows.refresh()
+    assert list(workflows.realtime) == [('test_realtime', '0.1.0')]
+
+    # Invalid cache is ignored
+    write(cache_file, 'invalid')
+    workflows = WorkflowDefinitions('file://' + path, SCHEMA_FILE, cache_file)
+    assert workflows.realtime == {}
+
+
+def test_workflows_stalled(tmp_path):
+
+    # Server accepting connections, but never responding
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        url = 'http://127.0.0.1:{}/workflows.json'.format(
+            server.getsockname()[1])
+        workflows = WorkflowDefinitions(url, SCHEMA_FILE, timeout=0.2)
+        start = time.time()
+        assert not workflows.refresh()
+        assert time.time() - start < 5
+
+    # Undecodable content is ignored
+    path = str(tmp_path / 'workflows.json')
+    with open(path, 'wb') as file:
+        file.write(b'\xff\xfe\xfd')
+    workflows = WorkflowDefinitions('file://' + path, SCHEMA_FILE)
+    assert not workflows.refresh()
+
+
+def test_workflows_refresh_failure(tmp_path, monkeypatch):
+
+    # Background refresh survives unexpected failures
+    path = str(tmp_path / 'workflows.json')
+    write(path, json.dumps(make_definition(['0.1.0'])))
+    workflows = WorkflowDefinitions('file://' + path, SCHEMA_FILE)
+    calls = []
+    refresh = workflows.refresh
+
+    def fail_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("Unexpected")
+        return refresh()
+    monkeypatch.setattr(workflows, 'refresh', fail_once)
+    workflows.start(0.05)
+    deadline = time.time() + 5
+    while not workflows.realtime and time.time() < deadline:
+        time.sleep(0.05)
+    workflows.stop()
+    assert len(calls) >= 2
+    assert list(workflows.realtime) == [('test_realtime', '0.1.0')]
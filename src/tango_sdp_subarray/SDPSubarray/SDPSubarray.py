@@ -12,14 +12,17 @@ import time
 import signal
 import logging
 import json
+import threading
+from collections import deque
 from enum import IntEnum, unique
 import jsonschema
 
 from ska_sdp_logging import tango_logging
+from ska_sdp_config.schema import SchemaRegistry
 
 import tango
 from tango import AttrWriteType, AttributeProxy, ConnectionFailed, Database, \
-    DbDevInfo, DevState
+    DbDevInfo, DevFailed, DevState, EventType
 from tango.server import Device, DeviceMeta, attribute, command, \
     device_property, run
 
@@ -33,6 +36,13 @@ except ImportError:
 
 LOG = logging.getLogger()
 
+# Directory containing the JSON schemas for validating configuration
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), 'schema')
+
+# Minimum and maximum delay (in seconds) before restarting a failed
+# watch of processing block states
+PB_STATE_WATCH_BACKOFF = (1.0, 30.0)
+
 
 # https://pytango.readthedocs.io/en/stable/data_types.html#devenum-pythonic-usage
 @unique
@@ -78,6 +88,125 @@ class FeatureToggle(IntEnum):
     AUTO_REGISTER = 3  #: Enable / Disable tango db auto-registration
 
 
+class AttributeWaiter:
+    """Wait for a Tango attribute to provide a matching value.
+
+    Subscribes to change events of the attribute, and waits for an
+    event with a matching value. If the attribute does not provide
+    change events, it falls back to polling, starting with a short
+    interval that grows while no match is found.
+
+    :param attribute_proxy: Tango attribute proxy
+    :param min_interval: Initial polling interval in seconds
+    :param max_interval: Maximum polling interval in seconds
+
+    """
+
+    def __init__(self, attribute_proxy, min_interval=0.05, max_interval=1.0):
+        """Initialise."""
+        self._proxy = attribute_proxy
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._condition = threading.Condition()
+        self._values = deque()
+
+        #: Whether change events were used (as opposed to polling)
+        self.used_events = None
+        #: Number of values received
+        self.values_seen = 0
+        #: Time taken to find a matching value, in seconds
+        self.time_to_match = None
+
+    def _push_event(self, event):
+        """Receive change event (called by Tango)."""
+        if event.err:
+            LOG.debug('Error event from %s: %s', event.attr_name,
+                      event.errors)
+            return
+        with self._condition:
+            self._values.append(event.attr_value.value)
+            self._condition.notify()
+
+    def _subscribe(self):
+        """Subscribe to change events.
+
+        :returns: Event ID, or None if events are not available
+
+        """
+        try:
+            return self._proxy.subscribe_event(EventType.CHANGE_EVENT,
+                                               self._push_event)
+        except DevFailed as error:
+            LOG.info('Change events unavailable, polling instead: %s',
+                     error.args[0].desc if error.args else error)
+            return None
+
+    def _next_event_value(self, deadline):
+        """Wait for the next value from a change event.
+
+        :returns: Value, or None if deadline was reached
+
+        """
+        with self._condition:
+            while not self._values:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._values.popleft()
+
+    def _poll_value(self, deadline, interval):
+        """Read the value after waiting for the polling interval.
+
+        :returns: Value, or None if deadline was reached
+
+        """
+        if interval > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+        return self._proxy.read().value
+
+    def wait(self, decode, match, timeout):
+        """Wait for a matching value.
+
+        :param decode: Function to decode attribute values. May raise
+            an exception if a value is invalid, which stops waiting.
+        :param match: Predicate on decoded values
+        :param timeout: Timeout in seconds
+        :returns: Matching decoded value, or None if timeout was
+            reached
+
+        """
+        start_time = time.time()
+        deadline = start_time + timeout
+        event_id = self._subscribe()
+        self.used_events = event_id is not None
+        # First read happens immediately when polling
+        interval = 0
+        try:
+            while True:
+                if self.used_events:
+                    value = self._next_event_value(deadline)
+                else:
+                    value = self._poll_value(deadline, interval)
+                    interval = min(max(2 * interval, self._min_interval),
+                                   self._max_interval)
+                if value is None:
+                    return None
+                self.values_seen += 1
+                decoded = decode(value)
+                if match(decoded):
+                    self.time_to_match = time.time() - start_time
+                    return decoded
+                LOG.debug('Waiting for matching value (elapsed: %2.4f s)',
+                          time.time() - start_time)
+        finally:
+            if event_id is not None:
+                self._proxy.unsubscribe_event(event_id)
+
+
 # class SDPSubarray(SKASubarray):
 class SDPSubarray(Device):
     """SDP Subarray device class.
@@ -175,6 +304,9 @@ class SDPSubarray(Device):
         self._set_health_state(HealthState.OK)
         self._set_receive_addresses(None)
 
+        # Load and compile JSON schemas once
+        self._schemas = SchemaRegistry(SCHEMA_DIR)
+
         # Initialise instance variables
         self._sbi_id = None
         self._pb_realtime = []
@@ -182,10 +314,21 @@ class SDPSubarray(Device):
         self._cbf_outlink_address = None
         self._pb_receive_addresses = None
 
+        # Processing block states, kept up to date by a watch on the
+        # config DB, and the processingBlockState attribute value
+        # serialised from them
+        self._pb_state_lock = threading.Lock()
+        self._pb_states = {}
+        self._pb_state_json = json.dumps([])
+        self._pb_state_watch = None
+        self._pb_state_watch_ok = False
+        self.set_change_event('processingBlockState', True)
+
         if ska_sdp_config is not None \
                 and self.is_feature_active(FeatureToggle.CONFIG_DB):
             self._config_db_client = ska_sdp_config.Config()
             LOG.debug('SDP Config DB enabled')
+            self._start_pb_state_watch()
         else:
             self._config_db_client = None
             LOG.warning('SDP Config DB disabled %s',
@@ -208,6 +351,7 @@ class SDPSubarray(Device):
     def delete_device(self):
         """Device destructor."""
         LOG.info('Deleting subarray device: %s', self.get_name())
+        self._stop_pb_state_watch()
 
     # ------------------
     # Attributes methods
@@ -259,19 +403,17 @@ class SDPSubarray(Device):
     def read_processingBlockState(self):
         """Get the states of the real-time processing blocks.
 
+        The value is maintained by a watch on the config DB (see
+        _watch_pb_states), so reading it does not access the database
+        unless the watch is down.
+
         :returns: JSON describing real-time processing block states
 
         """
-        pb_state_list = []
-
-        if self._config_db_client is not None:
-            for pb_id in self._pb_realtime:
-                for txn in self._config_db_client.txn():
-                    pb_state = txn.get_processing_block_state(pb_id).copy()
-                    pb_state['id'] = pb_id
-                    pb_state_list.append(pb_state)
-
-        return json.dumps(pb_state_list)
+        if not self._pb_state_watch_ok \
+                and self._config_db_client is not None:
+            self._read_pb_states()
+        return self._pb_state_json
 
     def write_obsState(self, obs_state):
         """Set the obsState attribute.
@@ -371,7 +513,7 @@ class SDPSubarray(Device):
         # self.set_state(DevState.ON)
 
         # Validate the JSON configuration string
-        config = self._validate_json_config(config_str, 'configure.json')
+        config = self._validate_json_config(config_str, 'configure')
 
         if config is None:
             # Validation has failed, so set obsState back to IDLE and raise
@@ -419,7 +561,7 @@ class SDPSubarray(Device):
         self._set_obs_state(ObsState.CONFIGURING)
 
         # Validate JSON configuration string
-        config = self._validate_json_config(config_str, 'configure_scan.json')
+        config = self._validate_json_config(config_str, 'configure_scan')
 
         if config is None:
             # Validation has failed, so set obsState back to READY and raise
@@ -581,6 +723,128 @@ class SDPSubarray(Device):
         self.push_change_event('receiveAddresses',
                                json.dumps(self._receive_addresses))
 
+    def _start_pb_state_watch(self):
+        """Start watching processing block states in the config DB."""
+        stop = threading.Event()
+        thread = threading.Thread(target=self._watch_pb_states,
+                                  args=(stop,), daemon=True)
+        self._pb_state_watch = (thread, stop)
+        thread.start()
+
+    def _stop_pb_state_watch(self):
+        """Stop watching processing block states."""
+        if self._pb_state_watch is not None:
+            thread, stop = self._pb_state_watch
+            stop.set()
+            thread.join()
+            self._pb_state_watch = None
+
+    def _watch_pb_states(self, stop):
+        """Follow processing block states (runs in background thread).
+
+        Updates the processingBlockState attribute whenever the state
+        of one of the real-time processing blocks changes. If watching
+        fails, it gets restarted with exponential backoff. Meanwhile
+        healthState is DEGRADED, and reading processingBlockState
+        falls back to reading the config DB directly.
+
+        :param stop: Event signalling to stop watching
+
+        """
+        backoff = PB_STATE_WATCH_BACKOFF[0]
+        # Pushing events requires an omniORB thread
+        with tango.EnsureOmniThread():
+            while not stop.is_set():
+                try:
+                    self._follow_pb_states(stop)
+                except Exception:  # pylint: disable=broad-except
+                    if self._pb_state_watch_ok:
+                        backoff = PB_STATE_WATCH_BACKOFF[0]
+                    LOG.exception('Watching processing block states '
+                                  'failed, restarting in %.0f s', backoff)
+                    self._set_pb_state_watch_ok(False)
+                    stop.wait(backoff)
+                    backoff = min(2 * backoff, PB_STATE_WATCH_BACKOFF[1])
+
+    def _follow_pb_states(self, stop):
+        """Follow processing block states using a new change feed.
+
+        The cached states get rebuilt from the snapshot of the feed.
+
+        :param stop: Event signalling to stop watching
+
+        """
+        pb_feed = self._config_db_client.watch_processing_blocks()
+        with pb_feed:
+            snapshot = True
+            while not stop.is_set():
+                events = pb_feed.poll(timeout=1.0)
+                changed = snapshot
+                with self._pb_state_lock:
+                    if snapshot:
+                        self._pb_states = {}
+                    for event in events:
+                        if not isinstance(event, pb_feed.StateChanged):
+                            continue
+                        if event.state is None:
+                            self._pb_states.pop(event.id, None)
+                        else:
+                            self._pb_states[event.id] = event.state
+                        changed |= event.id in self._pb_realtime
+                if snapshot:
+                    self._set_pb_state_watch_ok(True)
+                    snapshot = False
+                if changed:
+                    self._update_pb_state()
+
+    def _set_pb_state_watch_ok(self, watch_ok):
+        """Record whether the processing block state watch is up.
+
+        Switches healthState between OK and DEGRADED accordingly.
+
+        """
+        self._pb_state_watch_ok = watch_ok
+        if not watch_ok and self._health_state == HealthState.OK:
+            self._set_health_state(HealthState.DEGRADED)
+        elif watch_ok and self._health_state == HealthState.DEGRADED:
+            self._set_health_state(HealthState.OK)
+
+    def _read_pb_states(self):
+        """Read real-time processing block states from the config DB."""
+        with self._pb_state_lock:
+            pb_ids = list(self._pb_realtime)
+        try:
+            for txn in self._config_db_client.txn(serializable=True):
+                states = {pb_id: txn.get_processing_block_state(pb_id)
+                          for pb_id in pb_ids}
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Reading processing block states failed')
+            return
+        with self._pb_state_lock:
+            for pb_id, state in states.items():
+                if state is None:
+                    self._pb_states.pop(pb_id, None)
+                else:
+                    self._pb_states[pb_id] = state
+        self._update_pb_state()
+
+    def _update_pb_state(self):
+        """Update processingBlockState and issue a change event.
+
+        Only issues an event if the value changed.
+
+        """
+        with self._pb_state_lock:
+            pb_state_list = [
+                dict(self._pb_states.get(pb_id, {}), id=pb_id)
+                for pb_id in self._pb_realtime
+            ]
+            value = json.dumps(pb_state_list)
+            if value == self._pb_state_json:
+                return
+            self._pb_state_json = value
+        self.push_change_event('processingBlockState', value)
+
     def _require_obs_state(self, allowed_states, invert=False):
         """Require specified obsState values.
 
@@ -666,31 +930,25 @@ class SDPSubarray(Device):
         tango.Except.throw_exception(reason, desc, origin,
                                      tango.ErrSeverity.ERR)
 
-    @staticmethod
-    def _validate_json_config(config_str, schema_filename):
+    def _validate_json_config(self, config_str, schema_name):
         """Validate a JSON configuration against a schema.
 
         :param config_str: JSON configuration string
-        :param schema_filename: name of schema file in the 'schema'
-             sub-directory
+        :param schema_name: name of schema file in the 'schema'
+             sub-directory, without extension
         :returns: validated configuration (as dict/list), or None if
             validation fails
 
         """
         LOG.debug('Validating JSON configuration against schema %s',
-                  schema_filename)
+                  schema_name)
 
-        schema_path = os.path.join(os.path.dirname(__file__), 'schema',
-                                   schema_filename)
         config = None
 
         if config_str == '':
             LOG.error('Empty configuration string')
         try:
-            config = json.loads(config_str)
-            with open(schema_path, 'r') as file:
-                schema = json.load(file)
-            jsonschema.validate(config, schema)
+            config = self._schemas.loads(schema_name, config_str)
         except json.JSONDecodeError as error:
             LOG.error('Unable to decode configuration string as JSON: %s',
                       error.msg)
@@ -732,7 +990,8 @@ class SDPSubarray(Device):
             workflow = pbc.get('workflow')
             wf_type = workflow.get('type')
             if wf_type == 'realtime':
-                self._pb_realtime.append(pb_id)
+                with self._pb_state_lock:
+                    self._pb_realtime.append(pb_id)
             elif wf_type == 'batch':
                 self._pb_batch.append(pb_id)
             else:
@@ -766,9 +1025,13 @@ class SDPSubarray(Device):
             else:
                 scan_parameters = {}
 
-            if 'dependencies' in pbc and wf_type == 'realtime':
-                LOG.error('dependencies attribute must not appear in '
-                          'real-time processing block configuration')
+            dependencies = {}
+            if 'dependencies' in pbc:
+                if wf_type == 'realtime':
+                    LOG.error('dependencies attribute must not appear in '
+                              'real-time processing block configuration')
+                else:
+                    dependencies['dependencies'] = pbc.get('dependencies')
 
             # Create processing block with empty state
             if self._config_db_client is not None:
@@ -777,7 +1040,8 @@ class SDPSubarray(Device):
                     sbi_id=sbi_id,
                     workflow=workflow,
                     parameters=pbc.get('parameters'),
-                    scan_parameters=scan_parameters
+                    scan_parameters=scan_parameters,
+                    **dependencies
                 )
                 for txn in self._config_db_client.txn():
                     txn.create_processing_block(pb)
@@ -788,6 +1052,8 @@ class SDPSubarray(Device):
             self._cbf_outlink_address = cbf_outlink_address
             self._pb_receive_addresses = pb_receive_addresses
 
+        self._update_pb_state()
+
     def _update_scan_parameters(self, config):
         """Update scan parameters in real-time processing blocks.
 
@@ -817,7 +1083,7 @@ class SDPSubarray(Device):
                     )
                     txn.update_processing_block(pb_new)
 
-    def _get_receive_addresses(self, scan_id):
+    def _get_receive_addresses(self, scan_id, timeout=30.0):
         """Get the receive addresses for the next scan.
 
          The channel link map is read from the CSP device attribute and
@@ -826,6 +1092,7 @@ class SDPSubarray(Device):
          This communication happens via the processing block state.
 
         :param scan_id: scan ID for which to get receive addresses
+        :param timeout: Timeout in seconds
         :returns: receive address as dict
 
         """
@@ -838,25 +1105,33 @@ class SDPSubarray(Device):
         # Get channel link map with the same scan ID from CSP device
         channel_link_map = self._get_channel_link_map(scan_id)
 
-        # Update channel link map in the PB state
+        # Update channel link map in the PB state. It is stored in its
+        # own sub-key, so this does not conflict with the workflow
+        # writing the receive addresses.
         for txn in self._config_db_client.txn():
-            pb_state = txn.get_processing_block_state(pb_id)
-            pb_state['channel_link_map'] = channel_link_map
-            txn.update_processing_block_state(pb_id, pb_state)
+            txn.patch_processing_block_state(
+                pb_id, {'channel_link_map': channel_link_map},
+                fields=('channel_link_map',))
 
         # Wait for receive addresses with same scan ID to be available in the
         # PB state
-        for txn in self._config_db_client.txn():
-            pb_state = txn.get_processing_block_state(pb_id)
-            receive_addresses = pb_state.get('receive_addresses')
-            if receive_addresses is None:
-                ra_scan_id = None
-            else:
-                ra_scan_id = receive_addresses.get('scanId')
-            if ra_scan_id != scan_id:
-                txn.loop(wait=True)
+        def match(pb_state):
+            receive_addresses = (pb_state or {}).get('receive_addresses')
+            return receive_addresses is not None \
+                and receive_addresses.get('scanId') == scan_id
 
-        return receive_addresses
+        config_db = self._config_db_client
+        try:
+            pb_state, _ = config_db.wait_for_processing_block_state(
+                pb_id, match, timeout=timeout)
+        except TimeoutError:
+            self._set_obs_state(ObsState.FAULT)
+            self._raise_command_error('Timeout reached while waiting for '
+                                      'receive addresses of scan ID {}'
+                                      ''.format(scan_id))
+            return None
+
+        return pb_state.get('receive_addresses')
 
     def _get_channel_link_map(self, scan_id, timeout=30.0):
         """Get channel link map from the CSP Tango device attribute.
@@ -873,31 +1148,32 @@ class SDPSubarray(Device):
 
         LOG.debug('Waiting for CSP attribute to provide channel link map for '
                   'scan ID %s', scan_id)
-        # This is a horrendous hack to poll the CSP device until the scan
-        # ID matches. It needs to refactored to use events.
-        start_time = time.time()
-        while True:
-            channel_link_map_str = attribute_proxy.read().value
+
+        def decode(channel_link_map_str):
             channel_link_map = self._validate_json_config(
-                channel_link_map_str, 'channel_link_map.json')
+                channel_link_map_str, 'channel_link_map')
             if channel_link_map is None:
-                self._set_obs_state(ObsState.FAULT)
-                self._raise_command_error('Channel link map validation '
-                                          'failed')
-                break
-            if channel_link_map.get('scanID') == scan_id:
-                break
-            elapsed = time.time() - start_time
-            LOG.debug('Waiting for scan ID on CSP attribute '
-                      '(elapsed: %2.4f s)', elapsed)
-            if elapsed > timeout:
-                self._set_obs_state(ObsState.FAULT)
-                self._raise_command_error('Timeout reached while waiting for '
-                                          'scan ID on CSP attribute')
-                channel_link_map = None
-                break
-            time.sleep(1.0)
+                raise ValueError('Channel link map validation failed')
+            return channel_link_map
+
+        waiter = AttributeWaiter(attribute_proxy)
+        try:
+            channel_link_map = waiter.wait(
+                decode, lambda clm: clm.get('scanID') == scan_id, timeout)
+        except ValueError as error:
+            self._set_obs_state(ObsState.FAULT)
+            self._raise_command_error(str(error))
+            return None
+        if channel_link_map is None:
+            self._set_obs_state(ObsState.FAULT)
+            self._raise_command_error('Timeout reached while waiting for '
+                                      'scan ID on CSP attribute')
+            return None
 
+        LOG.info('Channel link map for scan ID %s received after %.3f s '
+                 '(%s, %d values seen)', scan_id, waiter.time_to_match,
+                 'events' if waiter.used_events else 'polling',
+                 waiter.values_seen)
         return channel_link_map
 
     def _end_realtime_processing(self):
@@ -909,10 +1185,12 @@ class SDPSubarray(Device):
 
         """
         self._sbi_id = None
-        self._pb_realtime = []
+        with self._pb_state_lock:
+            self._pb_realtime = []
         self._pb_batch = []
         self._cbf_outlink_address = None
         self._pb_receive_addresses = None
+        self._update_pb_state()
 
 
 def delete_device_server(instance_name='*'):
@@ -0,0 +1,123 @@
+"""
+Benchmark validation of configuration strings against JSON schemas.
+
+Generates Configure payloads with many processing blocks (and many
+fields in their parameters) and channel link maps with many channels,
+then validates them the way the subarray device used to (reading the
+schema file and building a validator on every call) and using the
+registry of precompiled validators. Reports the time per validation.
+
+Usage:
+  bench_validate.py [options] [<sizes>...]
+
+Options:
+  --repeat <count>  Number of validations per size [default: 50]
+  --fields <count>  Number of fields per processing block [default: 100]
+
+Sizes are numbers of processing blocks in the Configure payload and
+numbers of channels per link in the channel link map (default: 1 10
+100 1000).
+"""
+
+# pylint: disable=invalid-name
+
+import os
+import json
+import time
+import docopt
+import jsonschema
+from ska_sdp_config.schema import SchemaRegistry
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'SDPSubarray', 'schema')
+
+
+def make_configure(num_pbs, num_fields):
+    """Generate Configure payload."""
+    fields = [{'id': str(i), 'system': 'ICRS', 'ra': '02:31:50.91',
+               'dec': '89:15:51.4'} for i in range(num_fields)]
+    return json.dumps({
+        'sbiId': 'SBI-20200101-0001',
+        'scanId': 1,
+        'processingBlocks': [{
+            'id': 'PB-20200101-{:05d}'.format(i),
+            'workflow': {'type': 'realtime', 'id': 'vis_receive',
+                         'version': '0.1.0'},
+            'parameters': {'fields': fields},
+            'scanParameters': {'fieldId': '0', 'interval': 0.14}
+        } for i in range(num_pbs)]
+    })
+
+
+def make_channel_link_map(num_channels):
+    """Generate channel link map with 4 frequency slices of 20 links."""
+    return json.dumps({
+        'scanID': 1,
+        'fsp': [{
+            'fspID': fsp + 1,
+            'frequencySliceID': fsp + 1,
+            'cbfOutLink': [{
+                'linkID': link + 1,
+                'channel': [{
+                    'bw': 53763, 'cf': 4654489247 + 53763 * chan,
+                    'chanID': chan
+                } for chan in range(num_channels)]
+            } for link in range(20)]
+        } for fsp in range(4)]
+    })
+
+
+def validate_uncompiled(schema_name, config_str):
+    """Validate the way the subarray device used to."""
+    config = json.loads(config_str)
+    with open(os.path.join(SCHEMA_DIR, schema_name + '.json'), 'r') as file:
+        schema = json.load(file)
+    jsonschema.validate(config, schema)
+    return config
+
+
+def time_calls(function, repeat):
+    """Time calls of function.
+
+    :returns: Mean and maximum time per call in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return sum(times) / len(times), max(times)
+
+
+def main():
+    """Run benchmark."""
+    args = docopt.docopt(__doc__)
+    repeat = int(args['--repeat'])
+    num_fields = int(args['--fields'])
+
+    start = time.perf_counter()
+    schemas = SchemaRegistry(SCHEMA_DIR)
+    print("Compiled {} schemas in {:.2f} ms".format(
+        len(schemas), 1000 * (time.perf_counter() - start)))
+
+    print("{:<17} {:>6} {:>10} {:>12} {:>12} {:>12} {:>8}".format(
+        "Schema", "Size", "Bytes", "Uncompiled", "Compiled", "Max",
+        "Speedup"))
+    for size in [int(size) for size in args['<sizes>'] or
+                 ['1', '10', '100', '1000']]:
+        for schema_name, config_str in (
+                ('configure', make_configure(size, num_fields)),
+                ('channel_link_map', make_channel_link_map(size))):
+            before, _ = time_calls(
+                lambda: validate_uncompiled(schema_name, config_str),
+                repeat)
+            after, after_max = time_calls(
+                lambda: schemas.loads(schema_name, config_str), repeat)
+            print("{:<17} {:>6} {:>10} {:>10.3f}ms {:>10.3f}ms "
+                  "{:>10.3f}ms {:>7.1f}x".format(
+                      schema_name, size, len(config_str), 1000 * before,
+                      1000 * after, 1000 * after_max, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,8 @@ setup(
     ],
     install_requires=[
         'pytango',
-        'jsonschema'
+        'jsonschema',
+        'ska-sdp-config>=0.0.6'
     ],
     entry_points={
         'console_scripts': ['SDPSubarray = SDPSubarray:main']
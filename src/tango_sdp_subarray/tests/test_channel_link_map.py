@@ -0,0 +1,108 @@
+# coding: utf-8
+"""Tests for waiting for the channel link map from a CSP subarray."""
+# pylint: disable=invalid-name
+# pylint: disable=redefined-outer-name
+# pylint: disable=attribute-defined-outside-init
+
+import json
+import threading
+from os.path import dirname, join
+
+import tango
+from tango.server import Device, attribute, command
+from tango.test_context import DeviceTestContext
+
+import pytest
+
+from SDPSubarray.SDPSubarray import AttributeWaiter
+
+
+class CspSubarrayStandIn(Device):
+    """Stand-in for a CSP subarray device, providing the channel link map."""
+
+    events = True
+
+    cbfOutputLink = attribute(dtype=str)
+
+    def init_device(self):
+        """Initialise the device."""
+        Device.init_device(self)
+        self._channel_link_map = json.dumps({'scanID': 0, 'fsp': []})
+        if self.events:
+            self.set_change_event('cbfOutputLink', True, False)
+
+    def read_cbfOutputLink(self):
+        """Get the channel link map."""
+        return self._channel_link_map
+
+    @command(dtype_in=str)
+    def SetChannelLinkMap(self, value):
+        """Set the channel link map and issue a change event."""
+        self._channel_link_map = value
+        if self.events:
+            self.push_change_event('cbfOutputLink', value)
+
+
+class CspSubarrayStandInNoEvents(CspSubarrayStandIn):
+    """Stand-in for a CSP subarray device that does not issue events."""
+
+    events = False
+
+
+@pytest.fixture(params=[CspSubarrayStandIn, CspSubarrayStandInNoEvents])
+def csp_subarray(request):
+    """Run stand-in CSP subarray device in a separate process.
+
+    :returns: Tango test context and whether it issues events
+    """
+    context = DeviceTestContext(request.param,
+                                device_name='mid_csp/elt/subarray_1',
+                                process=True)
+    context.start()
+    yield context, request.param.events
+    context.stop()
+
+
+def channel_link_map_address(context):
+    """Get address of the channel link map attribute."""
+    return context.get_device_access().replace(
+        '#dbase=no', '/cbfOutputLink#dbase=no')
+
+
+def test_channel_link_map_wait(csp_subarray):
+    """Wait for the channel link map to reach the scan ID."""
+    context, events = csp_subarray
+    path = join(dirname(__file__), 'data', 'attr_cbfOutputLink-simple.json')
+    with open(path, 'r') as file:
+        channel_link_map = json.load(file)
+    channel_link_map['scanID'] = 2
+
+    attribute_proxy = tango.AttributeProxy(channel_link_map_address(context))
+    timer = threading.Timer(0.5, context.device.SetChannelLinkMap,
+                            [json.dumps(channel_link_map)])
+    timer.start()
+    waiter = AttributeWaiter(attribute_proxy)
+    value = waiter.wait(json.loads, lambda clm: clm['scanID'] == 2, 10.0)
+    timer.join()
+
+    assert value == channel_link_map
+    assert waiter.used_events == events
+    assert waiter.values_seen >= 2
+    assert 0.4 < waiter.time_to_match < 10.0
+
+
+def test_channel_link_map_timeout(csp_subarray):
+    """Time out waiting for the channel link map."""
+    context, events = csp_subarray
+    attribute_proxy = tango.AttributeProxy(channel_link_map_address(context))
+    waiter = AttributeWaiter(attribute_proxy)
+    assert waiter.wait(json.loads, lambda clm: clm['scanID'] == 3,
+                       0.5) is None
+    assert waiter.used_events == events
+    assert waiter.time_to_match is None
+
+    # Invalid values stop waiting
+    context.device.SetChannelLinkMap('invalid')
+    waiter = AttributeWaiter(attribute_proxy)
+    with pytest.raises(ValueError):
+        waiter.wait(json.loads, lambda clm: clm['scanID'] == 3, 5.0)
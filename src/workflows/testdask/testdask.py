@@ -21,6 +21,9 @@ log.setLevel(logging.INFO)
 # for deployments of additional software)
 config = ska_sdp_config.Config()
 
+# Maximum time to wait for Dask to become available, in seconds
+DASK_TIMEOUT = 200.0
+
 # Find processing block configuration from the configuration. Normally
 # this workflow should only get started once one is available, and we
 # just pull the ID from an environment variable here. But because the
@@ -62,27 +65,37 @@ def main(argv):
                 'worker.replicas': 2,
                 # We want to access Dask in-cluster using a DNS name
                 'scheduler.serviceType': 'ClusterIP'
-            }})
+            }}, pb_id=pb.pb_id)
     for txn in config.txn():
         txn.create_deployment(deploy)
     try:
 
-        # Wait for Dask to become available. At some point there will be a
-        # way to learn about availability from the configuration database
-        # (clearly populated by controllers querying Helm/Kubernetes).  So
-        # for the moment we'll simply query the DNS name where we know
-        # that Dask must become available eventually
+        # Wait for Dask to become available. The Helm deployment
+        # controller reports in the deployment status once the
+        # scheduler service has a ready endpoint.
         log.info("Waiting for Dask...")
-        client = None
-        for _ in range(200):
-            try:
-                client = distributed.Client(
-                    deploy_id + '-scheduler.' +
-                    os.environ['SDP_HELM_NAMESPACE'] + ':8786')
-            except Exception as e:
-                print(e)
-        if client is None:
-            log.error("Could not connect to Dask!")
+        try:
+            status, _ = config.wait_for_deployment_status(
+                deploy_id, lambda status: (status or {}).get('phase') in
+                ('ready', 'failed'), timeout=DASK_TIMEOUT)
+        except TimeoutError:
+            log.error("Dask not ready after %.0f s!", DASK_TIMEOUT)
+            exit(1)
+        if status.get('phase') != 'ready':
+            log.error("Could not deploy Dask: %s", status.get('last_error'))
+            exit(1)
+        log.info("Dask ready at %s", status.get('endpoints'))
+
+        # Connect to the scheduler endpoint
+        address = deploy_id + '-scheduler.' + \
+            os.environ['SDP_HELM_NAMESPACE'] + ':8786'
+        for endpoint in status.get('endpoints') or []:
+            if endpoint.endswith(':8786'):
+                address = endpoint
+        try:
+            client = distributed.Client(address)
+        except Exception as e:
+            log.error("Could not connect to Dask: %s", e)
             exit(1)
         log.info("Connected to Dask")
 
@@ -95,10 +108,8 @@ def main(argv):
 
         # Just idle until processing block or we lose ownership
         log.info("Done, now idling...")
-        for txn in config.txn():
-            if not txn.is_processing_block_owner(pb.pb_id):
-                break
-            txn.loop(True)
+        config.wait_for('/pb/{}/owner'.format(pb.pb_id),
+                        lambda owner: owner != config.owner)
 
     finally:
 
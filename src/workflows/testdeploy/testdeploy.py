@@ -41,13 +41,15 @@ logging.basicConfig()
 log = logging.getLogger('testdeploy')
 log.setLevel(logging.INFO)
 
-# Instantiate configuration
-client = ska_sdp_config.Config()
+# Instantiate configuration. Apply deployments in the background, so
+# that slow deployments do not hold up watching the processing block.
+client = ska_sdp_config.Config(side_effect_workers=4)
 
 
 def make_deployment(dpl_name, dpl_args, pb_id):
     """Make a deployment given PB parameters."""
-    return ska_sdp_config.Deployment(pb_id + "-" + dpl_name, **dpl_args)
+    return ska_sdp_config.Deployment(pb_id + "-" + dpl_name, pb_id=pb_id,
+                                     **dpl_args)
 
 
 def main(argv):
@@ -78,7 +80,7 @@ def main(argv):
             dirty = False
             for dpl_name, dpl_args in deploys.items():
                 if dpl_args != pb.parameters.get(dpl_name):
-                    deploy = make_deployment(dpl_name, dpl_args)
+                    deploy = make_deployment(dpl_name, dpl_args, pb_id)
                     log.info("Delete deployment {}".format(dpl_name))
                     txn.delete_deployment(deploy)
                     del deploys[dpl_name]
@@ -93,7 +95,7 @@ def main(argv):
 
                 # Get deployments, ignoring ones that don't fit
                 try:
-                    deploy = make_deployment(dpl_name, dpl_args)
+                    deploy = make_deployment(dpl_name, dpl_args, pb_id)
                 except ValueError as e:
                     log.warning("Deployment {} failed validation: {}".format(
                         dpl_name, str(e)))
@@ -116,7 +118,8 @@ def main(argv):
     finally:
         for txn in client.txn():
             for dpl_name, dpl_args in deploys.items():
-                txn.delete_deployment(make_deployment(dpl_name, dpl_args, pb_id))
+                txn.delete_deployment(
+                    make_deployment(dpl_name, dpl_args, pb_id))
 
 
 if __name__ == "__main__":
@@ -23,7 +23,6 @@ import logging
 import os
 import socket
 import sys
-import time
 
 import ska_sdp_config
 from . import common
@@ -31,6 +30,9 @@ from . import common
 
 SDP_HELM_NAMESPACE = os.environ.get('SDP_HELM_NAMESPACE', 'sdp')
 
+# Maximum time to wait for the deployment to become ready, in seconds
+DEPLOYMENT_TIMEOUT = 200.0
+
 logger = logging.getLogger(__name__)
 
 def get_pb(config, pb_id):
@@ -47,7 +49,7 @@ def create_deployment(config, pb):
     deployment = ska_sdp_config.Deployment(
         deploy_id, "helm", {
             'chart': 'daliuge',
-        })
+        }, pb_id=pb.pb_id)
     for txn in config.txn():
         txn.create_deployment(deployment)
     return deployment
@@ -55,10 +57,8 @@ def create_deployment(config, pb):
 
 def idle_for_some_obscure_reason(config, pb):
     logger.info("Done, now idling...")
-    for txn in config.txn():
-        if not txn.is_processing_block_owner(pb.pb_id):
-            break
-        txn.loop(True)
+    config.wait_for('/pb/{}/owner'.format(pb.pb_id),
+                    lambda owner: owner != config.owner)
 
 
 def cleanup(config, deployment):
@@ -67,23 +67,32 @@ def cleanup(config, deployment):
     config.close()
 
 
-def resolve_dim_host(deployment_id):
-    tries = 1
-    max_tries = 200
+def wait_for_deployment(config, deployment_id):
+    """Wait for the Helm deployment controller to report readiness."""
+    logger.info("Waiting for deployment %s to become ready", deployment_id)
+    try:
+        status, _ = config.wait_for_deployment_status(
+            deployment_id,
+            lambda status: (status or {}).get('phase') in ('ready', 'failed'),
+            timeout=DEPLOYMENT_TIMEOUT)
+    except TimeoutError:
+        raise RuntimeError("Deployment {} not ready after {} s, cannot "
+                           "continue".format(deployment_id,
+                                             DEPLOYMENT_TIMEOUT))
+    if status.get('phase') != 'ready':
+        raise RuntimeError("Deployment {} failed: {}".format(
+            deployment_id, status.get('last_error')))
+    logger.info("Deployment %s ready at %s", deployment_id,
+                status.get('endpoints'))
+    return status
+
+
+def resolve_dim_host(config, deployment_id):
+    wait_for_deployment(config, deployment_id)
     dlg_dim_host = deployment_id + '-dlg-dim.' + SDP_HELM_NAMESPACE
     logger.info("Resolving IP for DIM located at %s", dlg_dim_host)
-    for _ in range(max_tries):
-        try:
-            dlg_dim_ip = socket.gethostbyname(dlg_dim_host)
-            logger.info("Resolved %s to %s", dlg_dim_host, dlg_dim_ip)
-            break
-        except socket.gaierror:
-            logger.warning("Cannot resolve %s yet, trying again (%d/%d)",
-                    dlg_dim_host, tries, max_tries)
-            tries += 1
-            time.sleep(1)
-    if dlg_dim_ip is None:
-        raise RuntimeError("Couldn't resolve %s, cannot continue", dlg_dim_host)
+    dlg_dim_ip = socket.gethostbyname(dlg_dim_host)
+    logger.info("Resolved %s to %s", dlg_dim_host, dlg_dim_ip)
     return dlg_dim_ip
 
 
@@ -93,7 +102,7 @@ def main():
     pb = get_pb(config, sys.argv[1])
     deployment = create_deployment(config, pb)
     try:
-        dlg_dim_ip = resolve_dim_host(deployment.deploy_id)
+        dlg_dim_ip = resolve_dim_host(config, deployment.deploy_id)
         common.run_processing_block(pb, lambda _: None,
                 host=dlg_dim_ip, port=8001)
         idle_for_some_obscure_reason(config, pb)
@@ -49,20 +49,10 @@ def main(argv):
     # Sleep for 180 seconds
     time.sleep(180)
 
-    # Update state
+    # Update state. Patching only changes the given field, so this
+    # does not conflict with other writers of the state
     for txn in config.txn():
-        update_state = {
-            "state": "error",
-            "subarray": "ON-test",
-            "obsState": "SCANNING-test",
-            "receiveAddresses": {
-                "1": {
-                    "1": ["0.0.0.0", 1024]
-                }
-            }
-        }
-        # Update processing block state
-        txn.update_processing_block_state(pb_id, update_state)
+        txn.patch_processing_block_state(pb_id, {"state": "error"})
         LOG.info("Updated Processing Block State")
 
         # Get processing block state
@@ -30,17 +30,15 @@ def main(argv):
     deploy = ska_sdp_config.Deployment(
         deploy_id, "helm", {
             'chart': 'vis-receive',  # Helm chart deploy/charts/vis-receive
-        })
+        }, pb_id=pb.pb_id)
     for txn in config.txn():
         txn.create_deployment(deploy)
     try:
 
         # Just idle until processing block or disappears
         log.info("Done, now idling...")
-        for txn in config.txn():
-            if not txn.is_processing_block_owner(pb.pb_id):
-                break
-            txn.loop(True)
+        config.wait_for('/pb/{}/owner'.format(pb.pb_id),
+                        lambda owner: owner != config.owner)
 
     finally:
 